@@ -0,0 +1,107 @@
+import argparse
+import logging
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+import radix
+
+from benchmarks.synthetic import generate_collector_rows, generate_table
+from helpers.compression import (format_compression, get_compression, get_pickle_suffix, open_compressed,
+                                open_decompressed)
+
+DEFAULT_CODECS = 'bz2:1,bz2:9,gzip:1,gzip:6,gzip:9,lzma:0,lzma:6,none'
+
+
+def parse_codecs(arg: str) -> list:
+    """Parse a comma-separated list of CODEC[:LEVEL] into (codec, level) tuples."""
+    compressions = list()
+    for spec in arg.split(','):
+        codec, sep, level = spec.partition(':')
+        try:
+            compressions.append(get_compression(codec, int(level) if sep else None))
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return compressions
+
+
+def generate_tree(prefix_count: int, seed: int) -> radix.Radix:
+    """Build the transformed tree of one collector from a synthetic table."""
+    rtree = radix.Radix()
+    for version, network, prefix_length, origin in generate_collector_rows(generate_table(prefix_count, seed), seed, 0):
+        node = rtree.add(packed=network.to_bytes(4 if version == 4 else 16, 'big'), masklen=prefix_length)
+        node.data['as'] = str(origin)
+    return rtree
+
+
+def run(tree, compression: tuple, output_file: str, repeat: int) -> tuple:
+    """Return the best write and read times (in s) of tree with compression, and the file
+    size."""
+    write_times = list()
+    read_times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with open_compressed(output_file, compression) as f:
+            pickle.dump(tree, f)
+        write_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        with open_decompressed(output_file) as f:
+            pickle.load(f)
+        read_times.append(time.perf_counter() - start)
+    return min(write_times), min(read_times), os.path.getsize(output_file)
+
+
+def main() -> None:
+    desc = """Compare the size and the write and read times of a pickled tree with
+    different compression codecs and levels. Uses the given transformed or merged tree, or
+    the tree of a synthetic collector. Prints a Markdown table."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('input_file', nargs='?', help='pickled transformed or merged file of any codec')
+    parser.add_argument('-p', '--prefixes', type=int, default=1_000_000,
+                        help='number of prefixes of the synthetic tree if no input file is given (default: 1000000)')
+    parser.add_argument('--codecs', type=parse_codecs, default=DEFAULT_CODECS,
+                        help=f'comma-separated list of CODEC[:LEVEL] (default: {DEFAULT_CODECS})')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='runs per codec, the best is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--temp-dir', help='folder for the output files (default: system temporary folder)')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    if args.input_file:
+        with open_decompressed(args.input_file) as f:
+            tree = pickle.load(f)
+        logging.info(f'Loaded {args.input_file}')
+    else:
+        tree = generate_tree(args.prefixes, args.seed)
+        logging.info(f'Generated tree with {len(tree.nodes())} prefixes')
+    pickled_size = len(pickle.dumps(tree))
+
+    rows = list()
+    with tempfile.TemporaryDirectory(dir=args.temp_dir) as tmp_dir:
+        for compression in args.codecs:
+            output_file = os.path.join(tmp_dir, f'tree{get_pickle_suffix(compression)}')
+            write_time, read_time, size = run(tree, compression, output_file, args.repeat)
+            logging.info(f'{format_compression(compression)}: {size / 1024**2:.1f} MiB, write {write_time:.2f}s, '
+                         f'read {read_time:.2f}s')
+            rows.append((format_compression(compression), size, write_time, read_time))
+
+    print(f'Pickled size: {pickled_size / 1024**2:.1f} MiB')
+    print('| Codec | Size (MiB) | Ratio | Write (s) | Read (s) | Write (MiB/s) | Read (MiB/s) |')
+    print('|---|---:|---:|---:|---:|---:|---:|')
+    for codec, size, write_time, read_time in rows:
+        print(f'| {codec} | {size / 1024**2:.1f} | {pickled_size / size:.1f} | {write_time:.2f} | {read_time:.2f} | '
+              f'{pickled_size / 1024**2 / write_time:.0f} | {pickled_size / 1024**2 / read_time:.0f} |')
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -0,0 +1,89 @@
+import argparse
+import logging
+import random
+import sys
+import time
+
+import numpy as np
+
+from helpers.columnar import ColumnarRTree, columnar_to_rtree, is_columnar_file
+from helpers.lookup import PrefixLookup, read_merged_rows
+from helpers.merged_tree import load_merged_tree
+
+
+def generate_addresses(rows: list, count: int, seed: int) -> dict:
+    """Generate random addresses per family, mostly from within the given prefixes."""
+    rnd = random.Random(seed)
+    addresses = {4: list(), 6: list()}
+    for _ in range(count):
+        version, network, prefix_length, _, _ = rnd.choice(rows)
+        bits = 32 if version == 4 else 128
+        if rnd.random() < 0.9:
+            address = network | rnd.getrandbits(bits - prefix_length) if prefix_length < bits else network
+        else:
+            address = rnd.getrandbits(bits)
+        addresses[version].append(address)
+    return addresses
+
+
+def main() -> None:
+    desc = """Benchmark vectorized batch lookups against per-address radix.search_best
+    calls on a merged tree."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('merged_file', help='pickled or columnar merged file')
+    parser.add_argument('-c', '--count', type=int, default=1_000_000, help='number of addresses to look up')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    rows = list(read_merged_rows(args.merged_file))
+    addresses = generate_addresses(rows, args.count, args.seed)
+
+    start = time.perf_counter()
+    lookup = PrefixLookup(rows)
+    logging.info(f'Built lookup arrays from {len(rows)} prefixes in {time.perf_counter() - start:.2f}s')
+
+    v4 = np.array(addresses[4], dtype=np.uint32)
+    v6 = np.array([address.to_bytes(16, 'big') for address in addresses[6]], dtype='S16')
+    start = time.perf_counter()
+    v4_asns, v4_counts = lookup.lookup_v4(v4)
+    v6_asns, v6_counts = lookup.lookup_v6(v6)
+    batch_time = time.perf_counter() - start
+    # Origins are compared as strings, since not all of them are plain ASNs.
+    batch_origins = [lookup.decode_origin(asn) if count > 0 else None
+                     for asn, count in zip(v4_asns.tolist() + v6_asns.tolist(),
+                                           v4_counts.tolist() + v6_counts.tolist())]
+
+    if is_columnar_file(args.merged_file):
+        with ColumnarRTree(args.merged_file) as merged:
+            merged_rtree = columnar_to_rtree(merged)
+    else:
+        merged_rtree, _ = load_merged_tree(args.merged_file)
+    v4_packed = [address.to_bytes(4, 'big') for address in addresses[4]]
+    v6_packed = [address.to_bytes(16, 'big') for address in addresses[6]]
+    start = time.perf_counter()
+    radix_asns = list()
+    for packed in v4_packed + v6_packed:
+        node = merged_rtree.search_best(packed=packed)
+        radix_asns.append(node.data['as'] if node is not None else None)
+    radix_time = time.perf_counter() - start
+
+    mismatches = sum(a != b for a, b in zip(batch_origins, radix_asns))
+    if mismatches:
+        logging.error(f'{mismatches} results differ from radix.search_best')
+    total = len(v4) + len(v6)
+    logging.info(f'Batch lookup: {batch_time:.3f}s ({total / batch_time:,.0f} addresses/s)')
+    logging.info(f'search_best:  {radix_time:.3f}s ({total / radix_time:,.0f} addresses/s)')
+    logging.info(f'Speedup: {radix_time / batch_time:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -0,0 +1,260 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess as sp
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks.lookup import generate_addresses
+from benchmarks.synthetic import (AS_SET_RATIO, CONFLICT_RATIO, V6_RATIO, generate_table, get_collector_file,
+                                  write_collector_tree, write_rib)
+from helpers.defines import DEFAULT_STATS_FOLDER
+from helpers.lookup import PrefixLookup, read_merged_rows
+from helpers.merge import (build_merged_output, group_collector_rows, iter_collector_rows, new_merge_stats,
+                           prepare_collector_file, select_prefixes, write_merged_output)
+from helpers.transform import AGGREGATIONS, AGGREGATORS, FINALIZERS, get_peak_memory, new_transform_stats
+from readers.BGPKitReader import BGPKitReader
+
+RESULTS_VERSION = 1
+DEFAULT_RESULTS_DIR = os.path.join(DEFAULT_STATS_FOLDER, 'benchmarks')
+RESULTS_FILE_FORMAT = '%Y%m%d.%H%M%S.benchmark.json'
+STAGES = ('transform', 'merge', 'lookup')
+# Metrics that are compared with --compare, and whether larger values are better.
+COMPARED_METRICS = {
+    'wall_time': False,
+    'lines_per_s': True,
+    'prefixes_per_s': True,
+    'lookups_per_s': True,
+    'peak_rss': False,
+}
+
+
+def run_transform(rib_file: str, line_count: int, output_file: str, aggregation: str, output_format: str) -> dict:
+    """Transform a RIB in bgpkit-parser text format like transform_rib does."""
+    start = time.perf_counter()
+    stats = new_transform_stats(rib_file)
+    with open(rib_file, 'r') as f:
+        aggregate = AGGREGATORS[aggregation](BGPKitReader(rib_file).parse_lines(f), stats)
+        stats = FINALIZERS[aggregation](aggregate, stats, output_file, output_format)
+    wall_time = time.perf_counter() - start
+    prefixes = stats['v4_pfxs'] + stats['v6_pfxs']
+    return {'wall_time': wall_time,
+            'lines': line_count,
+            'lines_per_s': line_count / wall_time,
+            'prefixes': prefixes,
+            'prefixes_per_s': prefixes / wall_time,
+            'peak_rss': get_peak_memory()}
+
+
+def run_merge(collector_files: list, input_format: str, output_file: str, output_format: str,
+              min_collector_count: int) -> dict:
+    """Merge collector trees like create-merged-rtree.py does."""
+    collector_names = [os.path.basename(collector_file).split('.')[0] for collector_file in collector_files]
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(output_file)) as spill_dir:
+        prepared_files = [prepare_collector_file(collector_file, input_format, spill_dir)
+                          for collector_file in collector_files]
+        collector_rows = [iter_collector_rows(prepared_file, input_format) for prepared_file in prepared_files]
+        stats = new_merge_stats()
+        merged_output = build_merged_output(select_prefixes(group_collector_rows(collector_rows),
+                                                            min_collector_count,
+                                                            stats),
+                                            collector_names,
+                                            output_format)
+        write_merged_output(output_file, merged_output, collector_names, output_format)
+    wall_time = time.perf_counter() - start
+    return {'wall_time': wall_time,
+            'collectors': len(collector_files),
+            'prefixes': stats['total_prefixes'],
+            'prefixes_per_s': stats['total_prefixes'] / wall_time,
+            'merged_prefixes': stats['used_prefixes'],
+            'peak_rss': get_peak_memory()}
+
+
+def run_lookup(merged_file: str, lookup_count: int, seed: int) -> dict:
+    """Load a merged tree into a PrefixLookup and look up random addresses in batches."""
+    start = time.perf_counter()
+    rows = list(read_merged_rows(merged_file))
+    lookup = PrefixLookup(rows)
+    build_time = time.perf_counter() - start
+    addresses = generate_addresses(rows, lookup_count, seed)
+    v4 = np.array(addresses[4], dtype=np.uint32)
+    v6 = np.array([address.to_bytes(16, 'big') for address in addresses[6]], dtype='S16')
+    lookup_start = time.perf_counter()
+    lookup.lookup_v4(v4)
+    lookup.lookup_v6(v6)
+    lookup_time = time.perf_counter() - lookup_start
+    return {'wall_time': build_time + lookup_time,
+            'build_time': build_time,
+            'prefixes': len(rows),
+            'prefixes_per_s': len(rows) / build_time,
+            'lookups': lookup_count,
+            'lookups_per_s': lookup_count / lookup_time,
+            'peak_rss': get_peak_memory()}
+
+
+def run_stage(function, args: tuple, repeat: int) -> dict:
+    """Run a stage repeat times, each in a new process, so that the peak RSS only covers
+    the stage itself. Returns the result of the fastest run."""
+    best = None
+    context = multiprocessing.get_context('spawn')
+    for _ in range(repeat):
+        with context.Pool(1) as pool:
+            result = pool.apply(function, args)
+        if best is None or result['wall_time'] < best['wall_time']:
+            best = result
+    return best
+
+
+def get_git_commit() -> str:
+    try:
+        return sp.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, sp.CalledProcessError):
+        return None
+
+
+def print_stage(stage: str, result: dict) -> None:
+    rates = [f'{result[metric]:,.0f} {metric.replace("_per_s", "")}/s'
+             for metric in ('lines_per_s', 'prefixes_per_s', 'lookups_per_s') if metric in result]
+    # autopep8: off
+    logging.info(f'{stage}: {result["wall_time"]:.3f}s, {", ".join(rates)}, peak RSS {result["peak_rss"] / 1024**2:.1f} MiB')
+    # autopep8: on
+
+
+def compare_results(results: dict, previous_file: str) -> None:
+    with open(previous_file, 'r') as f:
+        previous = json.load(f)
+    if previous['parameters'] != results['parameters']:
+        logging.warning(f'Parameters differ from {previous_file}, results are not comparable')
+    for stage, result in results['stages'].items():
+        previous_result = previous['stages'].get(stage)
+        if previous_result is None:
+            continue
+        for metric, larger_is_better in COMPARED_METRICS.items():
+            if metric not in result or not previous_result.get(metric):
+                continue
+            change = result[metric] / previous_result[metric] - 1
+            improved = change > 0 if larger_is_better else change < 0
+            value_format = ',.3f' if metric == 'wall_time' else ',.0f'
+            # autopep8: off
+            logging.info(f'{stage} {metric}: {result[metric]:{value_format}} (previous {previous_result[metric]:{value_format}}, {change:+.1%}, {"better" if improved else "worse"})')
+            # autopep8: on
+
+
+def main() -> None:
+    desc = """Benchmark the transform, merge and lookup stages on deterministic synthetic data
+    (see benchmarks.synthetic). The transform stage reads a generated RIB in bgpkit-parser
+    text format without running bgpkit-parser. The merge stage merges generated collector
+    trees, and the lookup stage looks up random addresses in the merged tree. Each stage
+    runs in its own process to measure its peak RSS. Results are saved as JSON."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('-p', '--prefixes', type=int, default=100_000, help='number of prefixes (default: 100000)')
+    parser.add_argument('--peers', type=int, default=20, help='number of peers in the RIB (default: 20)')
+    parser.add_argument('-c', '--collectors', type=int, default=10, help='number of collector trees (default: 10)')
+    parser.add_argument('--v6-ratio', type=float, default=V6_RATIO,
+                        help=f'share of IPv6 prefixes (default: {V6_RATIO})')
+    parser.add_argument('--conflict-ratio', type=float, default=CONFLICT_RATIO,
+                        help=f'share of prefixes with a second origin (default: {CONFLICT_RATIO})')
+    parser.add_argument('--as-set-ratio', type=float, default=AS_SET_RATIO,
+                        help=f'share of prefixes announced with an origin AS set (default: {AS_SET_RATIO})')
+    parser.add_argument('--lookups', type=int, default=1_000_000,
+                        help='number of addresses to look up (default: 1000000)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--aggregation', choices=AGGREGATIONS, default='radix',
+                        help='aggregation of the transform stage (default: radix)')
+    parser.add_argument('--format', choices=('pickle', 'columnar'), default='pickle',
+                        help='format of transformed and merged files (default: pickle)')
+    parser.add_argument('--min-collector-count', type=int, default=0,
+                        help='minimum number of collectors of the merge stage (default: 0)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES),
+                        help='stages to run (default: all). lookup requires merge.')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs, the fastest is reported (default: 1)')
+    parser.add_argument('--results-dir', default=DEFAULT_RESULTS_DIR,
+                        help=f'folder of the results file (default: {DEFAULT_RESULTS_DIR})')
+    parser.add_argument('--compare', help='results file of a previous run to compare to')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    if 'lookup' in args.stages and 'merge' not in args.stages:
+        logging.error('The lookup stage requires the merge stage')
+        sys.exit(1)
+
+    parameters = {'prefixes': args.prefixes,
+                  'peers': args.peers,
+                  'collectors': args.collectors,
+                  'v6_ratio': args.v6_ratio,
+                  'conflict_ratio': args.conflict_ratio,
+                  'as_set_ratio': args.as_set_ratio,
+                  'lookups': args.lookups,
+                  'seed': args.seed,
+                  'aggregation': args.aggregation,
+                  'format': args.format,
+                  'min_collector_count': args.min_collector_count}
+    results = {'version': RESULTS_VERSION,
+               'time': datetime.now(tz=timezone.utc).isoformat(),
+               'git_commit': get_git_commit(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpu_count': os.cpu_count(),
+               'parameters': parameters,
+               'stages': dict()}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        table = generate_table(args.prefixes, args.seed, args.v6_ratio, args.conflict_ratio, args.as_set_ratio)
+        rib_file = os.path.join(tmp_dir, 'rib.txt')
+        line_count = 0
+        if 'transform' in args.stages:
+            line_count = write_rib(table, rib_file, args.peers, args.seed)
+        collector_files = list()
+        if 'merge' in args.stages:
+            for collector_idx in range(args.collectors):
+                collector_file = get_collector_file(tmp_dir, f'c{collector_idx:02d}', args.format)
+                write_collector_tree(table, collector_file, args.format, args.seed, collector_idx)
+                collector_files.append(collector_file)
+        # autopep8: off
+        logging.info(f'Generated {len(table)} prefixes, {line_count} RIB entries and {len(collector_files)} collector trees in {time.perf_counter() - start:.2f}s')
+        # autopep8: on
+
+        suffix = '.col' if args.format == 'columnar' else '.pickle.bz2'
+        merged_file = os.path.join(tmp_dir, f'merged{suffix}')
+        stage_args = {
+            'transform': (run_transform, (rib_file, line_count, os.path.join(tmp_dir, f'transformed{suffix}'),
+                                          args.aggregation, args.format)),
+            'merge': (run_merge, (collector_files, args.format, merged_file, args.format, args.min_collector_count)),
+            'lookup': (run_lookup, (merged_file, args.lookups, args.seed)),
+        }
+        for stage in STAGES:
+            if stage not in args.stages:
+                continue
+            function, function_args = stage_args[stage]
+            results['stages'][stage] = run_stage(function, function_args, args.repeat)
+            print_stage(stage, results['stages'][stage])
+
+    results_file = os.path.join(args.results_dir, datetime.now(tz=timezone.utc).strftime(RESULTS_FILE_FORMAT))
+    os.makedirs(args.results_dir, exist_ok=True)
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    logging.info(f'Saved results to {results_file}')
+
+    if args.compare:
+        compare_results(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
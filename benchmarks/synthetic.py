@@ -0,0 +1,240 @@
+"""Deterministic synthetic routing data for benchmarks.
+
+A synthetic table assigns an origin to each prefix. Its prefix lengths and v4/v6 mix
+follow the shape of current full tables, part of the prefixes are more specifics of other
+prefixes, and origins are drawn from a skewed ASN pool. Some prefixes have a second origin
+(multi-origin conflicts) or are announced with an origin AS set by some peers.
+
+RIBs and collector trees are views of the same table: a RIB contains the entries of all
+peers of one collector in the text format of bgpkit-parser, and a collector tree
+contains the prefixes a collector sees, like a transformed file. The same parameters and
+seed always produce the same output.
+"""
+import argparse
+import logging
+import os
+import random
+import socket
+import sys
+from itertools import accumulate
+from typing import Iterator, List, Tuple
+
+import radix
+
+from helpers.columnar import format_prefix
+from helpers.prefix_filter import is_global_network
+from helpers.transform import write_rows, write_rtree
+
+# Relative frequency of prefix lengths in full tables.
+V4_LENGTH_WEIGHTS = {24: 600, 23: 100, 22: 120, 21: 45, 20: 40, 19: 25, 18: 10, 17: 7, 16: 15, 15: 2, 14: 2,
+                     13: 1, 12: 1}
+V6_LENGTH_WEIGHTS = {48: 450, 47: 30, 46: 50, 45: 10, 44: 80, 42: 10, 40: 60, 36: 30, 35: 5, 34: 10, 33: 10,
+                     32: 150, 31: 5, 30: 5, 29: 40}
+# Default shape of the data, see the arguments of main.
+V6_RATIO = 0.17
+MORE_SPECIFIC_RATIO = 0.3
+CONFLICT_RATIO = 0.01
+AS_SET_RATIO = 0.001
+# Share of peers with a full table, and the share of prefixes seen by full and partial
+# peers.
+FULL_FEED_RATIO = 0.75
+FULL_FEED_VISIBILITY = 0.98
+PARTIAL_FEED_VISIBILITY = 0.1
+# Share of peers (or collectors) that see the second origin of a conflicting prefix.
+CONFLICT_VISIBILITY = 0.3
+COLLECTOR_VISIBILITY = 0.95
+RIB_TIMESTAMP = 1704067200
+
+# Table rows are (version, network, prefix length, origin, second origin or None,
+# origin AS set or None), sorted in canonical order.
+TableRow = Tuple[int, int, int, int, int, str]
+
+
+def get_rng(seed: int, *name) -> random.Random:
+    """Return a generator for one component of the data, so that changing one parameter
+    does not change unrelated parts of the output."""
+    return random.Random('-'.join(str(part) for part in (seed,) + name))
+
+
+def generate_asns(count: int, rnd: random.Random) -> List[int]:
+    """Return count distinct ASNs, mostly 16-bit, some 32-bit."""
+    count_32 = count * 3 // 10
+    asns = rnd.sample(range(1, 64496), min(count - count_32, 64495)) + rnd.sample(range(131072, 4199999999), count_32)
+    rnd.shuffle(asns)
+    return asns
+
+
+def generate_network(version: int, prefix_length: int, rnd: random.Random, parent: tuple = None) -> int:
+    """Return a random global network, inside of parent (network, length) if given."""
+    bits = 32 if version == 4 else 128
+    host_mask = (1 << (bits - prefix_length)) - 1
+    while True:
+        if parent is not None:
+            network = parent[0] | (rnd.getrandbits(bits - parent[1]) if parent[1] < bits else 0)
+        elif version == 4:
+            network = rnd.getrandbits(32)
+        else:
+            # Global unicast space (2000::/3).
+            network = (1 << 125) | rnd.getrandbits(125)
+        network &= ~host_mask
+        if is_global_network(version, network, prefix_length):
+            return network
+
+
+def generate_table(prefix_count: int,
+                   seed: int,
+                   v6_ratio: float = V6_RATIO,
+                   conflict_ratio: float = CONFLICT_RATIO,
+                   as_set_ratio: float = AS_SET_RATIO) -> List[TableRow]:
+    rnd = get_rng(seed, 'table')
+    asns = generate_asns(max(16, prefix_count // 16), rnd)
+    # Few origins announce many prefixes.
+    asn_weights = list(accumulate(1 / (rank + 1) for rank in range(len(asns))))
+    length_weights = {version: (list(weights), list(accumulate(weights.values())))
+                      for version, weights in ((4, V4_LENGTH_WEIGHTS), (6, V6_LENGTH_WEIGHTS))}
+    prefixes = set()
+    parents = {4: list(), 6: list()}
+    table = list()
+    while len(table) < prefix_count:
+        version = 6 if rnd.random() < v6_ratio else 4
+        lengths, cum_weights = length_weights[version]
+        prefix_length = rnd.choices(lengths, cum_weights=cum_weights)[0]
+        parent = None
+        if parents[version] and rnd.random() < MORE_SPECIFIC_RATIO:
+            parent = rnd.choice(parents[version])
+            if parent[1] >= prefix_length:
+                parent = None
+        network = generate_network(version, prefix_length, rnd, parent)
+        if (version, network, prefix_length) in prefixes:
+            continue
+        prefixes.add((version, network, prefix_length))
+        if prefix_length < (24 if version == 4 else 48):
+            parents[version].append((network, prefix_length))
+        origin, second_origin = rnd.choices(asns, cum_weights=asn_weights, k=2)
+        if second_origin == origin or rnd.random() >= conflict_ratio:
+            second_origin = None
+        as_set = None
+        if rnd.random() < as_set_ratio:
+            as_set = f'{{{origin},{rnd.choice(asns)}}}'
+        table.append((version, network, prefix_length, origin, second_origin, as_set))
+    table.sort()
+    return table
+
+
+def generate_peers(peer_count: int, seed: int, collector_idx: int) -> List[Tuple[str, int, float]]:
+    """Return (peer IP, peer ASN, visibility) for the peers of a collector."""
+    rnd = get_rng(seed, 'peers', collector_idx)
+    peers = list()
+    for idx in range(peer_count):
+        if rnd.random() < 0.7:
+            peer_ip = socket.inet_ntop(socket.AF_INET, (0xC0000000 | collector_idx << 16 | idx).to_bytes(4, 'big'))
+        else:
+            peer_ip = socket.inet_ntop(socket.AF_INET6,
+                                       (0x2001_07f8 << 96 | collector_idx << 16 | idx).to_bytes(16, 'big'))
+        visibility = FULL_FEED_VISIBILITY if rnd.random() < FULL_FEED_RATIO else PARTIAL_FEED_VISIBILITY
+        peers.append((peer_ip, rnd.randrange(1, 64496), visibility))
+    return peers
+
+
+def generate_rib_lines(table: List[TableRow], peer_count: int, seed: int, collector_idx: int = 0) -> Iterator[str]:
+    """Yield the RIB entries of one collector in the format of bgpkit-parser, grouped by
+    prefix like the entries of a RIB dump."""
+    rnd = get_rng(seed, 'rib', collector_idx)
+    peers = generate_peers(peer_count, seed, collector_idx)
+    transits = [rnd.randrange(1, 64496) for _ in range(64)]
+    for version, network, prefix_length, origin, second_origin, as_set in table:
+        prefix = format_prefix(version, network, prefix_length)
+        for peer_ip, peer_asn, visibility in peers:
+            if rnd.random() >= visibility:
+                continue
+            path_origin = str(origin)
+            if second_origin is not None and rnd.random() < CONFLICT_VISIBILITY:
+                path_origin = str(second_origin)
+            elif as_set is not None and rnd.random() < 0.5:
+                path_origin = as_set
+            path = [str(peer_asn)] + [str(transit) for transit in rnd.sample(transits, rnd.randrange(4))]
+            path.append(path_origin)
+            yield (f'A|{RIB_TIMESTAMP}|{peer_ip}|{peer_asn}|{prefix}|{" ".join(path)}|{path_origin.strip("{}")}|IGP|'
+                   f'{peer_ip}|0|0||false|||\n')
+
+
+def write_rib(table: List[TableRow], output_file: str, peer_count: int, seed: int, collector_idx: int = 0) -> int:
+    """Write the RIB of one collector to output_file and return the number of lines."""
+    line_count = 0
+    with open(output_file, 'w') as f:
+        for line in generate_rib_lines(table, peer_count, seed, collector_idx):
+            f.write(line)
+            line_count += 1
+    return line_count
+
+
+def generate_collector_rows(table: List[TableRow], seed: int, collector_idx: int) -> Iterator[tuple]:
+    """Yield the (version, network, prefix length, origin) rows of the transformed tree
+    of one collector in canonical order."""
+    rnd = get_rng(seed, 'collector', collector_idx)
+    for version, network, prefix_length, origin, second_origin, _ in table:
+        if rnd.random() >= COLLECTOR_VISIBILITY:
+            continue
+        if second_origin is not None and rnd.random() < CONFLICT_VISIBILITY:
+            origin = second_origin
+        yield version, network, prefix_length, origin
+
+
+def write_collector_tree(table: List[TableRow], output_file: str, output_format: str, seed: int,
+                         collector_idx: int) -> None:
+    rows = generate_collector_rows(table, seed, collector_idx)
+    if output_format == 'columnar':
+        write_rows(rows, output_file)
+        return
+    rtree = radix.Radix()
+    for version, network, prefix_length, origin in rows:
+        node = rtree.add(packed=network.to_bytes(4 if version == 4 else 16, 'big'), masklen=prefix_length)
+        node.data['as'] = str(origin)
+    write_rtree(rtree, output_file)
+
+
+def get_collector_file(output_dir: str, collector: str, output_format: str) -> str:
+    return os.path.join(output_dir, f'{collector}.col' if output_format == 'columnar' else f'{collector}.pickle.bz2')
+
+
+def main() -> None:
+    desc = """Generate a synthetic RIB in bgpkit-parser text format and transformed trees of
+    multiple collectors from the same synthetic table."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('output_dir', help='output folder')
+    parser.add_argument('-p', '--prefixes', type=int, default=100_000, help='number of prefixes (default: 100000)')
+    parser.add_argument('--peers', type=int, default=20, help='number of peers in the RIB (default: 20)')
+    parser.add_argument('-c', '--collectors', type=int, default=10, help='number of collector trees (default: 10)')
+    parser.add_argument('--v6-ratio', type=float, default=V6_RATIO,
+                        help=f'share of IPv6 prefixes (default: {V6_RATIO})')
+    parser.add_argument('--conflict-ratio', type=float, default=CONFLICT_RATIO,
+                        help=f'share of prefixes with a second origin (default: {CONFLICT_RATIO})')
+    parser.add_argument('--as-set-ratio', type=float, default=AS_SET_RATIO,
+                        help=f'share of prefixes announced with an origin AS set (default: {AS_SET_RATIO})')
+    parser.add_argument('--output-format', choices=('pickle', 'columnar'), default='pickle',
+                        help='format of the collector trees (default: pickle)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    table = generate_table(args.prefixes, args.seed, args.v6_ratio, args.conflict_ratio, args.as_set_ratio)
+    rib_file = os.path.join(args.output_dir, 'rib.txt')
+    line_count = write_rib(table, rib_file, args.peers, args.seed)
+    logging.info(f'Wrote {line_count} entries of {len(table)} prefixes to {rib_file}')
+    for collector_idx in range(args.collectors):
+        collector_file = get_collector_file(args.output_dir, f'c{collector_idx:02d}', args.output_format)
+        write_collector_tree(table, collector_file, args.output_format, args.seed, collector_idx)
+    logging.info(f'Wrote {args.collectors} collector trees to {args.output_dir}')
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -0,0 +1,137 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Iterable, Tuple
+
+import radix
+
+from helpers.prefix_filter import PrefixClassifier
+from helpers.transform import (RIB_READERS, aggregate_entries, aggregate_entries_compact, finalize_compact,
+                               finalize_rib, new_transform_stats)
+
+
+def aggregate_entries_per_entry(entries: Iterable[Tuple[object, str, str]], stats: dict) -> radix.Radix:
+    """Reference implementation of aggregate_entries that processes each entry on its
+    own, as transform_rib did before."""
+    rtree = radix.Radix()
+    classifier = PrefixClassifier()
+    for peer, prefix, origin_asn in entries:
+        if peer not in stats['peers']:
+            stats['peers'].add(peer)
+
+        try:
+            prefix_is_global = classifier.is_global(prefix)
+        except ValueError as e:
+            logging.error(f'Invalid prefix ({prefix}): {e}')
+            continue
+
+        if not prefix_is_global:
+            logging.debug(f'Ignoring non-global prefix: {prefix}')
+            continue
+
+        stats['entries'] += 1
+
+        if ',' in origin_asn:
+            # Do not include "Origin AS Sets"
+            stats['origin_sets'] += 1
+            continue
+        origin_asn = origin_asn.strip('{}')
+
+        node = rtree.add(prefix)
+        if 'as' in node.data:
+            if origin_asn not in node.data['as']:
+                logging.debug(f'{prefix}: {node.data["as"]} += {origin_asn}')
+                if peer in node.data['peers']:
+                    logging.error(f'Peer {peer} reported different origins for {prefix}: {node.data["as"]} '
+                                  f'{origin_asn}')
+                node.data['as'].add(origin_asn)
+                node.data['peers'].append(peer)
+        else:
+            node.data['as'] = {origin_asn}
+            node.data['peers'] = [peer]
+    return rtree
+
+
+def run(name: str,
+        aggregate,
+        finalize,
+        entries: list,
+        input_file: str,
+        output_file: str,
+        repeat: int) -> Tuple[float, dict]:
+    """Time aggregate and report the fastest of repeat runs, then measure the peak memory
+    allocated by aggregating and by finalizing in a separate run, since tracing slows down
+    allocations. Memory allocated by py-radix itself is not traced."""
+    best = None
+    for _ in range(repeat):
+        stats = new_transform_stats(input_file)
+        start = time.perf_counter()
+        aggregate(entries, stats)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    stats = new_transform_stats(input_file)
+    tracemalloc.start()
+    aggregated = aggregate(entries, stats)
+    _, aggregate_peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    stats = finalize(aggregated, stats, output_file, 'pickle')
+    _, finalize_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # autopep8: off
+    logging.info(f'{name}: {best:.3f}s ({len(entries) / best:,.0f} entries/s), peak memory aggregate {aggregate_peak / 1024**2:.1f} MiB finalize {finalize_peak / 1024**2:.1f} MiB')
+    # autopep8: on
+    return best, stats
+
+
+def main() -> None:
+    desc = """Benchmark the aggregation of RIB entries into origin sets, comparing the
+    prefix-run implementation and the compact aggregation with the per-entry reference.
+    Entries are read into memory first, so reader time is reported separately and is not
+    included in the peak memory. The finalized trees of all implementations are compared
+    byte by byte."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('rib_file', help='RIB file')
+    parser.add_argument('-r', '--reader', choices=sorted(RIB_READERS), default='mrt', help='RIB reader (default: mrt)')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest is reported (default: 3)')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    start = time.perf_counter()
+    entries = list(RIB_READERS[args.reader](args.rib_file).read())
+    read_time = time.perf_counter() - start
+    logging.info(f'Read {len(entries):,d} entries in {read_time:.3f}s ({len(entries) / read_time:,.0f} entries/s)')
+
+    implementations = [
+        ('Per entry', aggregate_entries_per_entry, finalize_rib),
+        ('Prefix runs', aggregate_entries, finalize_rib),
+        ('Compact', aggregate_entries_compact, finalize_compact),
+    ]
+    results = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for idx, (name, aggregate, finalize) in enumerate(implementations):
+            output_file = os.path.join(tmp_dir, f'{idx}.pickle.bz2')
+            elapsed, stats = run(name, aggregate, finalize, entries, args.rib_file, output_file, args.repeat)
+            with open(output_file, 'rb') as f:
+                results.append((name, elapsed, stats, f.read()))
+    reference_name, reference_time, reference_stats, reference_output = results[0]
+    for name, elapsed, stats, output in results[1:]:
+        if output != reference_output or stats != reference_stats:
+            logging.error(f'Output of {name} differs from {reference_name}')
+        else:
+            logging.info(f'{name}: output is byte-identical, speedup {reference_time / elapsed:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
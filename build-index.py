@@ -8,7 +8,10 @@ from datetime import datetime, timezone
 import requests
 from bs4 import BeautifulSoup
 
-from helpers.defines import DEFAULT_INDEX_FOLDER, INDEX_OUTPUT_FILE_FORMAT
+from helpers.defines import DEFAULT_INDEX_FOLDER, DEFAULT_STATS_FOLDER, INDEX_OUTPUT_FILE_FORMAT
+from helpers.shared_functions import get_stat_file_name
+from helpers.telemetry import (StageTelemetry, format_telemetry, get_file_size, write_prometheus_textfile,
+                               write_telemetry_stats)
 
 ROUTE_VIEWS_INDEX_URL = 'http://routeviews.org'
 RIS_API_ENDPOINT = 'https://stat.ripe.net/data/rrc-info/data.json'
@@ -24,9 +27,10 @@ def get_route_views_collector_name(url: str) -> str:
     return url_split[0]
 
 
-def fetch_url(url: str) -> requests.Response:
+def fetch_url(url: str, telemetry: StageTelemetry) -> requests.Response:
     logging.info(f'Fetching data from {url}')
     r = requests.get(url)
+    telemetry.add('bytes_read', len(r.content))
     try:
         r.raise_for_status()
     except requests.HTTPError as e:
@@ -35,17 +39,17 @@ def fetch_url(url: str) -> requests.Response:
     return r
 
 
-def fetch_route_views_source() -> str:
+def fetch_route_views_source(telemetry: StageTelemetry) -> str:
     """Fetch the HTML source of the Route Views landing page."""
-    r = fetch_url(ROUTE_VIEWS_INDEX_URL)
+    r = fetch_url(ROUTE_VIEWS_INDEX_URL, telemetry)
     if not r:
         return str()
     return r.text
 
 
-def fetch_ris_data() -> dict:
+def fetch_ris_data(telemetry: StageTelemetry) -> dict:
     """Fetch the full RIS API endpoint JSON object."""
-    r = fetch_url(RIS_API_ENDPOINT)
+    r = fetch_url(RIS_API_ENDPOINT, telemetry)
     if not r:
         return dict()
     try:
@@ -78,14 +82,14 @@ def get_route_views_collectors(source: str) -> list:
     return collector_links
 
 
-def fetch_ris_collectors() -> list:
+def fetch_ris_collectors(telemetry: StageTelemetry) -> list:
     """Build a list of RIS collector links.
 
     Create links from the URL template and the collector ids collected from the RIS API
     dump. Each collector has a numerical id from which the name is inferred according to
     the format rrc{id:02d}.
     """
-    collector_data = fetch_ris_data()
+    collector_data = fetch_ris_data(telemetry)
     if not collector_data:
         return list()
     if 'data' not in collector_data or 'rrcs' not in collector_data['data']:
@@ -109,8 +113,8 @@ def suffix_url(url: str) -> str:
     return url
 
 
-def handle_route_views() -> dict:
-    source = fetch_route_views_source()
+def handle_route_views(telemetry: StageTelemetry) -> dict:
+    source = fetch_route_views_source(telemetry)
     if not source:
         return dict()
 
@@ -121,8 +125,8 @@ def handle_route_views() -> dict:
     return ret
 
 
-def handle_ris() -> dict:
-    collector_links = fetch_ris_collectors()
+def handle_ris(telemetry: StageTelemetry) -> dict:
+    collector_links = fetch_ris_collectors(telemetry)
     ret = dict()
     for collector, url in sorted(collector_links):
         ret[collector] = suffix_url(url)
@@ -135,6 +139,13 @@ def main() -> None:
     parser.add_argument('-o', '--output-dir',
                         default=DEFAULT_INDEX_FOLDER,
                         help=f'output directory (default: {DEFAULT_INDEX_FOLDER})')
+    parser.add_argument('-w', '--write-stats', action='store_true', help='write stats to file')
+    parser.add_argument('-s', '--stats-dir',
+                        default=DEFAULT_STATS_FOLDER,
+                        help=f'stats output directory (default: {DEFAULT_STATS_FOLDER})')
+    parser.add_argument('--textfile-dir',
+                        help='also write telemetry as Prometheus metrics to this node exporter textfile collector '
+                        'directory')
     args = parser.parse_args()
 
     FORMAT = '%(asctime)s %(levelname)s %(message)s'
@@ -148,13 +159,14 @@ def main() -> None:
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
+    telemetry = StageTelemetry('index')
     output_data = dict()
     output_data['created'] = datetime.now(tz=timezone.utc).isoformat()
     sources = dict()
-    route_views = handle_route_views()
+    route_views = handle_route_views(telemetry)
     if route_views:
         sources['routeviews'] = route_views
-    ris = handle_ris()
+    ris = handle_ris(telemetry)
     if ris:
         sources['ris'] = ris
     if not sources:
@@ -170,6 +182,15 @@ def main() -> None:
     with open(output_file, 'w') as f:
         json.dump(output_data, f, indent=4)
 
+    telemetry.add('bytes_written', get_file_size(output_file))
+    summary = telemetry.summarize()
+    logging.info(f'Built index | {format_telemetry(summary)}')
+    if args.write_stats:
+        stats_output_file = get_stat_file_name(datetime.now(tz=timezone.utc), args.stats_dir, 'index')
+        write_telemetry_stats([dict(summary, file=output_file)], stats_output_file)
+    if args.textfile_dir:
+        write_prometheus_textfile(args.textfile_dir, 'index', summary)
+
 
 if __name__ == '__main__':
     main()
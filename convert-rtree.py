@@ -0,0 +1,83 @@
+import argparse
+import logging
+import os
+import sys
+
+from helpers.columnar import (KIND_MERGED, KIND_TRANSFORMED, ColumnarRTree, columnar_to_rtree, is_columnar_file,
+                              rtree_to_rows, write_columnar)
+from helpers.compression import CODECS, get_compression, get_pickle_suffix, open_compressed
+from helpers.merged_tree import COLLECTOR_ENCODINGS, SEEN_BY_COLLECTORS, dump_merged_tree, load_merged_tree
+
+
+def pickle_to_columnar(input_file: str, output_file: str) -> None:
+    rtree, collectors = load_merged_tree(input_file)
+    nodes = rtree.nodes()
+    if collectors is None and nodes and SEEN_BY_COLLECTORS in nodes[0].data:
+        collectors = sorted({collector for node in nodes for collector in node.data[SEEN_BY_COLLECTORS]})
+    if collectors is not None:
+        logging.info(f'Converting merged tree with {len(nodes)} prefixes from {len(collectors)} collectors')
+        write_columnar(output_file, rtree_to_rows(rtree, collectors), KIND_MERGED, collectors)
+    else:
+        logging.info(f'Converting transformed tree with {len(nodes)} prefixes')
+        write_columnar(output_file, rtree_to_rows(rtree), KIND_TRANSFORMED)
+
+
+def columnar_to_pickle(input_file: str, output_file: str, collector_encoding: str, compression: tuple) -> None:
+    with ColumnarRTree(input_file) as columnar:
+        logging.info(f'Converting {columnar.kind} tree with {len(columnar)} prefixes')
+        rtree = columnar_to_rtree(columnar, collector_encoding)
+        collectors = None
+        if columnar.kind == KIND_MERGED and collector_encoding == 'bitmask':
+            collectors = columnar.collectors
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with open_compressed(output_file, compression) as f:
+        dump_merged_tree(f, rtree, collectors)
+
+
+def main() -> None:
+    desc = """Convert transformed or merged radix trees between the pickle and columnar
+    formats. The direction is inferred from the input file."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('input_file', help='pickled (.pickle.bz2, .pickle.gz, .pickle.xz or .pickle) or columnar '
+                        'input file')
+    parser.add_argument('output_file', help='output file')
+    parser.add_argument('--collector-encoding', choices=COLLECTOR_ENCODINGS, default='names',
+                        help='encoding of the collectors of merged trees when converting to a pickle '
+                        '(default: names)')
+    parser.add_argument('--compression',
+                        choices=sorted(CODECS),
+                        default='bz2',
+                        help='compression codec when converting to a pickle. The output file should have the suffix '
+                             'of the codec (.pickle.bz2, .pickle.gz, .pickle.xz or .pickle), but readers detect the '
+                             'codec by its magic bytes (default: bz2)')
+    parser.add_argument('--compression-level',
+                        type=int,
+                        help='compression level of --compression (default: 9 for bz2, 6 for gzip and lzma)')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    try:
+        compression = get_compression(args.compression, args.compression_level)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+
+    if is_columnar_file(args.input_file):
+        if not args.output_file.endswith(get_pickle_suffix(compression)):
+            logging.warning(f'Output file will be compressed with {args.compression}, but its suffix is not '
+                            f'{get_pickle_suffix(compression)}.')
+        columnar_to_pickle(args.input_file, args.output_file, args.collector_encoding, compression)
+    else:
+        pickle_to_columnar(args.input_file, args.output_file)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -1,20 +1,98 @@
 import argparse
-import bz2
 import json
 import logging
 import os
-import pickle
 import sys
-from collections import defaultdict
-from datetime import timedelta
+import tempfile
+from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing import Pool
 
-import radix
-
-from helpers.defines import (DEFAULT_MERGED_FOLDER, DEFAULT_STATS_FOLDER, DEFAULT_TRANSFORMED_FOLDER,
-                             EXPECTED_OUTPUT_FILE_SUFFIX, RTREE_FILE_FORMATS, RTREE_OUTPUT_FILE_FORMAT,
-                             TIMESTAMP_FORMAT_ESCAPED)
+from helpers.compression import CODECS, get_compression
+from helpers.defines import (DEFAULT_INDEX_FOLDER, DEFAULT_MERGED_FOLDER, DEFAULT_PROFILE_FOLDER, DEFAULT_STATS_FOLDER,
+                             DEFAULT_TRANSFORMED_FOLDER, INTERMEDIATE_OUTPUT_FILE_FORMAT, TIMESTAMP_FORMAT_ESCAPED)
+from helpers.file_catalog import FileCatalog
+from helpers.merge import (FILE_FORMATS, build_merged_output, get_merged_output_file_name, get_output_file_suffix,
+                           group_collector_rows, iter_collector_rows, new_merge_stats, prepare_collector_file,
+                           print_merge_stats, read_intermediate, record_grouped_rows, select_prefixes,
+                           summarize_merge_stats, write_intermediate, write_merge_stats, write_merged_output)
+from helpers.merged_tree import COLLECTOR_ENCODINGS
+from helpers.profiling import (Profiler, checkpoint_allocations, get_job_name, get_profile_dir, profile_job,
+                               summarize_profiles)
 from helpers.shared_functions import (get_candidate_file, get_latest_index_file, get_stat_file_name,
-                                      parse_timestamp_argument)
+                                      parse_timestamp_range)
+from helpers.telemetry import (StageTelemetry, format_telemetry, get_cpu_time, get_file_size,
+                               write_prometheus_textfile)
+from helpers.transform import get_peak_memory
+
+
+def timed_prepare_collector_file(input_file: str,
+                                 input_format: str,
+                                 spill_dir: str,
+                                 profiler: Profiler = None) -> tuple:
+    """Run prepare_collector_file in a pool worker and return the prepared file with the
+    CPU time and peak memory of the worker, since the pool is reused for all timestamps.
+    The job is profiled if profiler is given."""
+    start_cpu_time = get_cpu_time()
+    with profile_job(profiler, get_job_name(input_file)):
+        prepared_file = prepare_collector_file(input_file, input_format, spill_dir)
+    return prepared_file, get_cpu_time() - start_cpu_time, get_peak_memory()
+
+
+def get_merge_job_name(timestamp: datetime) -> str:
+    return timestamp.strftime('merge.%Y%m%d.%H%M')
+
+
+def merge_timestamp(args: argparse.Namespace,
+                    timestamp: datetime,
+                    output_file: str,
+                    intermediate_file: str,
+                    collector_names: list,
+                    grouped_rows,
+                    telemetry: StageTelemetry) -> None:
+    """Select the prefixes of grouped_rows and write the merged tree of timestamp. If
+    intermediate_file is given, grouped_rows are saved to it as well. telemetry is
+    summarized once the tree is written."""
+    total_collector_count = len(collector_names)
+    logging.info(f'Read files from {total_collector_count} collectors')
+    min_collector_count = 0
+    if args.min_collector_ratio:
+        min_collector_ratio = args.min_collector_ratio
+        logging.info(f'Min. collector ratio: {min_collector_ratio}')
+        min_collector_count = int(total_collector_count * min_collector_ratio)
+    elif args.min_collector_count:
+        min_collector_count = args.min_collector_count
+    logging.info(f'Min. collector count: {min_collector_count}')
+
+    merge_stats = new_merge_stats()
+    if intermediate_file is not None:
+        intermediate_rows = list()
+        grouped_rows = record_grouped_rows(grouped_rows, intermediate_rows)
+    merged_output = build_merged_output(select_prefixes(grouped_rows, min_collector_count, merge_stats),
+                                        collector_names,
+                                        args.output_format,
+                                        args.collector_encoding)
+    checkpoint_allocations()
+    if intermediate_file is not None:
+        logging.info(f'Writing intermediate file {intermediate_file}')
+        write_intermediate(intermediate_file, intermediate_rows, collector_names)
+
+    merge_summary = summarize_merge_stats(merge_stats)
+    print_merge_stats(merge_summary)
+
+    write_merged_output(output_file, merged_output, collector_names, args.output_format, args.collector_encoding,
+                        get_compression(args.compression, args.compression_level))
+
+    telemetry.add('prefixes', merge_stats['total_prefixes'])
+    telemetry.add('bytes_written', get_file_size(output_file))
+    summary = telemetry.summarize()
+    logging.info(f'Merged {timestamp} | {format_telemetry(summary)}')
+
+    if args.write_stats:
+        stats_output_file = get_stat_file_name(timestamp, args.stats_dir, 'merged')
+        write_merge_stats(merge_summary, stats_output_file, summary)
+    if args.textfile_dir:
+        write_prometheus_textfile(args.textfile_dir, 'merge', summary)
 
 
 def main() -> None:
@@ -25,6 +103,14 @@ def main() -> None:
     is seen by fewer collectors, it is ignored as well."""
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument('timestamp', help=f'UTC timestamp in {TIMESTAMP_FORMAT_ESCAPED} format')
+    parser.add_argument('--end',
+                        help=f'UTC timestamp in {TIMESTAMP_FORMAT_ESCAPED} format. Create a tree for each timestamp '
+                             'from timestamp to end (inclusive), see --step. --output-file and --intermediate-file '
+                             'are then used as strftime formats')
+    parser.add_argument('--step',
+                        type=float,
+                        default=24,
+                        help='hours between the timestamps of a range (default: 24)')
     parser.add_argument('--output-file',
                         help=f'output file name. output file is created in the {DEFAULT_MERGED_FOLDER} folder')
     parser.add_argument('--max-timestamp-difference',
@@ -38,10 +124,64 @@ def main() -> None:
     parser.add_argument('-o', '--output-dir',
                         default=DEFAULT_MERGED_FOLDER,
                         help=f'output directory (default: {DEFAULT_MERGED_FOLDER})')
+    parser.add_argument('-n', '--num-workers',
+                        type=int,
+                        default=4,
+                        help='number of parallel workers that decompress and flatten input files')
+    parser.add_argument('--temp-dir',
+                        help='directory for temporary files of the merge (default: system temp directory)')
     parser.add_argument('-w', '--write-stats', action='store_true', help='write stats to file')
     parser.add_argument('-s', '--stats-dir',
                         default=DEFAULT_STATS_FOLDER,
                         help=f'stats output directory (default: {DEFAULT_STATS_FOLDER})')
+    parser.add_argument('--textfile-dir',
+                        help='also write telemetry as Prometheus metrics to this node exporter textfile collector '
+                        'directory')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='run each job under cProfile, write one profile per input file and a summary of the '
+                        'hottest functions to --profile-dir')
+    parser.add_argument('--profile-allocations',
+                        action='store_true',
+                        help='with --profile, also trace memory allocations with tracemalloc (slow)')
+    parser.add_argument('--profile-dir',
+                        help=f'profile output directory (default: new directory in {DEFAULT_PROFILE_FOLDER})')
+    parser.add_argument('--input-format',
+                        choices=sorted(FILE_FORMATS),
+                        default='pickle',
+                        help='format of the transformed input files (default: pickle)')
+    parser.add_argument('--output-format',
+                        choices=sorted(FILE_FORMATS),
+                        default='pickle',
+                        help='format of the output file (default: pickle)')
+    parser.add_argument('--compression',
+                        choices=sorted(CODECS),
+                        default='bz2',
+                        help='compression codec of a pickled output file, which determines the default file suffix '
+                             '(.pickle.bz2, .pickle.gz, .pickle.xz or .pickle). Readers detect the codec by its magic '
+                             'bytes (default: bz2)')
+    parser.add_argument('--compression-level',
+                        type=int,
+                        help='compression level of --compression (default: 9 for bz2, 6 for gzip and lzma)')
+    parser.add_argument('--collector-encoding',
+                        choices=COLLECTOR_ENCODINGS,
+                        default='names',
+                        help='store the collectors of each prefix of a pickled tree as names or as a bitmask into a '
+                             'collector table (default: names)')
+    parser.add_argument('--collectors',
+                        help='comma-separated list of collectors to merge (default: all collectors)')
+    intermediate_group = parser.add_mutually_exclusive_group()
+    intermediate_group.add_argument('--save-intermediate',
+                                    action='store_true',
+                                    help='also save the origins and collectors of all prefixes to an intermediate '
+                                         'file, from which trees for other thresholds or collectors can be built '
+                                         'quickly with --from-intermediate')
+    intermediate_group.add_argument('--from-intermediate',
+                                    action='store_true',
+                                    help='build the tree from the intermediate file instead of the transformed files')
+    parser.add_argument('--intermediate-file',
+                        help=f'intermediate file. created in the {DEFAULT_MERGED_FOLDER} folder (default: '
+                             f'{INTERMEDIATE_OUTPUT_FILE_FORMAT.replace("%", "%%")})')
     min_group = parser.add_mutually_exclusive_group()
     min_group.add_argument('--min-collector-ratio',
                            type=float,
@@ -64,129 +204,152 @@ def main() -> None:
 
     logging.info(f'Started {sys.argv}')
 
-    timestamp = parse_timestamp_argument(args.timestamp)
-    if timestamp is None:
+    try:
+        compression = get_compression(args.compression, args.compression_level)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+
+    timestamps = parse_timestamp_range(args.timestamp, args.end, args.step)
+    if timestamps is None:
         logging.error('Invalid timestamp specified')
         sys.exit(1)
+    if args.end:
+        logging.info(f'Processing {len(timestamps)} timestamps from {timestamps[0]} to {timestamps[-1]}')
+
+    collectors = None
+    if args.collectors:
+        collectors = args.collectors.split(',')
+        if args.output_file is None:
+            # The default file name does not reflect the collectors.
+            logging.error('--collectors requires --output-file')
+            sys.exit(1)
+
+    input_file_formats = FILE_FORMATS[args.input_format][0]
+    output_file_suffix = get_output_file_suffix(args.output_format, compression)
+
+    output_dir = args.output_dir
+    output_files = list()
+    intermediate_files = list()
+    for timestamp in timestamps:
+        output_file = args.output_file
+        if output_file is None:
+            output_file = get_merged_output_file_name(timestamp, args.output_format, args.min_collector_ratio,
+                                                      args.min_collector_count, compression)
+        elif args.end:
+            output_file = timestamp.strftime(output_file)
+        output_files.append(os.path.join(output_dir, output_file))
+        intermediate_file = args.intermediate_file
+        if intermediate_file is None:
+            intermediate_file = timestamp.strftime(INTERMEDIATE_OUTPUT_FILE_FORMAT)
+        elif args.end:
+            intermediate_file = timestamp.strftime(intermediate_file)
+        intermediate_files.append(os.path.join(output_dir, intermediate_file))
+    if len(set(output_files)) < len(timestamps) or \
+            (args.save_intermediate or args.from_intermediate) and len(set(intermediate_files)) < len(timestamps):
+        logging.error('Output files of the range are not unique. Use --output-file and --intermediate-file with '
+                      'strftime codes, e.g., %Y%m%d.%H%M.merged.pickle.bz2')
+        sys.exit(1)
+    if not output_files[0].endswith(output_file_suffix):
+        logging.warning(f'Output file will be in {output_file_suffix} format, but different file suffix '
+                        'was specified.')
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile_dir or get_profile_dir('merge'), args.profile_allocations)
+        logging.info(f'Writing profiles to {profiler.profile_dir}')
+
+    if args.from_intermediate:
+        for timestamp, output_file, intermediate_file in zip(timestamps, output_files, intermediate_files):
+            telemetry = StageTelemetry('merge')
+            telemetry.add('bytes_read', get_file_size(intermediate_file))
+            logging.info(f'Reading intermediate file {intermediate_file}')
+            try:
+                collector_names, grouped_rows = read_intermediate(intermediate_file, collectors)
+            except (OSError, ValueError) as e:
+                logging.error(f'Failed to read intermediate file: {e}')
+                sys.exit(1)
+            with profile_job(profiler, get_merge_job_name(timestamp)):
+                merge_timestamp(args, timestamp, output_file, None, collector_names, grouped_rows, telemetry)
+        if profiler is not None:
+            summarize_profiles(profiler.profile_dir)
+        return
 
     index_file = args.index
     if index_file is None:
-        index_file = get_latest_index_file(timestamp)
+        index_file = get_latest_index_file(timestamps[-1], FileCatalog(DEFAULT_INDEX_FOLDER))
         if not index_file:
             sys.exit(1)
     with open(index_file, 'r') as f:
         index = json.load(f)
 
-    output_dir = args.output_dir
-    output_file = args.output_file
-    if output_file is None:
-        output_file = timestamp.strftime(RTREE_OUTPUT_FILE_FORMAT)
-        if args.min_collector_ratio:
-            output_file = output_file.format(suffix=f'.min_ratio_{args.min_collector_ratio}')
-        elif args.min_collector_count:
-            output_file = output_file.format(suffix=f'.min_{args.min_collector_count}')
-        else:
-            output_file = output_file.format(suffix='')
-    output_file = os.path.join(output_dir, output_file)
-    if not output_file.endswith(EXPECTED_OUTPUT_FILE_SUFFIX):
-        logging.warning(f'Output file will be in {EXPECTED_OUTPUT_FILE_SUFFIX} format, but different file suffix '
-                        'was specified.')
-
     logging.info('Reading input files...')
     input_dir = args.data_dir
     max_timestamp_difference = timedelta(hours=args.max_timestamp_difference)
-    # prefix -> as -> set of collectors
-    prefix_maps = defaultdict(lambda: defaultdict(set))
-    total_collector_count = 0
-    for source, collectors in index['sources'].items():
-        for collector in collectors:
-            collector_dir = os.path.join(input_dir, source, collector)
-            candidate_file = get_candidate_file(collector_dir,
-                                                timestamp,
-                                                max_timestamp_difference,
-                                                RTREE_FILE_FORMATS)
-            if candidate_file is None:
-                continue
-            total_collector_count += 1
-            with bz2.open(candidate_file[1], 'rb') as f:
-                collector_rtree: radix.Radix = pickle.load(f)
-            for node in collector_rtree.nodes():
-                prefix_maps[node.prefix][node.data['as']].add(collector)
+    catalog = FileCatalog(input_dir)
+    # (collector, file path) of each timestamp
+    timestamp_collector_files = list()
+    for timestamp in timestamps:
+        collector_files = list()
+        for source, source_collectors in index['sources'].items():
+            for collector in source_collectors:
+                if collectors is not None and collector not in collectors:
+                    continue
+                collector_dir = os.path.join(input_dir, source, collector)
+                candidate_file = get_candidate_file(collector_dir,
+                                                    timestamp,
+                                                    max_timestamp_difference,
+                                                    input_file_formats,
+                                                    catalog)
+                if candidate_file is None:
+                    continue
+                collector_files.append((collector, candidate_file[1]))
+        timestamp_collector_files.append(collector_files)
+    # Index of the last timestamp that uses each file. Neighboring timestamps may share
+    # files, which are prepared once and removed after their last use.
+    last_use = dict()
+    for timestamp_idx, collector_files in enumerate(timestamp_collector_files):
+        for _, input_file in collector_files:
+            last_use[input_file] = timestamp_idx
+    if args.end:
+        logging.info(f'Found {len(last_use)} distinct files for {len(timestamps)} timestamps')
 
-    logging.info(f'Read files from {total_collector_count} collectors')
-    min_collector_count = 0
-    if args.min_collector_ratio:
-        min_collector_ratio = args.min_collector_ratio
-        logging.info(f'Min. collector ratio: {min_collector_ratio}')
-        min_collector_count = int(total_collector_count * min_collector_ratio)
-    elif args.min_collector_count:
-        min_collector_count = args.min_collector_count
-    logging.info(f'Min. collector count: {min_collector_count}')
-
-    merged_rtree = radix.Radix()
-    total_prefixes = len(prefix_maps)
-    used_prefixes = 0
-    collector_count_agg = 0
-    unique_prefixes = 0
-    below_threshold_prefixes = 0
-    contested_prefixes = 0
-    for prefix, ases in prefix_maps.items():
-        if len(ases) > 1:
-            # Never include contested prefixes.
-            contested_prefixes += 1
-            continue
-        unique_prefixes += 1
-        asn, collector_set = tuple(ases.items())[0]
-        if len(collector_set) < min_collector_count:
-            below_threshold_prefixes += 1
-            continue
-        node = merged_rtree.add(prefix)
-        node.data['as'] = asn
-        node.data['seen_by_collectors'] = tuple(collector_set)
-        used_prefixes += 1
-        collector_count_agg += len(collector_set)
-
-    # Statistics
-    avg_collector_count = collector_count_agg / used_prefixes
-
-    total_ignored_prefixes = contested_prefixes + below_threshold_prefixes
-    total_ignored_prefixes_pct = total_ignored_prefixes / total_prefixes * 100
-
-    below_threshold_prefixes_total_pct = below_threshold_prefixes / total_prefixes * 100
-    below_threshold_prefixes_pct = 0
-    if total_ignored_prefixes > 0:
-        below_threshold_prefixes_pct = below_threshold_prefixes / total_ignored_prefixes * 100
-
-    contested_prefixes_total_pct = contested_prefixes / total_prefixes * 100
-    contested_prefixes_pct = 0
-    if total_ignored_prefixes > 0:
-        contested_prefixes_pct = contested_prefixes / total_ignored_prefixes * 100
-
-    used_prefixes_pct = used_prefixes / total_prefixes * 100
-
-    # autopep8: off
-    logging.info(f'Used {used_prefixes} prefixes seen by {avg_collector_count:.2f} collectors on average')
-    logging.info(f'                     Total: {total_prefixes:9,d} 100.00%')
-    logging.info(f'                   Ignored: {total_ignored_prefixes:9,d} {total_ignored_prefixes_pct:6.2f}% 100.00%')
-    logging.info(f'Announced by multiple ASes: {contested_prefixes:9,d} {contested_prefixes_total_pct:6.2f}% {contested_prefixes_pct:6.2f}%')
-    logging.info(f'           Below threshold: {below_threshold_prefixes:9,d} {below_threshold_prefixes_total_pct:6.2f}% {below_threshold_prefixes_pct:6.2f}%')
-    logging.info(f'                      Used: {used_prefixes:9,d} {used_prefixes_pct:6.2f}%')
-    # autopep8: on
-
-    with bz2.open(output_file, 'wb') as f:
-        pickle.dump(merged_rtree, f)
-
-    if args.write_stats:
-        stats_output_file = get_stat_file_name(timestamp, args.stats_dir, 'merged')
-        with open(stats_output_file, 'w') as f:
-            # autopep8: off
-            f.write(f'average collectors per prefix,{avg_collector_count},,\n')
-            f.write(f'total prefixes,{total_prefixes},100%,\n')
-            f.write(f'ignored prefixes,{total_ignored_prefixes},{total_ignored_prefixes_pct}%, 100%\n')
-            f.write(f'announced by multiple ases,{contested_prefixes},{contested_prefixes_total_pct}%,{contested_prefixes_pct}%\n')
-            f.write(f'below threshold,{below_threshold_prefixes},{below_threshold_prefixes_total_pct}%,{below_threshold_prefixes_pct}%\n')
-            f.write(f'used prefixes,{used_prefixes},{used_prefixes_pct}%,\n')
-            # autopep8: on
+    num_workers = args.num_workers
+    with tempfile.TemporaryDirectory(dir=args.temp_dir) as spill_dir, Pool(num_workers) as p:
+        prepared_files = dict()
+        for timestamp_idx, timestamp in enumerate(timestamps):
+            collector_files = timestamp_collector_files[timestamp_idx]
+            if not collector_files:
+                logging.error(f'No input files found for {timestamp}')
+                continue
+            if args.end:
+                logging.info(f'Creating tree for {timestamp}')
+            telemetry = StageTelemetry('merge')
+            telemetry.add('files', len(collector_files))
+            telemetry.add('bytes_read', sum(get_file_size(input_file) for _, input_file in collector_files))
+            new_files = [input_file for _, input_file in collector_files if input_file not in prepared_files]
+            if new_files:
+                logging.info(f'Preparing {len(new_files)} files with {num_workers} parallel workers')
+            results = p.map(partial(timed_prepare_collector_file, input_format=args.input_format, spill_dir=spill_dir,
+                                    profiler=profiler),
+                            new_files)
+            for input_file, (prepared_file, cpu_time, peak_memory) in zip(new_files, results):
+                prepared_files[input_file] = prepared_file
+                telemetry.add_worker(cpu_time, peak_memory)
+            collector_names = [collector for collector, _ in collector_files]
+            collector_rows = [iter_collector_rows(prepared_files[input_file], args.input_format)
+                              for _, input_file in collector_files]
+            with profile_job(profiler, get_merge_job_name(timestamp)):
+                merge_timestamp(args, timestamp, output_files[timestamp_idx],
+                                intermediate_files[timestamp_idx] if args.save_intermediate else None,
+                                collector_names, group_collector_rows(collector_rows), telemetry)
+            for _, input_file in collector_files:
+                if last_use[input_file] == timestamp_idx:
+                    prepared_file = prepared_files.pop(input_file)
+                    if prepared_file != input_file:
+                        os.remove(prepared_file)
+    if profiler is not None:
+        summarize_profiles(profiler.profile_dir)
 
 
 if __name__ == '__main__':
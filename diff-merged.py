@@ -0,0 +1,62 @@
+import argparse
+import json
+import logging
+import sys
+import time
+from collections import Counter
+
+from helpers.diff import ADDED, CHANGES, OUTPUT_FORMATS, REMOVED, UNCHANGED, diff_rows, iter_merged_rows, write_diff
+from helpers.shared_functions import atomic_output_file
+
+
+def main() -> None:
+    desc = """Compare two merged trees and list the prefixes that were added, removed, changed
+    their origin, or changed the set of collectors that see them. Both inputs can be
+    pickled (either collector encoding) or columnar files. Columnar inputs are
+    streamed and are much faster to compare."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('old_file', help='old merged tree')
+    parser.add_argument('new_file', help='new merged tree')
+    parser.add_argument('output_file', help='output file for the change records')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='jsonl',
+                        help='format of the change records (default: jsonl)')
+    parser.add_argument('--changes', nargs='+', choices=CHANGES, default=list(CHANGES),
+                        help='only write these kinds of changes (default: all). All changes are counted in '
+                        'the summary.')
+    parser.add_argument('--summary-file', help='write the summary counts to this JSON file')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[logging.StreamHandler(sys.stdout)],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    logging.info(f'Comparing {args.old_file} to {args.new_file}')
+    start = time.perf_counter()
+    stats = Counter()
+    changes = set(args.changes)
+    records = (record for record in diff_rows(iter_merged_rows(args.old_file), iter_merged_rows(args.new_file), stats)
+               if record[0] in changes)
+    with atomic_output_file(args.output_file) as tmp_output_file:
+        with open(tmp_output_file, 'w', newline='') as f:
+            write_diff(records, f, args.output_format)
+    elapsed = time.perf_counter() - start
+
+    summary = {change: stats[change] for change in CHANGES + (UNCHANGED,)}
+    summary['old_prefixes'] = sum(summary.values()) - summary[ADDED]
+    summary['new_prefixes'] = summary['old_prefixes'] - summary[REMOVED] + summary[ADDED]
+    logging.info(f'Compared {sum(stats.values())} prefixes in {elapsed:.2f}s')
+    for change, count in summary.items():
+        logging.info(f'{change}: {count}')
+    if args.summary_file:
+        with atomic_output_file(args.summary_file) as tmp_summary_file:
+            with open(tmp_summary_file, 'w') as f:
+                json.dump(summary, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -22,6 +22,11 @@ Help()
     echo "fetch              Fetch RIBs from RIS and Routeviews"
     echo "transform          Transform RIBs into radix trees"
     echo "create             Create a prefix-to-ASN mapping"
+    echo "pipeline           Run fetch, transform, and create as a single pipeline"
+    echo "convert            Convert radix trees between the pickle and columnar formats"
+    echo "diff               Compare two merged trees"
+    echo "history            Append merged trees to the history store or query it"
+    echo "serve              Serve prefix-to-ASN queries from the latest merged tree"
     echo "clean              Clean all input directories"
     echo "clean-data         Clean RIB files"
     echo "clean-index        Clean index files"
@@ -43,6 +48,21 @@ case $T in
     create)
         python3 create-merged-rtree.py "${@:2}"
     ;;
+    pipeline)
+        python3 run-pipeline.py "${@:2}"
+    ;;
+    convert)
+        python3 convert-rtree.py "${@:2}"
+    ;;
+    diff)
+        python3 diff-merged.py "${@:2}"
+    ;;
+    history)
+        python3 history-store.py "${@:2}"
+    ;;
+    serve)
+        python3 query-service.py "${@:2}"
+    ;;
     all)
         if [ $# -ne 5 ]; then
             echo "usage: all timestamp num-fetchers num-transformers min-collector-count"
@@ -51,7 +71,7 @@ case $T in
         python3 build-index.py
         python3 fetch-snapshots.py -n "$3" "$2"
         python3 transform-snapshots.py -w -n "$4" "$2"
-        python3 create-merged-rtree.py -w --min-collector-count "$5" "$2"
+        python3 create-merged-rtree.py -w -n "$4" --min-collector-count "$5" "$2"
     ;;
     clean-data)
         rm -r data/*
@@ -2,33 +2,92 @@ import argparse
 import json
 import logging
 import sys
+from functools import partial
 from multiprocessing import Pool
 
 from fetchers import BaseFetcher
+from fetchers.AsyncFetchEngine import AsyncFetchEngine
 from fetchers.RISFetcher import RISFetcher
 from fetchers.RouteViewsFetcher import RouteViewsFetcher
-from helpers.defines import DEFAULT_DATA_FOLDER, TIMESTAMP_FORMAT_ESCAPED
-from helpers.shared_functions import get_latest_index_file, parse_timestamp_argument
+from helpers.defines import (DEFAULT_DATA_FOLDER, DEFAULT_INDEX_FOLDER, DEFAULT_PROFILE_FOLDER, DEFAULT_STATS_FOLDER,
+                             FOLDER_FORMAT, TIMESTAMP_FORMAT_ESCAPED)
+from helpers.file_catalog import FileCatalog
+from helpers.profiling import Profiler, get_job_name, get_profile_dir, profile_job, summarize_profiles
+from helpers.shared_functions import get_latest_index_file, get_stat_file_name, parse_timestamp_range
+from helpers.telemetry import (StageTelemetry, format_telemetry, get_total_row, write_prometheus_textfile,
+                               write_telemetry_stats)
 
 
-def fetch(collector: BaseFetcher) -> None:
-    collector.fetch()
+def select(collector: BaseFetcher, profiler: Profiler = None) -> list:
+    with profile_job(profiler, f'list.{collector.collector}.{collector.timestamp.strftime(FOLDER_FORMAT)}'):
+        return collector.get_pending_downloads()
+
+
+def download(item: tuple, profiler: Profiler = None) -> dict:
+    collector, url, output_file = item
+    with profile_job(profiler, get_job_name(output_file)):
+        return collector.timed_download(url, output_file)
+
+
+def parse_host_limit(arg: str) -> tuple:
+    host, sep, limit = arg.partition('=')
+    if not sep or not limit.isdigit() or int(limit) < 1:
+        raise argparse.ArgumentTypeError(f'expected HOST=N, got: {arg}')
+    return host, int(limit)
 
 
 def main() -> None:
     desc = """Takes an index file (created with build-index.py) and a timestamp fo fetch RIBs for
     the specified timestamp in parallel. By default the newest index file in the
-    /indexes folder is used."""
+    /indexes folder is used. With --end, RIBs for a range of timestamps are fetched, and
+    each remote folder is only listed once."""
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument('timestamp', help=f'UTC timestamp in {TIMESTAMP_FORMAT_ESCAPED} format')
+    parser.add_argument('--end',
+                        help=f'UTC timestamp in {TIMESTAMP_FORMAT_ESCAPED} format. Fetch RIBs for all timestamps from '
+                             'timestamp to end (inclusive), see --step')
+    parser.add_argument('--step',
+                        type=float,
+                        default=24,
+                        help='hours between the timestamps of a range (default: 24)')
     parser.add_argument('-i', '--index', help='index file')
     parser.add_argument('-n', '--num-workers',
                         type=int,
                         default=4,
-                        help='number of parallel workers')
+                        help='number of parallel workers (async engine: max. number of concurrent requests)')
     parser.add_argument('-o', '--output-dir',
                         default=DEFAULT_DATA_FOLDER,
                         help=f'output directory (default: {DEFAULT_DATA_FOLDER})')
+    parser.add_argument('-e', '--engine',
+                        choices=['pool', 'async'],
+                        default='pool',
+                        help='pool runs one process per collector. async runs all collectors in a thread pool of one '
+                             'process, with asyncio enforcing the global and per-host limits (default: pool)')
+    parser.add_argument('--max-per-host',
+                        type=parse_host_limit,
+                        action='append',
+                        default=list(),
+                        metavar='HOST=N',
+                        help='async engine: max. concurrent requests to HOST and its subdomains. Can be repeated')
+    parser.add_argument('--max-bandwidth',
+                        type=float,
+                        help='async engine: max. total download bandwidth in MB/s')
+    parser.add_argument('-w', '--write-stats', action='store_true', help='write stats to file')
+    parser.add_argument('-s', '--stats-dir',
+                        default=DEFAULT_STATS_FOLDER,
+                        help=f'stats output directory (default: {DEFAULT_STATS_FOLDER})')
+    parser.add_argument('--textfile-dir',
+                        help='also write telemetry as Prometheus metrics to this node exporter textfile collector '
+                        'directory')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='pool engine: run each job under cProfile, write one profile per downloaded file and a '
+                        'summary of the hottest functions to --profile-dir')
+    parser.add_argument('--profile-allocations',
+                        action='store_true',
+                        help='with --profile, also trace memory allocations with tracemalloc (slow)')
+    parser.add_argument('--profile-dir',
+                        help=f'profile output directory (default: new directory in {DEFAULT_PROFILE_FOLDER})')
     args = parser.parse_args()
 
     FORMAT = '%(asctime)s %(levelname)s %(message)s'
@@ -43,35 +102,85 @@ def main() -> None:
     )
 
     logging.info(f'Started {sys.argv}')
+    telemetry = StageTelemetry('fetch')
 
-    timestamp = parse_timestamp_argument(args.timestamp)
-    if timestamp is None:
+    timestamps = parse_timestamp_range(args.timestamp, args.end, args.step)
+    if timestamps is None:
         logging.error('Invalid timestamp specified')
         sys.exit(1)
+    if args.end:
+        logging.info(f'Processing {len(timestamps)} timestamps from {timestamps[0]} to {timestamps[-1]}')
 
     index_file = args.index
     if index_file is None:
-        index_file = get_latest_index_file(timestamp)
+        index_file = get_latest_index_file(timestamps[-1], FileCatalog(DEFAULT_INDEX_FOLDER))
         if not index_file:
             sys.exit(1)
     with open(index_file, 'r') as f:
         index = json.load(f)
 
     output_dir = args.output_dir
+    # Files are stored in monthly folders, so one fetcher per month and collector lists
+    # the folder once and selects the files for all timestamps of the month.
+    month_timestamps = dict()
+    for timestamp in timestamps:
+        month_timestamps.setdefault(timestamp.strftime(FOLDER_FORMAT), list()).append(timestamp)
     collectors = list()
-    # Build Route Views fetchers
-    for collector, url in index['sources']['routeviews'].items():
-        logging.debug(f'Creating RouteViewsFetcher {collector}')
-        collectors.append(RouteViewsFetcher(collector, url, timestamp, output_dir))
-    # Build RIS fetchers
-    for collector, url in index['sources']['ris'].items():
-        logging.debug(f'Creating RISFetcher {collector}')
-        collectors.append(RISFetcher(collector, url, timestamp, output_dir))
+    for timestamps_of_month in month_timestamps.values():
+        month_collectors = list()
+        # Build Route Views fetchers
+        for collector, url in index['sources']['routeviews'].items():
+            logging.debug(f'Creating RouteViewsFetcher {collector}')
+            month_collectors.append(RouteViewsFetcher(collector, url, timestamps_of_month[0], output_dir))
+        # Build RIS fetchers
+        for collector, url in index['sources']['ris'].items():
+            logging.debug(f'Creating RISFetcher {collector}')
+            month_collectors.append(RISFetcher(collector, url, timestamps_of_month[0], output_dir))
+        for fetcher in month_collectors:
+            fetcher.timestamps = timestamps_of_month
+        collectors += month_collectors
+
+    profiler = None
+    if args.profile:
+        if args.engine == 'async':
+            # Jobs of the async engine run concurrently in threads of the same process.
+            logging.error('--profile is only supported with the pool engine')
+            sys.exit(1)
+        profiler = Profiler(args.profile_dir or get_profile_dir('fetch'), args.profile_allocations)
+        logging.info(f'Writing profiles to {profiler.profile_dir}')
 
     num_workers = args.num_workers
-    logging.info(f'Starting {num_workers} workers')
-    with Pool(num_workers) as p:
-        p.map(fetch, collectors)
+    if args.engine == 'async':
+        max_bandwidth = args.max_bandwidth * 1_000_000 if args.max_bandwidth else None
+        logging.info(f'Fetching {len(collectors)} collectors with at most {num_workers} concurrent requests')
+        download_stats = AsyncFetchEngine(num_workers, dict(args.max_per_host), max_bandwidth).run(collectors)
+    else:
+        logging.info(f'Starting {num_workers} workers')
+        with Pool(num_workers) as p:
+            pending_downloads = p.map(partial(select, profiler=profiler), collectors)
+            downloads = [(collector, url, output_file)
+                         for collector, collector_downloads in zip(collectors, pending_downloads)
+                         for url, output_file in collector_downloads]
+            logging.info(f'Downloading {len(downloads)} files')
+            download_stats = p.map(partial(download, profiler=profiler), downloads)
+    if profiler is not None:
+        summarize_profiles(profiler.profile_dir)
+    # Catalog the new files now, so that the next stages do not have to scan the folders.
+    catalog = FileCatalog(output_dir)
+    for collector in collectors:
+        catalog.update(collector.output_dir)
+
+    telemetry.add_files(download_stats)
+    summary = telemetry.summarize()
+    logging.info(f'Downloaded {len(download_stats)} files | {format_telemetry(summary)}')
+    if args.write_stats:
+        # Only the first timestamp of a range is used for the name of the stats file,
+        # since files of neighboring timestamps are downloaded together.
+        stats_output_file = get_stat_file_name(timestamps[0], args.stats_dir, 'fetched')
+        write_telemetry_stats(sorted(download_stats, key=lambda d: d['file']) + [get_total_row(download_stats)],
+                              stats_output_file)
+    if args.textfile_dir:
+        write_prometheus_textfile(args.textfile_dir, 'fetch', summary, download_stats)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fetchers import BaseFetcher
+
+# Default maximum number of concurrent requests per archive host. Hosts are matched by
+# suffix, so subdomains share the limit of their parent entry.
+DEFAULT_HOST_LIMITS = {
+    'routeviews.org': 4,
+    'data.ris.ripe.net': 8,
+}
+# Limit for hosts without an explicit entry.
+DEFAULT_HOST_LIMIT = 4
+
+
+class BandwidthLimiter:
+    """Token bucket shared by all download threads."""
+
+    def __init__(self, bytes_per_second: float) -> None:
+        self.rate = bytes_per_second
+        self.allowance = bytes_per_second
+        self.last_update = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, num_bytes: int) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last_update) * self.rate)
+            self.last_update = now
+            self.allowance -= num_bytes
+            wait = -self.allowance / self.rate if self.allowance < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThreadSessions:
+    """One requests.Session per thread, since sessions are not thread-safe.
+
+    Provides the get method of a session, so it can be used as session of a fetcher. Each
+    thread makes one request at a time, so its session keeps at most one connection per
+    host.
+    """
+
+    def __init__(self, num_hosts: int) -> None:
+        self.num_hosts = num_hosts
+        self.local = threading.local()
+        self.sessions = list()
+        self.lock = threading.Lock()
+
+    def get_session(self) -> requests.Session:
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.num_hosts, pool_maxsize=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.get_session().get(url, **kwargs)
+
+    def close(self) -> None:
+        with self.lock:
+            for session in self.sessions:
+                session.close()
+            self.sessions = list()
+
+
+class AsyncFetchEngine:
+    """Run many fetchers concurrently in one process.
+
+    This is not an asynchronous HTTP client: the blocking requests calls of the fetchers
+    run in a thread pool, and the asyncio event loop only schedules them and enforces the
+    global and per-host limits on concurrent requests. The listing and parsing logic of the
+    fetchers is unchanged. Each thread has its own requests.Session, so keep-alive
+    connections are reused by the requests of a thread. Downloads can share a global
+    bandwidth budget.
+    """
+
+    def __init__(self,
+                 max_concurrency: int,
+                 host_limits: dict = None,
+                 max_bandwidth: float = None) -> None:
+        self.max_concurrency = max_concurrency
+        self.host_limits = dict(DEFAULT_HOST_LIMITS)
+        if host_limits:
+            self.host_limits.update(host_limits)
+        self.limiter = None
+        if max_bandwidth:
+            self.limiter = BandwidthLimiter(max_bandwidth)
+        self.sessions = None
+
+    def get_host_limit(self, host: str) -> int:
+        for suffix, limit in self.host_limits.items():
+            if host == suffix or host.endswith(f'.{suffix}'):
+                return limit
+        return DEFAULT_HOST_LIMIT
+
+    def run(self, fetchers: list) -> list:
+        """Fetch the pending downloads of all fetchers. Returns the telemetry of each
+        download (see BaseFetcher.timed_download)."""
+        hosts = {urlparse(fetcher.url).hostname for fetcher in fetchers}
+        self.sessions = ThreadSessions(max(len(hosts), 1))
+        try:
+            return asyncio.run(self.run_all(fetchers))
+        finally:
+            self.sessions.close()
+
+    async def run_all(self, fetchers: list) -> list:
+        loop = asyncio.get_running_loop()
+        global_semaphore = asyncio.Semaphore(self.max_concurrency)
+        host_semaphores = dict()
+        for fetcher in fetchers:
+            host = urlparse(fetcher.url).hostname
+            if host not in host_semaphores:
+                limit = self.get_host_limit(host)
+                logging.info(f'Using at most {limit} concurrent connections for {host}')
+                host_semaphores[host] = asyncio.Semaphore(limit)
+        # More threads than the sum of the host limits would never be used.
+        num_threads = min(self.max_concurrency, sum(self.get_host_limit(host) for host in host_semaphores))
+        logging.info(f'Using {num_threads} threads')
+        with ThreadPoolExecutor(max(num_threads, 1)) as executor:
+            async def run_blocking(fetcher: BaseFetcher, func, *args):
+                host_semaphore = host_semaphores[urlparse(fetcher.url).hostname]
+                # Acquire the host slot first, so that tasks waiting for a busy host do not
+                # hold global slots.
+                async with host_semaphore, global_semaphore:
+                    return await loop.run_in_executor(executor, func, *args)
+
+            tasks = [self.fetch(fetcher, run_blocking) for fetcher in fetchers]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        download_stats = list()
+        for fetcher, result in zip(fetchers, results):
+            if isinstance(result, Exception):
+                logging.error(f'{fetcher.collector} Fetch failed: {result}')
+                continue
+            download_stats += result
+        return download_stats
+
+    async def fetch(self, fetcher: BaseFetcher, run_blocking) -> list:
+        fetcher.session = self.sessions
+        if self.limiter is not None:
+            fetcher.throttle = self.limiter.consume
+        # Release the slots between listing and downloading, so that a slow download
+        # does not keep other collectors from being listed.
+        # A fetcher selects multiple files if it covers a range of timestamps.
+        pending_downloads = await run_blocking(fetcher, fetcher.get_pending_downloads)
+        return await asyncio.gather(*[run_blocking(fetcher, fetcher.timed_download, *pending_download)
+                                      for pending_download in pending_downloads])
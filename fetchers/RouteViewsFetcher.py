@@ -7,9 +7,11 @@ from helpers.defines import DEFAULT_DATA_FOLDER, ROUTE_VIEWS_RIB_FORMATS
 
 
 class RouteViewsFetcher(BaseFetcher):
+    source = 'routeviews'
+
     def __init__(self, collector: str, url: str, timestamp: datetime, output_dir: str = DEFAULT_DATA_FOLDER) -> None:
         super().__init__(collector, url, timestamp, output_dir)
-        self.output_dir = os.path.join(output_dir, 'routeviews', collector, timestamp.strftime(self.folder_format))
+        self.output_dir = os.path.join(output_dir, self.source, collector, timestamp.strftime(self.folder_format))
 
     def get_file_list(self) -> bool:
         base_index = super().fetch_url(self.url)
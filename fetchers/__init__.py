@@ -1,16 +1,29 @@
 import logging
 import os
+import time
 from abc import ABC, abstractmethod
 from datetime import datetime, timedelta
-from typing import Tuple
+from typing import List, Tuple
 
 import requests
+import urllib3
 from bs4 import BeautifulSoup
 
 from helpers.defines import DEFAULT_DATA_FOLDER, FOLDER_FORMAT
+from helpers.telemetry import add_rates
+
+# Downloads are written to this file first and renamed once complete.
+PARTIAL_FILE_SUFFIX = '.part'
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# (connect, read) timeouts in seconds.
+DOWNLOAD_TIMEOUT = (30, 300)
+MAX_DOWNLOAD_ATTEMPTS = 3
 
 
 class BaseFetcher(ABC):
+    # Name of the source in the index file.
+    source = None
+
     def __init__(self, collector: str, url: str, timestamp: datetime, output_dir: str = DEFAULT_DATA_FOLDER) -> None:
         self.folder_format = FOLDER_FORMAT
         # If no file for the specified time is found, fetch the
@@ -21,16 +34,27 @@ class BaseFetcher(ABC):
         self.collector = collector
         self.url = f'{url}{timestamp.strftime(self.folder_format)}/'
         self.timestamp = timestamp
+        # Timestamps to select files for with select_files. All have to be in the same
+        # month as timestamp, since only the folder of that month is listed.
+        self.timestamps = [timestamp]
         self.output_dir = output_dir
         self.file_list = list()
+        # Optional requests.Session (or object with the same get method) shared between
+        # fetchers to reuse connections.
+        self.session = None
+        # Optional callable that is called with the size of each downloaded chunk and
+        # blocks to enforce a bandwidth limit.
+        self.throttle = None
         logging.debug(f'{collector} {timestamp}')
 
-    def get_closest_file(self) -> Tuple[datetime, str, str]:
+    def get_closest_file(self, timestamp: datetime = None) -> Tuple[datetime, str, str]:
+        if timestamp is None:
+            timestamp = self.timestamp
         closest_file = None
         closest_diff = None
         for file_info in self.file_list:
             file_ts = file_info[0]
-            file_ts_diff = abs(file_ts - self.timestamp)
+            file_ts_diff = abs(file_ts - timestamp)
             if file_ts_diff > self.max_timestamp_difference:
                 continue
             if closest_diff is None or file_ts_diff < closest_diff:
@@ -42,26 +66,197 @@ class BaseFetcher(ABC):
             logging.debug(f'{self.collector} {closest_diff} {closest_file[0]} {closest_file[1]}')
         return closest_file
 
-    def fetch(self) -> None:
+    def fetch(self) -> str:
+        """Download the file closest to the timestamp.
+
+        Returns the path of the local file, which may have been cached already, or None if
+        no valid file was found or the download failed.
+        """
+        selected_file = self.select_file()
+        if selected_file is None:
+            return None
+        url, output_file = selected_file
+        if self.is_cached(output_file):
+            return output_file
+        if not self.download_with_retries(url, output_file):
+            return None
+        return output_file
+
+    def select_file(self) -> Tuple[str, str]:
+        """List the remote files and select the file to download.
+
+        Returns (url, output_file) or None if there is no valid file.
+        """
         if (self.get_file_list()):
-            return
+            return None
         candidate_file = self.get_closest_file()
         if candidate_file is None:
-            return
-        output_file = os.path.join(self.output_dir, candidate_file[1])
+            return None
+        return candidate_file[2], os.path.join(self.output_dir, candidate_file[1])
+
+    def select_files(self) -> List[Tuple[str, str]]:
+        """Like select_file, but for all of self.timestamps. The remote folder is only
+        listed once.
+
+        Returns the distinct (url, output_file) pairs, since neighboring timestamps can
+        map to the same file.
+        """
+        if (self.get_file_list()):
+            return list()
+        selected_files = dict()
+        for timestamp in self.timestamps:
+            candidate_file = self.get_closest_file(timestamp)
+            if candidate_file is None:
+                continue
+            selected_files[os.path.join(self.output_dir, candidate_file[1])] = candidate_file[2]
+        return [(url, output_file) for output_file, url in selected_files.items()]
+
+    def is_cached(self, output_file: str) -> bool:
+        # Only complete downloads are published under the final name, so an existing file
+        # is always valid.
         if os.path.exists(output_file):
             logging.info(f'{self.collector}: File already cached {output_file}')
-            return
-        fetched_file = self.fetch_url(candidate_file[2])
-        if fetched_file is None:
-            return
-        os.makedirs(self.output_dir, exist_ok=True)
-        self.write_to_file(fetched_file, output_file)
+            return True
+        return False
+
+    def get_pending_downloads(self) -> List[Tuple[str, str]]:
+        """Like select_files, but without files that are already cached."""
+        return [selected_file for selected_file in self.select_files() if not self.is_cached(selected_file[1])]
+
+    def download_with_retries(self, url: str, output_file: str, stats: dict = None) -> bool:
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        for attempt in range(1, MAX_DOWNLOAD_ATTEMPTS + 1):
+            if stats is not None:
+                stats['attempts'] = attempt
+            if self.download(url, output_file, stats):
+                return True
+            logging.warning(f'{self.collector} Download attempt {attempt}/{MAX_DOWNLOAD_ATTEMPTS} failed for {url}')
+        return False
+
+    def timed_download(self, url: str, output_file: str) -> dict:
+        """Run download_with_retries and return its telemetry (see helpers.telemetry):
+        duration, downloaded bytes (bytes_written), attempts, and failures (1 if all
+        attempts failed)."""
+        stats = {'file': output_file, 'source': self.source, 'collector': self.collector, 'bytes_written': 0,
+                 'attempts': 0}
+        start = time.monotonic()
+        stats['failures'] = 0 if self.download_with_retries(url, output_file, stats) else 1
+        stats['duration'] = time.monotonic() - start
+        add_rates(stats, stats['duration'])
+        return stats
+
+    def download(self, url: str, output_file: str, stats: dict = None) -> bool:
+        """Stream url to output_file with bounded memory.
+
+        Data is written to a partial file first, which is resumed with an HTTP Range
+        request if it already exists. The partial file is renamed to output_file once its
+        size matches the size announced by the server. Returns True on success. If stats
+        is given, the number of downloaded bytes is added to stats['bytes_written'].
+        """
+        partial_file = output_file + PARTIAL_FILE_SUFFIX
+        offset = 0
+        if os.path.exists(partial_file):
+            offset = os.path.getsize(partial_file)
+        headers = dict()
+        if offset > 0:
+            logging.info(f'{self.collector} Resuming {url} at {offset} bytes')
+            headers['Range'] = f'bytes={offset}-'
+        else:
+            logging.info(f'{self.collector} Fetching {url}')
+        try:
+            with self.http_get(url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT) as r:
+                if r.status_code == 416:
+                    return self.handle_unsatisfiable_range(r, url, partial_file, output_file, offset)
+                r.raise_for_status()
+                expected_size = self.get_expected_size(r, offset)
+                if offset > 0 and r.status_code != 206:
+                    logging.warning(f'{self.collector} Server ignored range request, restarting download of {url}')
+                    offset = 0
+                if r.status_code == 206:
+                    start, _ = self.parse_content_range(r.headers.get('Content-Range', str()))
+                    if start != offset:
+                        # Appending would corrupt the partial file.
+                        logging.warning(f'{self.collector} Server returned range starting at {start} instead of '
+                                        f'{offset}, restarting download of {url}')
+                        if os.path.exists(partial_file):
+                            os.remove(partial_file)
+                        return False
+                with open(partial_file, 'ab' if offset > 0 else 'wb') as f:
+                    # Write the raw bytes, the file size must match Content-Length.
+                    for chunk in r.raw.stream(DOWNLOAD_CHUNK_SIZE, decode_content=False):
+                        f.write(chunk)
+                        if stats is not None:
+                            stats['bytes_written'] += len(chunk)
+                        if self.throttle is not None:
+                            self.throttle(len(chunk))
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            logging.error(f'{self.collector} Failed to fetch data from {url}: {e}')
+            return False
+        size = os.path.getsize(partial_file)
+        if expected_size is not None and size != expected_size:
+            logging.error(f'{self.collector} Incomplete download of {url}: {size} of {expected_size} bytes')
+            return False
+        os.replace(partial_file, output_file)
+        logging.info(f'{self.collector} Wrote {size} bytes to {output_file}')
+        return True
+
+    def handle_unsatisfiable_range(self,
+                                   response: requests.Response,
+                                   url: str,
+                                   partial_file: str,
+                                   output_file: str,
+                                   offset: int) -> bool:
+        """Handle a 416 response to a range request starting at offset.
+
+        If the total size in the Content-Range header (bytes */total) equals the size of
+        the partial file, the previous attempt was complete and the file is published.
+        Otherwise the partial file is not a prefix of the remote file (anymore) and is
+        removed, so that the next attempt starts over.
+        """
+        _, total = self.parse_content_range(response.headers.get('Content-Range', str()))
+        if offset > 0 and total == offset:
+            os.replace(partial_file, output_file)
+            logging.info(f'{self.collector} Partial file of {url} is already complete, wrote {offset} bytes to '
+                         f'{output_file}')
+            return True
+        logging.warning(f'{self.collector} Range not satisfiable, restarting download of {url}')
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        return False
+
+    @staticmethod
+    def parse_content_range(content_range: str) -> Tuple[int, int]:
+        """Parse a Content-Range header (bytes start-end/total or bytes */total).
+
+        Returns (start, total), where each value is None if it is missing or invalid.
+        """
+        unit, _, content_range = content_range.strip().partition(' ')
+        if unit != 'bytes':
+            return None, None
+        byte_range, _, total = content_range.partition('/')
+        start = byte_range.partition('-')[0]
+        return (int(start) if start.isdigit() else None,
+                int(total) if total.isdigit() else None)
+
+    @staticmethod
+    def get_expected_size(response: requests.Response, offset: int) -> int:
+        """Return the total file size announced by the server, or None if unknown."""
+        if response.status_code == 206:
+            return BaseFetcher.parse_content_range(response.headers.get('Content-Range', str()))[1]
+        content_length = response.headers.get('Content-Length')
+        if content_length is None or not content_length.isdigit():
+            return None
+        return int(content_length)
+
+    def http_get(self, url: str, **kwargs) -> requests.Response:
+        if self.session is not None:
+            return self.session.get(url, **kwargs)
+        return requests.get(url, **kwargs)
 
     def fetch_url(self, url: str) -> requests.Response:
         logging.info(f'{self.collector} Fetching {url}')
         try:
-            r = requests.get(url)
+            r = self.http_get(url)
             r.raise_for_status()
         except requests.HTTPError as e:
             logging.error(f'{self.collector} Failed to fetch data from {url}: {e}')
@@ -85,8 +280,3 @@ class BaseFetcher(ABC):
             if 'href' in link.attrs:
                 ret.append(link.attrs['href'])
         return ret
-
-    @staticmethod
-    def write_to_file(response: requests.Response, output_file: str) -> None:
-        with open(output_file, 'wb') as f:
-            f.write(response.content)
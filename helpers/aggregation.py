@@ -0,0 +1,145 @@
+import logging
+from typing import Iterator, List, Tuple
+
+import radix
+
+# Value of prefixes for which peers reported different origins. The other origins are
+# not needed, since these prefixes are removed from the transformed tree anyway.
+CONFLICT = -1
+# Values are origin_code | peer_index << PEER_SHIFT, where the peer is the first one that
+# reported the origin. Origin codes up to 2^32 - 1 are the ASN itself, larger codes refer
+# to interned origin strings that are not plain ASNs.
+PEER_SHIFT = 40
+ORIGIN_MASK = (1 << PEER_SHIFT) - 1
+INTERNED_ORIGIN_BASE = 1 << 32
+ADDRESS_BYTES = {4: 4, 6: 16}
+
+
+class CompactAggregate:
+    """Origins of the prefixes of a RIB, stored as integers.
+
+    This is an alternative to a radix tree with a set of origins and a list of peers per
+    node, which needs several Python objects per prefix. Here, each prefix is a single int
+    key (network << 8 | prefix length) in a dict per address family, and the value is a
+    single int as well (see PEER_SHIFT). Since a prefix is dropped as soon as its peers
+    disagree, only the first origin has to be stored. Peers are stored as indices into
+    the peers list.
+    """
+
+    def __init__(self) -> None:
+        self.prefixes = {4: dict(), 6: dict()}
+        self.peers = list()
+        self.peer_indices = dict()
+        self.interned_origins = list()
+        self.interned_origin_codes = dict()
+
+    def __len__(self) -> int:
+        return len(self.prefixes[4]) + len(self.prefixes[6])
+
+    def get_peer_index(self, peer) -> int:
+        try:
+            return self.peer_indices[peer]
+        except KeyError:
+            idx = len(self.peers)
+            self.peers.append(peer)
+            self.peer_indices[peer] = idx
+            return idx
+
+    def encode_origin(self, origin_asn: str) -> int:
+        # Only canonical ASNs are stored as their value, so that decoding returns the
+        # same string.
+        if origin_asn.isascii() and origin_asn.isdigit() and (origin_asn == '0' or origin_asn[0] != '0'):
+            asn = int(origin_asn)
+            if asn < INTERNED_ORIGIN_BASE:
+                return asn
+        try:
+            return self.interned_origin_codes[origin_asn]
+        except KeyError:
+            code = INTERNED_ORIGIN_BASE + len(self.interned_origins)
+            self.interned_origins.append(origin_asn)
+            self.interned_origin_codes[origin_asn] = code
+            return code
+
+    def decode_origin(self, code: int) -> str:
+        if code < INTERNED_ORIGIN_BASE:
+            return str(code)
+        return self.interned_origins[code - INTERNED_ORIGIN_BASE]
+
+    def add(self, prefix: str, version: int, network: int, prefix_length: int,
+            origins: List[Tuple[object, str]]) -> None:
+        """Add the (peer, origin) pairs reported for a prefix.
+
+        prefix is only used for log messages. Logs the same messages as aggregate_entries,
+        except that a prefix that already has conflicting origins is not checked again.
+        """
+        table = self.prefixes[version]
+        key = network << 8 | prefix_length
+        value = table.get(key)
+        for peer, origin_asn in origins:
+            if value == CONFLICT:
+                return
+            code = self.encode_origin(origin_asn)
+            if value is None:
+                value = code | self.get_peer_index(peer) << PEER_SHIFT
+                table[key] = value
+            elif value & ORIGIN_MASK != code:
+                first_origin = self.decode_origin(value & ORIGIN_MASK)
+                logging.debug(f'{prefix}: {{{first_origin!r}}} += {origin_asn}')
+                if self.peers[value >> PEER_SHIFT] == peer:
+                    logging.error(f'Peer {peer} reported different origins for {prefix}: {{{first_origin!r}}} '
+                                  f'{origin_asn}')
+                value = CONFLICT
+                table[key] = value
+
+    def update(self, other: 'CompactAggregate') -> None:
+        """Add the prefixes of other, which was built from a different part of the same
+        RIB."""
+        for version, other_table in other.prefixes.items():
+            table = self.prefixes[version]
+            for key, other_value in other_table.items():
+                if other_value != CONFLICT:
+                    # Peer indices and interned origins are specific to each aggregate.
+                    code = self.encode_origin(other.decode_origin(other_value & ORIGIN_MASK))
+                    other_value = code | self.get_peer_index(other.peers[other_value >> PEER_SHIFT]) << PEER_SHIFT
+                value = table.get(key)
+                if value is None:
+                    table[key] = other_value
+                elif value != CONFLICT and (other_value == CONFLICT
+                                            or value & ORIGIN_MASK != other_value & ORIGIN_MASK):
+                    table[key] = CONFLICT
+
+    def iter_prefixes(self) -> Iterator[Tuple[int, int, int, int]]:
+        """Yield (version, network, prefix length, value) of all prefixes."""
+        for version, table in self.prefixes.items():
+            for key, value in table.items():
+                yield version, key >> 8, key & 0xFF, value
+
+    def count_prefixes(self, stats: dict) -> None:
+        """Add the number of prefixes and of prefixes with conflicting origins to the
+        stats."""
+        for version in (4, 6):
+            table = self.prefixes[version]
+            stats[f'v{version}_pfxs'] += len(table)
+            stats[f'ignored_v{version}_pfxs'] += sum(1 for value in table.values() if value == CONFLICT)
+
+    def to_rows(self) -> Iterator[Tuple[int, int, int, object]]:
+        """Yield the (version, network, prefix length, origin) rows of the prefixes with a
+        single origin, as used by the columnar format. Interned origins are yielded as
+        strings, like in rtree_to_rows."""
+        for version, network, prefix_length, value in self.iter_prefixes():
+            if value == CONFLICT:
+                continue
+            origin = value & ORIGIN_MASK
+            if origin >= INTERNED_ORIGIN_BASE:
+                origin = self.decode_origin(origin)
+            yield version, network, prefix_length, origin
+
+    def to_rtree(self) -> radix.Radix:
+        """Build the radix tree of the prefixes with a single origin."""
+        rtree = radix.Radix()
+        for version, network, prefix_length, value in self.iter_prefixes():
+            if value == CONFLICT:
+                continue
+            node = rtree.add(packed=network.to_bytes(ADDRESS_BYTES[version], 'big'), masklen=prefix_length)
+            node.data['as'] = self.decode_origin(value & ORIGIN_MASK)
+        return rtree
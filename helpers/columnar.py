@@ -0,0 +1,286 @@
+"""Compact columnar on-disk format for transformed and merged radix trees.
+
+Layout:
+    MAGIC (8 bytes) | header length (uint32, little endian) | JSON header | columns
+
+All columns are plain little-endian arrays aligned to 8 bytes. Prefixes are split by
+address family and sorted by (network, prefix length). IPv6 networks are stored as two
+uint64 columns (high and low half). Merged files additionally store a fixed-width
+bitmask per prefix that indexes into the collector table in the header. Intermediate
+files of the merge have the same columns as merged files, but contain one row per origin
+of a prefix, with the collectors that reported this origin. Origins that are not plain
+ASNs (e.g., AS sets or empty origins) do not fit into the origin column and are stored
+with their rows in the header instead.
+
+Files are read via a memory map, so loading does not require reading or decoding the
+entire file.
+"""
+import heapq
+import json
+import mmap
+import os
+import socket
+import sys
+from array import array
+from operator import itemgetter
+from typing import Iterable, Iterator
+
+import radix
+
+from helpers.merged_tree import SEEN_BY_COLLECTORS, SEEN_BY_COLLECTORS_MASK, decode_collector_mask
+
+MAGIC = b'RIBCOL\x00\x01'
+FORMAT_VERSION = 1
+HEADER_LENGTH_BYTES = 4
+ALIGNMENT = 8
+
+KIND_TRANSFORMED = 'transformed'
+KIND_MERGED = 'merged'
+KIND_INTERMEDIATE = 'intermediate'
+# Kinds with a collector table and a collector bitmask per row.
+COLLECTOR_KINDS = (KIND_MERGED, KIND_INTERMEDIATE)
+
+COLUMNS = {
+    4: [('network', 'I'), ('length', 'B'), ('origin', 'I')],
+    6: [('network_hi', 'Q'), ('network_lo', 'Q'), ('length', 'B'), ('origin', 'I')],
+}
+LOW_64_MASK = (1 << 64) - 1
+
+
+def is_columnar_file(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def parse_origin(asn: str) -> int:
+    """Convert an origin string to an integer. Returns None for non-numeric origins."""
+    if not asn.isascii() or not asn.isdigit():
+        return None
+    asn = int(asn)
+    if asn > 0xFFFFFFFF:
+        return None
+    return asn
+
+
+def encode_origin(asn: str):
+    """Return the value of the origin column for asn, or asn itself if it is not a plain
+    ASN and has to be stored in the header."""
+    origin = parse_origin(asn)
+    if origin is None or str(origin) != asn:
+        return asn
+    return origin
+
+
+def format_network(version: int, network: int) -> str:
+    if version == 4:
+        return socket.inet_ntop(socket.AF_INET, network.to_bytes(4, 'big'))
+    return socket.inet_ntop(socket.AF_INET6, network.to_bytes(16, 'big'))
+
+
+def format_prefix(version: int, network: int, prefix_length: int) -> str:
+    return f'{format_network(version, network)}/{prefix_length}'
+
+
+def write_columnar(output_file: str, rows: Iterable[tuple], kind: str = KIND_TRANSFORMED,
+                   collectors: list = None, extra_header: dict = None) -> None:
+    """Write prefix rows to output_file.
+
+    rows contains (version, network, prefix length, origin) tuples for transformed files.
+    Merged and intermediate files (see COLLECTOR_KINDS) have an additional collector
+    bitmask per row, where bit i refers to collectors[i]. Origins are integers, or
+    strings for origins that are not plain ASNs (see encode_origin), whose rows are stored
+    in the header. extra_header is stored in the header as is and must be
+    JSON-serializable.
+    """
+    is_merged = kind in COLLECTOR_KINDS
+    if is_merged and collectors is None:
+        raise ValueError('Merged files require a collector table')
+    seen_width = (len(collectors) + 7) // 8 if is_merged else 0
+    rows_by_family = {4: list(), 6: list()}
+    string_origin_rows = list()
+    for row in rows:
+        if isinstance(row[3], str):
+            string_origin_rows.append(list(row))
+            continue
+        rows_by_family[row[0]].append(row)
+
+    columns = list()
+    for version, family_rows in rows_by_family.items():
+        family_rows.sort(key=lambda r: (r[1], r[2]))
+        data = {name: array(typecode) for name, typecode in COLUMNS[version]}
+        seen = bytearray()
+        for row in family_rows:
+            if version == 4:
+                data['network'].append(row[1])
+            else:
+                data['network_hi'].append(row[1] >> 64)
+                data['network_lo'].append(row[1] & LOW_64_MASK)
+            data['length'].append(row[2])
+            data['origin'].append(row[3])
+            if is_merged:
+                seen += row[4].to_bytes(seen_width, 'little')
+        for name, typecode in COLUMNS[version]:
+            column = data[name]
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append((f'v{version}_{name}', typecode, column.tobytes()))
+        if is_merged:
+            columns.append((f'v{version}_seen', 'B', bytes(seen)))
+
+    header = {'version': FORMAT_VERSION,
+              'kind': kind,
+              'counts': {'4': len(rows_by_family[4]), '6': len(rows_by_family[6])},
+              'collectors': collectors if is_merged else list(),
+              'seen_width': seen_width,
+              'string_origin_rows': string_origin_rows,
+              'columns': dict()}
+    if extra_header:
+        header.update(extra_header)
+    # The header contains the column offsets, which depend on the header length. Column
+    # offsets are relative to the aligned end of the header to break the cycle.
+    offset = 0
+    for name, typecode, column in columns:
+        header['columns'][name] = [offset, len(column), typecode]
+        offset += len(column) + (-len(column) % ALIGNMENT)
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_end = len(MAGIC) + HEADER_LENGTH_BYTES + len(header_bytes)
+    header_bytes += b' ' * (-header_end % ALIGNMENT)
+
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with open(output_file, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(HEADER_LENGTH_BYTES, 'little'))
+        f.write(header_bytes)
+        for _, _, column in columns:
+            f.write(column)
+            f.write(b'\x00' * (-len(column) % ALIGNMENT))
+
+
+class ColumnarRTree:
+    """Memory-mapped read access to a columnar file."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(MAGIC)] != MAGIC:
+            self.mmap.close()
+            raise ValueError(f'Not a columnar file: {path}')
+        header_length_end = len(MAGIC) + HEADER_LENGTH_BYTES
+        header_length = int.from_bytes(self.mmap[len(MAGIC):header_length_end], 'little')
+        data_offset = header_length_end + header_length
+        self.header = json.loads(self.mmap[header_length_end:data_offset].decode('utf-8'))
+        if self.header['version'] != FORMAT_VERSION:
+            self.mmap.close()
+            raise ValueError(f'Unsupported columnar format version {self.header["version"]}: {path}')
+        self.kind = self.header['kind']
+        self.collectors = self.header['collectors']
+        self.seen_width = self.header['seen_width']
+        self.counts = {int(version): count for version, count in self.header['counts'].items()}
+        # Missing in files written before non-numeric origins were kept.
+        self.string_origin_rows = sorted((tuple(row) for row in self.header.get('string_origin_rows', list())),
+                                         key=itemgetter(0, 1, 2))
+        self.columns = dict()
+        buffer = memoryview(self.mmap)
+        for name, (offset, length, typecode) in self.header['columns'].items():
+            start = data_offset + offset
+            if sys.byteorder == 'little':
+                self.columns[name] = buffer[start:start + length].cast(typecode)
+            else:
+                column = array(typecode, buffer[start:start + length])
+                column.byteswap()
+                self.columns[name] = column
+        buffer.release()
+
+    def __enter__(self) -> 'ColumnarRTree':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return sum(self.counts.values()) + len(self.string_origin_rows)
+
+    def close(self) -> None:
+        for column in self.columns.values():
+            if isinstance(column, memoryview):
+                column.release()
+        self.columns = dict()
+        self.mmap.close()
+
+    def networks(self, version: int) -> Iterator[int]:
+        if version == 4:
+            return iter(self.columns['v4_network'])
+        return ((hi << 64) | lo for hi, lo in zip(self.columns['v6_network_hi'], self.columns['v6_network_lo']))
+
+    def seen(self, version: int, index: int) -> int:
+        """Return the collector bitmask of the prefix at index."""
+        start = index * self.seen_width
+        return int.from_bytes(self.columns[f'v{version}_seen'][start:start + self.seen_width], 'little')
+
+    def rows(self) -> Iterator[tuple]:
+        """Yield all prefix rows in canonical order, i.e., IPv4 before IPv6, each sorted
+        by (network, prefix length).
+
+        Rows are (version, network, prefix length, origin), with an additional collector
+        bitmask for merged and intermediate files. The origin is a string for origins that
+        are not plain ASNs.
+        """
+        return heapq.merge(self.column_rows(), self.string_origin_rows, key=itemgetter(0, 1, 2))
+
+    def column_rows(self) -> Iterator[tuple]:
+        for version in (4, 6):
+            rows = zip(self.networks(version),
+                       self.columns[f'v{version}_length'],
+                       self.columns[f'v{version}_origin'])
+            if self.kind in COLLECTOR_KINDS:
+                for index, (network, prefix_length, origin) in enumerate(rows):
+                    yield version, network, prefix_length, origin, self.seen(version, index)
+            else:
+                for network, prefix_length, origin in rows:
+                    yield version, network, prefix_length, origin
+
+    def decode_collectors(self, seen: int) -> tuple:
+        return decode_collector_mask(seen, self.collectors)
+
+
+def rtree_to_rows(rtree, collectors: list = None) -> Iterator[tuple]:
+    """Convert the nodes of a radix tree to prefix rows.
+
+    If collectors is given, the tree is treated as a merged tree and the
+    seen_by_collectors tuple is converted to a bitmask according to the table. Trees with
+    the bitmask encoding already contain the bitmask, so collectors has to be their
+    collector table. Origins are encoded with encode_origin.
+    """
+    collector_bits = None
+    if collectors is not None:
+        collector_bits = {collector: 1 << bit for bit, collector in enumerate(collectors)}
+    for node in rtree.nodes():
+        origin = encode_origin(node.data['as'])
+        version = 4 if node.family == socket.AF_INET else 6
+        row = (version, int.from_bytes(node.packed, 'big'), node.prefixlen, origin)
+        if collector_bits is not None:
+            seen = node.data.get(SEEN_BY_COLLECTORS_MASK)
+            if seen is None:
+                seen = 0
+                for collector in node.data[SEEN_BY_COLLECTORS]:
+                    seen |= collector_bits[collector]
+            row += (seen,)
+        yield row
+
+
+def columnar_to_rtree(columnar: ColumnarRTree, collector_encoding: str = 'names'):
+    """Build a radix tree with the usual node data from a columnar file. The collectors of
+    merged trees are encoded according to collector_encoding (see helpers.merged_tree)."""
+    rtree = radix.Radix()
+    is_merged = columnar.kind == KIND_MERGED
+    for row in columnar.rows():
+        version, network, prefix_length, origin = row[:4]
+        node = rtree.add(packed=network.to_bytes(4 if version == 4 else 16, 'big'), masklen=prefix_length)
+        node.data['as'] = str(origin)
+        if is_merged:
+            if collector_encoding == 'bitmask':
+                node.data[SEEN_BY_COLLECTORS_MASK] = row[4]
+            else:
+                node.data[SEEN_BY_COLLECTORS] = columnar.decode_collectors(row[4])
+    return rtree
@@ -0,0 +1,85 @@
+"""Compression of pickled transformed and merged trees.
+
+Trees are written with one of CODECS at a chosen level, given as a (codec, level)
+tuple. bz2 at level 9 is the default and produces the same files as before. Files are
+named with the suffix of their codec (see get_pickle_suffix), but readers detect the
+codec from the magic bytes at the start of a file, so a renamed file is still read
+correctly.
+"""
+import bz2
+import gzip
+import lzma
+from typing import BinaryIO, Tuple
+
+from helpers.defines import PICKLE_FILE_SUFFIXES
+
+# codec: (magic bytes, minimum level, maximum level, default level)
+CODECS = {
+    'bz2': (b'BZh', 1, 9, 9),
+    'gzip': (b'\x1f\x8b', 0, 9, 6),
+    'lzma': (b'\xfd7zXZ\x00', 0, 9, 6),
+    'none': (b'', None, None, None),
+}
+DEFAULT_COMPRESSION = ('bz2', 9)
+MAGIC_LENGTH = max(len(magic) for magic, _, _, _ in CODECS.values())
+
+
+def get_compression(codec: str, level: int = None) -> Tuple[str, int]:
+    """Return the (codec, level) tuple of codec, using the default level of the codec if
+    level is None. Raises a ValueError if the codec does not support level."""
+    if codec not in CODECS:
+        raise ValueError(f'Unknown compression codec: {codec}')
+    _, min_level, max_level, default_level = CODECS[codec]
+    if level is None:
+        return codec, default_level
+    if min_level is None:
+        raise ValueError(f'Codec {codec} does not support compression levels')
+    if not min_level <= level <= max_level:
+        raise ValueError(f'Compression level of {codec} must be between {min_level} and {max_level}, got: {level}')
+    return codec, level
+
+
+def format_compression(compression: Tuple[str, int]) -> str:
+    codec, level = compression
+    return codec if level is None else f'{codec}:{level}'
+
+
+def get_pickle_suffix(compression: Tuple[str, int] = DEFAULT_COMPRESSION) -> str:
+    """Return the file suffix of a pickled tree with compression, e.g., .pickle.gz."""
+    return PICKLE_FILE_SUFFIXES[compression[0]]
+
+
+def open_compressed(output_file: str, compression: Tuple[str, int] = DEFAULT_COMPRESSION) -> BinaryIO:
+    """Open output_file for writing with compression."""
+    codec, level = compression
+    if codec == 'bz2':
+        return bz2.open(output_file, 'wb', compresslevel=level)
+    if codec == 'gzip':
+        # Do not store the modification time, so that outputs are reproducible.
+        return gzip.GzipFile(output_file, 'wb', compresslevel=level, mtime=0)
+    if codec == 'lzma':
+        return lzma.open(output_file, 'wb', preset=level)
+    return open(output_file, 'wb')
+
+
+def detect_codec(input_file: str) -> str:
+    """Return the codec of input_file based on its magic bytes. Files without a known
+    magic are assumed to be uncompressed."""
+    with open(input_file, 'rb') as f:
+        head = f.read(MAGIC_LENGTH)
+    for codec, (magic, _, _, _) in CODECS.items():
+        if magic and head.startswith(magic):
+            return codec
+    return 'none'
+
+
+def open_decompressed(input_file: str) -> BinaryIO:
+    """Open input_file for reading with the codec detected by detect_codec."""
+    codec = detect_codec(input_file)
+    if codec == 'bz2':
+        return bz2.open(input_file, 'rb')
+    if codec == 'gzip':
+        return gzip.open(input_file, 'rb')
+    if codec == 'lzma':
+        return lzma.open(input_file, 'rb')
+    return open(input_file, 'rb')
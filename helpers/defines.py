@@ -3,13 +3,20 @@ DEFAULT_INDEX_FOLDER = 'indexes/'
 DEFAULT_MERGED_FOLDER = 'merged/'
 DEFAULT_TRANSFORMED_FOLDER = 'transformed/'
 DEFAULT_STATS_FOLDER = 'stats/'
+DEFAULT_HISTORY_FILE = DEFAULT_MERGED_FOLDER + 'history.sqlite'
+DEFAULT_PROFILE_FOLDER = DEFAULT_STATS_FOLDER + 'profiles/'
 
 FOLDER_FORMAT = '%Y.%m'
 
 INDEX_OUTPUT_FILE_FORMAT = '%Y%m%d.index.json'
 STATS_OUTPUT_FILE_FORMAT = '%Y%m%d.{type}-stats.csv'
-EXPECTED_OUTPUT_FILE_SUFFIX = '.pickle.bz2'
-RTREE_OUTPUT_FILE_FORMAT = '%Y%m%d{suffix}.merged' + EXPECTED_OUTPUT_FILE_SUFFIX
+# Suffixes of pickled trees by compression codec (see helpers.compression).
+PICKLE_FILE_SUFFIXES = {'bz2': '.pickle.bz2', 'gzip': '.pickle.gz', 'lzma': '.pickle.xz', 'none': '.pickle'}
+EXPECTED_OUTPUT_FILE_SUFFIX = PICKLE_FILE_SUFFIXES['bz2']
+RTREE_OUTPUT_FILE_FORMAT = '%Y%m%d{suffix}.merged{pickle_suffix}'
+COLUMNAR_OUTPUT_FILE_SUFFIX = '.col'
+COLUMNAR_RTREE_OUTPUT_FILE_FORMAT = '%Y%m%d{suffix}.merged' + COLUMNAR_OUTPUT_FILE_SUFFIX
+INTERMEDIATE_OUTPUT_FILE_FORMAT = '%Y%m%d.merge-intermediate' + COLUMNAR_OUTPUT_FILE_SUFFIX
 
 # Used for argparse help texts, which do not like % characters.
 TIMESTAMP_FORMAT_ESCAPED = 'YYYY-mm-ddTHH:MM'
@@ -20,7 +27,13 @@ ROUTE_VIEWS_RIB_FORMATS = ['rib.%Y%m%d.%H%M.bz2',
 RIS_RIB_FORMATS = ['bview.%Y%m%d.%H%M.gz']
 RIB_FILE_FORMATS = ROUTE_VIEWS_RIB_FORMATS + RIS_RIB_FORMATS
 
-ROUTE_VIEWS_RTREE_FORMATS = ['rib.%Y%m%d.%H%M.pickle.bz2',
-                             'route-views3-full-snapshot-%Y-%m-%d-%H%M.dat.pickle.bz2']
-RIS_RTREE_FORMATS = ['bview.%Y%m%d.%H%M.pickle.bz2']
+ROUTE_VIEWS_RTREE_FORMATS = ([f'rib.%Y%m%d.%H%M{suffix}' for suffix in PICKLE_FILE_SUFFIXES.values()]
+                             + [f'route-views3-full-snapshot-%Y-%m-%d-%H%M.dat{suffix}'
+                                for suffix in PICKLE_FILE_SUFFIXES.values()])
+RIS_RTREE_FORMATS = [f'bview.%Y%m%d.%H%M{suffix}' for suffix in PICKLE_FILE_SUFFIXES.values()]
 RTREE_FILE_FORMATS = ROUTE_VIEWS_RTREE_FORMATS + RIS_RTREE_FORMATS
+
+ROUTE_VIEWS_COLUMNAR_FORMATS = ['rib.%Y%m%d.%H%M.col',
+                                'route-views3-full-snapshot-%Y-%m-%d-%H%M.dat.col']
+RIS_COLUMNAR_FORMATS = ['bview.%Y%m%d.%H%M.col']
+COLUMNAR_FILE_FORMATS = ROUTE_VIEWS_COLUMNAR_FORMATS + RIS_COLUMNAR_FORMATS
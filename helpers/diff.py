@@ -0,0 +1,160 @@
+import csv
+import json
+from collections import Counter
+from socket import AF_INET
+from typing import Iterator, List, Tuple
+
+from helpers.columnar import KIND_MERGED, ColumnarRTree, format_prefix, is_columnar_file
+from helpers.merged_tree import SEEN_BY_COLLECTORS, SEEN_BY_COLLECTORS_MASK, decode_collector_mask, load_merged_tree
+
+ADDED = 'added'
+REMOVED = 'removed'
+ORIGIN_CHANGED = 'origin_changed'
+VISIBILITY_CHANGED = 'visibility_changed'
+CHANGES = (ADDED, REMOVED, ORIGIN_CHANGED, VISIBILITY_CHANGED)
+UNCHANGED = 'unchanged'
+OUTPUT_FORMATS = ('csv', 'jsonl')
+CSV_FIELDS = ['change', 'prefix', 'old_as', 'new_as', 'old_collector_count', 'new_collector_count',
+              'collectors_added', 'collectors_removed']
+
+# Merged rows are (version, network, prefix length, asn, collectors), where collectors is
+# the frozenset of collector names that see the prefix. Rows are iterated in canonical
+# order, i.e., sorted by (version, network, prefix length).
+MergedRow = Tuple[int, int, int, str, frozenset]
+# Diff records are (change, version, network, prefix length, old row, new row), where
+# the row that does not exist for added and removed prefixes is None.
+DiffRecord = Tuple[str, int, int, int, MergedRow, MergedRow]
+
+
+class CollectorSets:
+    """Cache of the collector set for each distinct bitmask or name tuple. Merged trees
+    contain far fewer distinct collector combinations than prefixes, so each one is
+    decoded once and equal sets share the same object."""
+
+    def __init__(self, collectors: List[str] = None) -> None:
+        self.collectors = collectors
+        self.sets = dict()
+
+    def from_mask(self, seen: int) -> frozenset:
+        collector_set = self.sets.get(seen)
+        if collector_set is None:
+            collector_set = frozenset(decode_collector_mask(seen, self.collectors))
+            self.sets[seen] = collector_set
+        return collector_set
+
+    def from_names(self, names: tuple) -> frozenset:
+        collector_set = self.sets.get(names)
+        if collector_set is None:
+            collector_set = frozenset(names)
+            self.sets[names] = collector_set
+        return collector_set
+
+
+def read_columnar_merged_rows(input_file: str) -> Iterator[MergedRow]:
+    with ColumnarRTree(input_file) as columnar:
+        if columnar.kind != KIND_MERGED:
+            raise ValueError(f'Not a merged tree: {input_file}')
+        collector_sets = CollectorSets(columnar.collectors)
+        for version, network, prefix_length, origin, seen in columnar.rows():
+            yield version, network, prefix_length, str(origin), collector_sets.from_mask(seen)
+
+
+def load_pickle_merged_rows(input_file: str) -> List[MergedRow]:
+    """Load a pickled merged tree with either collector encoding and return its rows
+    in canonical order."""
+    rtree, collectors = load_merged_tree(input_file)
+    collector_sets = CollectorSets(collectors)
+    rows = list()
+    for node in rtree.nodes():
+        if SEEN_BY_COLLECTORS_MASK in node.data:
+            collector_set = collector_sets.from_mask(node.data[SEEN_BY_COLLECTORS_MASK])
+        elif SEEN_BY_COLLECTORS in node.data:
+            collector_set = collector_sets.from_names(node.data[SEEN_BY_COLLECTORS])
+        else:
+            raise ValueError(f'Not a merged tree: {input_file}')
+        rows.append((4 if node.family == AF_INET else 6, int.from_bytes(node.packed, 'big'), node.prefixlen,
+                     node.data['as'], collector_set))
+    # Nodes are mostly in canonical order already, which makes sorting cheap.
+    rows.sort(key=lambda r: (r[0], r[1], r[2]))
+    return rows
+
+
+def iter_merged_rows(input_file: str) -> Iterator[MergedRow]:
+    """Yield the rows of a merged tree in either format in canonical order. Columnar
+    files are streamed, pickled trees have to be loaded entirely."""
+    if is_columnar_file(input_file):
+        return read_columnar_merged_rows(input_file)
+    return iter(load_pickle_merged_rows(input_file))
+
+
+def diff_rows(old_rows: Iterator[MergedRow], new_rows: Iterator[MergedRow], stats: Counter) -> Iterator[DiffRecord]:
+    """Compare two row iterators in canonical order with a single linear merge.
+
+    A prefix that exists in both but changed its origin is reported as ORIGIN_CHANGED,
+    even if the set of collectors that see it changed as well. Unchanged prefixes are
+    only counted. stats counts the prefixes for each change and UNCHANGED.
+    """
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    while old is not None and new is not None:
+        old_key = (old[0], old[1], old[2])
+        new_key = (new[0], new[1], new[2])
+        if old_key < new_key:
+            stats[REMOVED] += 1
+            yield REMOVED, old[0], old[1], old[2], old, None
+            old = next(old_rows, None)
+        elif new_key < old_key:
+            stats[ADDED] += 1
+            yield ADDED, new[0], new[1], new[2], None, new
+            new = next(new_rows, None)
+        else:
+            if old[3] != new[3]:
+                stats[ORIGIN_CHANGED] += 1
+                yield ORIGIN_CHANGED, old[0], old[1], old[2], old, new
+            elif old[4] != new[4]:
+                stats[VISIBILITY_CHANGED] += 1
+                yield VISIBILITY_CHANGED, old[0], old[1], old[2], old, new
+            else:
+                stats[UNCHANGED] += 1
+            old = next(old_rows, None)
+            new = next(new_rows, None)
+    while old is not None:
+        stats[REMOVED] += 1
+        yield REMOVED, old[0], old[1], old[2], old, None
+        old = next(old_rows, None)
+    while new is not None:
+        stats[ADDED] += 1
+        yield ADDED, new[0], new[1], new[2], None, new
+        new = next(new_rows, None)
+
+
+def format_record(record: DiffRecord) -> dict:
+    """Convert a diff record to a dict with the keys in CSV_FIELDS. Collector lists are
+    sorted."""
+    change, version, network, prefix_length, old, new = record
+    old_collectors = old[4] if old is not None else frozenset()
+    new_collectors = new[4] if new is not None else frozenset()
+    return {'change': change,
+            'prefix': format_prefix(version, network, prefix_length),
+            'old_as': old[3] if old is not None else None,
+            'new_as': new[3] if new is not None else None,
+            'old_collector_count': len(old_collectors),
+            'new_collector_count': len(new_collectors),
+            'collectors_added': sorted(new_collectors - old_collectors),
+            'collectors_removed': sorted(old_collectors - new_collectors)}
+
+
+def write_diff(records: Iterator[DiffRecord], f, output_format: str) -> None:
+    """Write records to the text file object f as JSON lines or CSV. In CSV, collector
+    lists are separated by spaces and missing origins are empty."""
+    if output_format == 'jsonl':
+        for record in records:
+            f.write(json.dumps(format_record(record)) + '\n')
+        return
+    writer = csv.writer(f)
+    writer.writerow(CSV_FIELDS)
+    for record in records:
+        formatted = format_record(record)
+        formatted['collectors_added'] = ' '.join(formatted['collectors_added'])
+        formatted['collectors_removed'] = ' '.join(formatted['collectors_removed'])
+        writer.writerow([formatted[field] for field in CSV_FIELDS])
@@ -0,0 +1,228 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Tuple
+
+from helpers.defines import COLUMNAR_FILE_FORMATS, INDEX_OUTPUT_FILE_FORMAT, RIB_FILE_FORMATS, RTREE_FILE_FORMATS
+
+CATALOG_VERSION = 1
+# Stored in the root folder of the catalog, e.g., the data or transformed folder.
+CATALOG_FILE = 'file-catalog.sqlite'
+# File names are parsed with all of these formats, so that the same catalog can answer
+# lookups for any subset of them.
+CATALOG_FILE_FORMATS = RIB_FILE_FORMATS + RTREE_FILE_FORMATS + COLUMNAR_FILE_FORMATS + [INDEX_OUTPUT_FILE_FORMAT]
+# Folders modified less than this many nanoseconds before a scan are scanned again on the
+# next lookup, since a file created right after the scan might not change the
+# modification time of the folder, depending on the timestamp resolution of the file
+# system.
+RACY_INTERVAL_NS = 2 * 10**9
+# Seconds to wait for other processes that write to the catalog.
+LOCK_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    folder TEXT PRIMARY KEY,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS files (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    format TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    PRIMARY KEY (folder, name)
+);
+CREATE INDEX IF NOT EXISTS files_by_timestamp ON files (folder, timestamp);
+"""
+
+
+def match_file_format(file_name: str, file_formats: list) -> Tuple[str, datetime]:
+    """Return the first format in file_formats that matches file_name and the parsed
+    timestamp, or None."""
+    for file_format in file_formats:
+        try:
+            return file_format, datetime.strptime(file_name, file_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    return None
+
+
+class FileCatalog:
+    """Persistent catalog of the timestamped files below a root folder.
+
+    Files are indexed by their folder (e.g., source/collector/YYYY.mm relative to the root)
+    and timestamp, so that the file closest to a timestamp is found with an index lookup
+    instead of scanning the folder and parsing every file name. The modification time of
+    each folder is stored as well, and a folder is scanned again if it changed, so files
+    added or removed by other means are still picked up.
+
+    The fetch stage updates the folders it downloaded to, and transformed files are
+    recorded as soon as they are written, which keeps the stored modification time of
+    their folder current. This assumes that the new file is the only change to the folder
+    since the last lookup. Like scans, recording only stores modification times outside of
+    the racy interval (see RACY_INTERVAL_NS), so a folder written to right before is
+    scanned again on the next lookup. Delete the catalog file to force a full rescan.
+
+    If the catalog can not be opened, e.g., because the root folder is read-only, lookups
+    fall back to scanning. The methods are thread-safe.
+    """
+
+    def __init__(self, root_dir: str) -> None:
+        self.root_dir = root_dir
+        self.catalog_file = os.path.join(root_dir, CATALOG_FILE)
+        self.lock = threading.Lock()
+        self.connection = None
+        self.failed = False
+
+    def connect(self) -> bool:
+        if self.connection is not None:
+            return True
+        if self.failed or not os.path.isdir(self.root_dir):
+            return False
+        try:
+            connection = sqlite3.connect(self.catalog_file, timeout=LOCK_TIMEOUT, check_same_thread=False)
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            if version != CATALOG_VERSION:
+                if version != 0:
+                    logging.info(f'Rebuilding file catalog {self.catalog_file} with version {version}')
+                connection.executescript('DROP TABLE IF EXISTS folders; DROP TABLE IF EXISTS files;')
+                connection.executescript(SCHEMA)
+                connection.execute(f'PRAGMA user_version = {CATALOG_VERSION}')
+                connection.commit()
+        except (OSError, sqlite3.Error) as e:
+            logging.warning(f'Failed to open file catalog {self.catalog_file}, scanning folders instead: {e}')
+            self.failed = True
+            return False
+        self.connection = connection
+        return True
+
+    def close(self) -> None:
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def get_folder_key(self, folder: str) -> str:
+        """Return the path of folder relative to the root, or None if it is outside of
+        the root."""
+        relative_folder = os.path.relpath(folder, self.root_dir)
+        if relative_folder == os.pardir or relative_folder.startswith(os.pardir + os.sep):
+            return None
+        return os.path.normpath(relative_folder)
+
+    def covers(self, folder: str, file_formats: list) -> bool:
+        """Check if lookups for file_formats in folder can be answered by the catalog."""
+        if self.get_folder_key(folder) is None:
+            return False
+        if any(file_format not in CATALOG_FILE_FORMATS for file_format in file_formats):
+            return False
+        with self.lock:
+            return self.connect()
+
+    def refresh(self, folder: str, folder_key: str) -> None:
+        """Scan folder if it changed since the last scan. Requires the lock."""
+        try:
+            mtime_ns = os.stat(folder).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        row = self.connection.execute('SELECT mtime_ns FROM folders WHERE folder = ?', (folder_key,)).fetchone()
+        if row is not None and mtime_ns is not None and row[0] == mtime_ns:
+            return
+        files = list()
+        if mtime_ns is not None:
+            for entry in os.scandir(folder):
+                if not entry.is_file():
+                    continue
+                match = match_file_format(entry.name, CATALOG_FILE_FORMATS)
+                if match is None:
+                    logging.debug(f'Not cataloging file without timestamp: {os.path.join(folder, entry.name)}')
+                    continue
+                file_format, file_ts = match
+                files.append((folder_key, entry.name, file_format, int(file_ts.timestamp())))
+        logging.debug(f'Cataloged {len(files)} files in {folder}')
+        with self.connection:
+            self.connection.execute('DELETE FROM files WHERE folder = ?', (folder_key,))
+            self.connection.executemany('INSERT INTO files VALUES (?, ?, ?, ?)', files)
+            self.connection.execute('INSERT OR REPLACE INTO folders VALUES (?, ?)',
+                                    (folder_key, get_stable_mtime(mtime_ns)))
+
+    def update(self, folder: str) -> None:
+        """Scan folder if it changed, so that later lookups do not have to."""
+        folder_key = self.get_folder_key(folder)
+        if folder_key is None:
+            return
+        with self.lock:
+            if self.connect():
+                self.refresh(folder, folder_key)
+
+    def get_closest_file(self,
+                         folder: str,
+                         timestamp: datetime,
+                         max_timestamp_difference: timedelta,
+                         file_formats: list) -> Tuple[str, str]:
+        """Like get_candidate_file, but for a single folder. Returns (file name, file path)
+        of the file in folder that is closest to timestamp, or None."""
+        folder_key = self.get_folder_key(folder)
+        target = int(timestamp.timestamp())
+        max_diff = int(max_timestamp_difference.total_seconds())
+        placeholders = ', '.join('?' * len(file_formats))
+        with self.lock:
+            self.refresh(folder, folder_key)
+            row = self.connection.execute(
+                'SELECT name FROM files '
+                f'WHERE folder = ? AND format IN ({placeholders}) AND timestamp BETWEEN ? AND ? '
+                'ORDER BY abs(timestamp - ?), name LIMIT 1',
+                (folder_key, *file_formats, target - max_diff, target + max_diff, target)).fetchone()
+        if row is None:
+            return None
+        return row[0], os.path.join(folder, row[0])
+
+    def get_latest_file(self, folder: str, file_formats: list) -> Tuple[str, datetime]:
+        """Return (file name, timestamp) of the newest file in folder, or None."""
+        folder_key = self.get_folder_key(folder)
+        placeholders = ', '.join('?' * len(file_formats))
+        with self.lock:
+            self.refresh(folder, folder_key)
+            row = self.connection.execute(
+                f'SELECT name, timestamp FROM files WHERE folder = ? AND format IN ({placeholders}) '
+                'ORDER BY timestamp DESC, name LIMIT 1',
+                (folder_key, *file_formats)).fetchone()
+        if row is None:
+            return None
+        return row[0], datetime.fromtimestamp(row[1], tz=timezone.utc)
+
+    def record(self, file_path: str) -> None:
+        """Add a file that was just written to the catalog."""
+        folder = os.path.dirname(file_path)
+        folder_key = self.get_folder_key(folder)
+        if folder_key is None:
+            return
+        file_name = os.path.basename(file_path)
+        match = match_file_format(file_name, CATALOG_FILE_FORMATS)
+        if match is None:
+            return
+        file_format, file_ts = match
+        with self.lock:
+            if not self.connect():
+                return
+            # The file was just written, so the modification time of the folder is
+            # usually too recent to be trusted, and the folder is scanned again.
+            mtime_ns = get_stable_mtime(os.stat(folder).st_mtime_ns)
+            with self.connection:
+                self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                        (folder_key, file_name, file_format, int(file_ts.timestamp())))
+                # Folders that were never scanned completely stay unknown, since they may
+                # contain other files.
+                self.connection.execute('UPDATE folders SET mtime_ns = ? WHERE folder = ? AND mtime_ns IS NOT NULL',
+                                        (mtime_ns, folder_key))
+
+
+def get_stable_mtime(mtime_ns: int) -> int:
+    """Return mtime_ns, or None if it is too recent to be trusted (see
+    RACY_INTERVAL_NS)."""
+    if mtime_ns is None or time.time_ns() - mtime_ns < RACY_INTERVAL_NS:
+        return None
+    return mtime_ns
+
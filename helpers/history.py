@@ -0,0 +1,254 @@
+"""History of prefix origins across a series of merged snapshots.
+
+The store is an SQLite database with one row per interval in which a prefix was
+announced by the same origin in consecutive snapshots:
+
+    intervals(version, network, length, asn, first_snapshot, last_snapshot)
+
+Snapshots are numbered in the order of their timestamps, and an interval covers all
+snapshots from first_snapshot to last_snapshot (inclusive). A prefix that is missing from
+a snapshot or changes its origin starts a new interval. Networks are stored as big-endian
+bytes, so that the primary key (version, network, length, first_snapshot) orders the
+intervals of a prefix by time and prefixes in canonical order. The open_intervals index
+finds the intervals that are open in a snapshot in the same order.
+
+Only the origin is stored, changes of the collectors that see a prefix are ignored.
+"""
+import ipaddress
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import Iterator, List, Tuple
+
+from helpers.diff import MergedRow
+
+HISTORY_VERSION = 2
+# Seconds to wait for other processes that write to the store.
+LOCK_TIMEOUT = 30
+# Formats of the leading timestamp of merged file names, e.g., 20240101.merged.col or
+# 20240101.1200.min_3.merged.pickle.bz2.
+SNAPSHOT_TIMESTAMP_FORMATS = [('%Y%m%d.%H%M', 2), ('%Y%m%d', 1)]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    timestamp INTEGER NOT NULL UNIQUE,
+    file TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS intervals (
+    version INTEGER NOT NULL,
+    network BLOB NOT NULL,
+    length INTEGER NOT NULL,
+    asn TEXT NOT NULL,
+    first_snapshot INTEGER NOT NULL,
+    last_snapshot INTEGER NOT NULL,
+    PRIMARY KEY (version, network, length, first_snapshot)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS open_intervals ON intervals (last_snapshot, version, network, length);
+CREATE TABLE IF NOT EXISTS prefix_lengths (
+    version INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    PRIMARY KEY (version, length)
+) WITHOUT ROWID;
+"""
+
+# Open intervals are (version, network, length, asn, first_snapshot).
+OpenInterval = Tuple[int, int, int, str, int]
+
+
+def get_snapshot_timestamp(input_file: str) -> datetime:
+    """Return the timestamp at the start of the name of a merged file, or None."""
+    parts = os.path.basename(input_file).split('.')
+    for timestamp_format, part_count in SNAPSHOT_TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime('.'.join(parts[:part_count]), timestamp_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    return None
+
+
+def pack_network(version: int, network: int) -> bytes:
+    return network.to_bytes(4 if version == 4 else 16, 'big')
+
+
+def merge_intervals(open_intervals: Iterator[OpenInterval],
+                    rows: Iterator[MergedRow]) -> Tuple[List[OpenInterval], List[tuple]]:
+    """Compare the open intervals of the latest snapshot with the rows of the next one.
+
+    Both iterators have to be in canonical order. Returns the intervals that end with the
+    latest snapshot and the (version, network, length, asn) of the rows that start a new
+    interval. All other open intervals continue.
+    """
+    ended = list()
+    started = list()
+    interval = next(open_intervals, None)
+    row = next(rows, None)
+    while interval is not None and row is not None:
+        interval_key = (interval[0], interval[1], interval[2])
+        row_key = (row[0], row[1], row[2])
+        if interval_key < row_key:
+            ended.append(interval)
+            interval = next(open_intervals, None)
+        elif row_key < interval_key:
+            started.append(row[:4])
+            row = next(rows, None)
+        else:
+            if interval[3] != row[3]:
+                ended.append(interval)
+                started.append(row[:4])
+            interval = next(open_intervals, None)
+            row = next(rows, None)
+    while interval is not None:
+        ended.append(interval)
+        interval = next(open_intervals, None)
+    while row is not None:
+        started.append(row[:4])
+        row = next(rows, None)
+    return ended, started
+
+
+class HistoryStore:
+    """Prefix-to-origin history of a series of merged snapshots (see module docstring).
+
+    Snapshots can only be appended in chronological order. Appending compares the new
+    snapshot to the intervals that are open in the latest one in a single pass, so the
+    cost depends on the size of a snapshot, not on the length of the history.
+    """
+
+    def __init__(self, store_file: str) -> None:
+        self.store_file = store_file
+        os.makedirs(os.path.dirname(store_file) or '.', exist_ok=True)
+        self.connection = sqlite3.connect(store_file, timeout=LOCK_TIMEOUT)
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version > HISTORY_VERSION:
+            self.connection.close()
+            raise ValueError(f'Unsupported history store version {version}: {store_file}')
+        if version < HISTORY_VERSION:
+            # Version 1 only lacks the open_intervals index, which the schema adds.
+            self.connection.executescript(SCHEMA)
+            self.connection.execute(f'PRAGMA user_version = {HISTORY_VERSION}')
+            self.connection.commit()
+
+    def __enter__(self) -> 'HistoryStore':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def get_latest_snapshot(self) -> Tuple[int, datetime]:
+        """Return (id, timestamp) of the latest snapshot, or None if the store is empty."""
+        row = self.connection.execute('SELECT id, timestamp FROM snapshots ORDER BY id DESC LIMIT 1').fetchone()
+        if row is None:
+            return None
+        return row[0], datetime.fromtimestamp(row[1], tz=timezone.utc)
+
+    def get_snapshot(self, timestamp: datetime) -> int:
+        """Return the id of the latest snapshot at or before timestamp, or None."""
+        row = self.connection.execute('SELECT id FROM snapshots WHERE timestamp <= ? ORDER BY timestamp DESC LIMIT 1',
+                                      (int(timestamp.timestamp()),)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_snapshot_count(self) -> int:
+        return self.connection.execute('SELECT count(*) FROM snapshots').fetchone()[0]
+
+    def contains(self, timestamp: datetime) -> bool:
+        row = self.connection.execute('SELECT 1 FROM snapshots WHERE timestamp = ?',
+                                      (int(timestamp.timestamp()),)).fetchone()
+        return row is not None
+
+    def iter_open_intervals(self, snapshot_id: int) -> Iterator[OpenInterval]:
+        # The open_intervals index is in canonical order, so the scan does not need to sort.
+        cursor = self.connection.execute(
+            'SELECT version, network, length, asn, first_snapshot FROM intervals WHERE last_snapshot = ? '
+            'ORDER BY version, network, length, first_snapshot', (snapshot_id,))
+        for version, network, length, asn, first_snapshot in cursor:
+            yield version, int.from_bytes(network, 'big'), length, asn, first_snapshot
+
+    def append(self, timestamp: datetime, input_file: str, rows: Iterator[MergedRow]) -> dict:
+        """Append a snapshot with rows in canonical order. Raises ValueError if the
+        snapshot is not newer than the latest one. Returns the number of continued, ended,
+        and started intervals."""
+        latest = self.get_latest_snapshot()
+        if latest is not None and timestamp <= latest[1]:
+            raise ValueError(f'Snapshot {timestamp} is not newer than the latest snapshot {latest[1]}')
+        with self.connection:
+            snapshot_id = self.connection.execute('INSERT INTO snapshots (timestamp, file) VALUES (?, ?)',
+                                                  (int(timestamp.timestamp()), input_file)).lastrowid
+            open_intervals = iter(()) if latest is None else self.iter_open_intervals(latest[0])
+            # Read the open intervals completely before modifying the table.
+            ended, started = merge_intervals(iter(list(open_intervals)), rows)
+            continued = 0
+            if latest is not None:
+                continued = self.connection.execute('UPDATE intervals SET last_snapshot = ? WHERE last_snapshot = ?',
+                                                    (snapshot_id, latest[0])).rowcount - len(ended)
+                self.connection.executemany(
+                    'UPDATE intervals SET last_snapshot = ? '
+                    'WHERE version = ? AND network = ? AND length = ? AND first_snapshot = ?',
+                    ((latest[0], version, pack_network(version, network), length, first_snapshot)
+                     for version, network, length, _, first_snapshot in ended))
+            self.connection.executemany(
+                'INSERT INTO intervals VALUES (?, ?, ?, ?, ?, ?)',
+                ((version, pack_network(version, network), length, asn, snapshot_id, snapshot_id)
+                 for version, network, length, asn in started))
+            lengths = {(version, length) for version, _, length, _ in started}
+            self.connection.executemany('INSERT OR IGNORE INTO prefix_lengths VALUES (?, ?)', lengths)
+        return {'continued': continued, 'ended': len(ended), 'started': len(started)}
+
+    def get_prefix_lengths(self, version: int) -> List[int]:
+        """Return the prefix lengths of version in the store, longest first."""
+        rows = self.connection.execute('SELECT length FROM prefix_lengths WHERE version = ? ORDER BY length DESC',
+                                       (version,))
+        return [row[0] for row in rows]
+
+    def get_origin(self, version: int, network: int, length: int, snapshot_id: int) -> str:
+        row = self.connection.execute(
+            'SELECT asn FROM intervals WHERE version = ? AND network = ? AND length = ? '
+            'AND first_snapshot <= ? AND last_snapshot >= ? ORDER BY first_snapshot DESC LIMIT 1',
+            (version, pack_network(version, network), length, snapshot_id, snapshot_id)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def lookup(self, address: str, timestamp: datetime = None) -> Tuple[str, str]:
+        """Longest-prefix match of address in the latest snapshot at or before timestamp
+        (default: the latest snapshot). Returns (prefix, asn), or None if there is no
+        match."""
+        if timestamp is None:
+            latest = self.get_latest_snapshot()
+            snapshot_id = latest[0] if latest is not None else None
+        else:
+            snapshot_id = self.get_snapshot(timestamp)
+        if snapshot_id is None:
+            return None
+        ip = ipaddress.ip_address(address)
+        bits = ip.max_prefixlen
+        for length in self.get_prefix_lengths(ip.version):
+            network = int(ip) & (((1 << length) - 1) << (bits - length))
+            asn = self.get_origin(ip.version, network, length, snapshot_id)
+            if asn is not None:
+                return f'{ipaddress.ip_address(network)}/{length}', asn
+        return None
+
+    def get_history(self, prefix: str) -> List[dict]:
+        """Return the origin intervals of prefix in chronological order. Each interval
+        contains the timestamps of its first and last snapshot and the number of
+        snapshots it spans."""
+        network = ipaddress.ip_network(prefix)
+        rows = self.connection.execute(
+            'SELECT asn, first_snapshot, last_snapshot, first.timestamp, last.timestamp FROM intervals '
+            'JOIN snapshots AS first ON first.id = first_snapshot '
+            'JOIN snapshots AS last ON last.id = last_snapshot '
+            'WHERE version = ? AND network = ? AND length = ? ORDER BY first_snapshot',
+            (network.version, pack_network(network.version, int(network.network_address)), network.prefixlen))
+        history = list()
+        for asn, first_snapshot, last_snapshot, first_ts, last_ts in rows:
+            history.append({'as': asn,
+                            'first_seen': datetime.fromtimestamp(first_ts, tz=timezone.utc),
+                            'last_seen': datetime.fromtimestamp(last_ts, tz=timezone.utc),
+                            'snapshots': last_snapshot - first_snapshot + 1})
+        return history
@@ -0,0 +1,208 @@
+import socket
+from typing import Iterable, Iterator, List, Tuple
+
+import numpy as np
+import radix
+
+from helpers.aggregation import INTERNED_ORIGIN_BASE
+from helpers.columnar import KIND_MERGED, ColumnarRTree, encode_origin, is_columnar_file
+from helpers.merged_tree import get_collector_count, load_merged_tree
+
+ADDRESS_BITS = {4: 32, 6: 128}
+# Value of intervals that are not covered by any prefix.
+NO_MATCH = -1
+
+# Lookup rows are (version, network, prefix length, origin, number of collectors). The
+# origin is an int, or a string for origins that are not plain ASNs (see
+# helpers.columnar.encode_origin).
+LookupRow = Tuple[int, int, int, object, int]
+
+
+def read_merged_rows(input_file: str) -> Iterator[LookupRow]:
+    """Yield lookup rows of a merged tree in canonical order.
+
+    Supports both the pickle and the columnar format.
+    """
+    if is_columnar_file(input_file):
+        with ColumnarRTree(input_file) as merged:
+            if merged.kind != KIND_MERGED:
+                raise ValueError(f'Not a merged tree: {input_file}')
+            for version, network, prefix_length, origin, seen in merged.rows():
+                yield version, network, prefix_length, origin, seen.bit_count()
+        return
+    merged_rtree, _ = load_merged_tree(input_file)
+    yield from merged_rtree_rows(merged_rtree)
+
+
+def merged_rtree_rows(merged_rtree: radix.Radix) -> Iterator[LookupRow]:
+    """Yield lookup rows of an already loaded merged radix tree."""
+    for node in merged_rtree.nodes():
+        origin = encode_origin(node.data['as'])
+        version = 4 if node.family == socket.AF_INET else 6
+        yield version, int.from_bytes(node.packed, 'big'), node.prefixlen, origin, get_collector_count(node)
+
+
+def flatten_prefixes(prefixes: List[Tuple[int, int]], bits: int) -> Tuple[List[int], List[int]]:
+    """Convert nested prefixes into disjoint intervals.
+
+    prefixes is a list of (network, prefix length) tuples in canonical order. Returns the
+    interval start addresses and, for each interval, the index of the most-specific
+    prefix covering it (or NO_MATCH). Adjacent intervals with the same value are joined.
+    """
+    starts = [0]
+    values = [NO_MATCH]
+
+    def emit(start: int, value: int) -> None:
+        if starts[-1] == start:
+            values[-1] = value
+            if len(values) > 1 and values[-2] == value:
+                starts.pop()
+                values.pop()
+        elif values[-1] != value:
+            starts.append(start)
+            values.append(value)
+
+    address_space_end = 1 << bits
+    # (last address, prefix index) of the currently open prefixes.
+    stack = list()
+    for prefix_idx, (network, prefix_length) in enumerate(prefixes):
+        while stack and stack[-1][0] < network:
+            end, _ = stack.pop()
+            emit(end + 1, stack[-1][1] if stack else NO_MATCH)
+        emit(network, prefix_idx)
+        stack.append((network + (1 << (bits - prefix_length)) - 1, prefix_idx))
+    while stack:
+        end, _ = stack.pop()
+        if end + 1 < address_space_end:
+            emit(end + 1, stack[-1][1] if stack else NO_MATCH)
+    return starts, values
+
+
+def ipv4_to_array(addresses: Iterable[str]) -> np.ndarray:
+    """Convert IPv4 address strings to the uint32 array expected by lookup_v4."""
+    return np.array([int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big') for address in addresses],
+                    dtype=np.uint32)
+
+
+def ipv6_to_array(addresses: Iterable[str]) -> np.ndarray:
+    """Convert IPv6 address strings to the array of 16-byte big-endian values expected by
+    lookup_v6."""
+    return np.array([socket.inet_pton(socket.AF_INET6, address) for address in addresses], dtype='S16')
+
+
+class PrefixLookup:
+    """Vectorized longest-prefix match over a merged mapping.
+
+    The prefixes of each address family are flattened into sorted arrays of disjoint
+    intervals, so that a batch of addresses can be matched with a single binary search.
+
+    Origins are returned as integer codes: plain ASNs are stored as their value, and
+    origins that are not plain ASNs (e.g., empty origins) as codes from
+    INTERNED_ORIGIN_BASE on that index into origin_strings, like in
+    helpers.aggregation.CompactAggregate. Use decode_origin to convert a code to the
+    origin string of the merged tree. Every merged prefix is seen by at least one
+    collector, so a collector count of 0 means that there is no match.
+    """
+
+    def __init__(self, rows: Iterable[LookupRow]) -> None:
+        prefixes = {4: list(), 6: list()}
+        asns = {4: list(), 6: list()}
+        counts = {4: list(), 6: list()}
+        self.origin_strings = list()
+        origin_codes = dict()
+        for version, network, prefix_length, asn, count in rows:
+            if isinstance(asn, str):
+                code = origin_codes.get(asn)
+                if code is None:
+                    code = INTERNED_ORIGIN_BASE + len(self.origin_strings)
+                    self.origin_strings.append(asn)
+                    origin_codes[asn] = code
+                asn = code
+            prefixes[version].append((network, prefix_length))
+            asns[version].append(asn)
+            counts[version].append(count)
+        self.starts = dict()
+        self.asns = dict()
+        self.counts = dict()
+        for version in (4, 6):
+            starts, values = flatten_prefixes(prefixes[version], ADDRESS_BITS[version])
+            # Append a sentinel entry for intervals without a match.
+            prefix_asns = np.array(asns[version] + [0], dtype=np.int64)
+            prefix_counts = np.array(counts[version] + [0], dtype=np.uint32)
+            values = np.array(values, dtype=np.int64)
+            if version == 4:
+                self.starts[version] = np.array(starts, dtype=np.uint32)
+            else:
+                self.starts[version] = np.array([start.to_bytes(16, 'big') for start in starts], dtype='S16')
+            self.asns[version] = prefix_asns[values]
+            self.counts[version] = prefix_counts[values]
+
+    @classmethod
+    def from_file(cls, input_file: str) -> 'PrefixLookup':
+        """Build the lookup structure from a pickled or columnar merged file, or load
+        a flattened version created with save()."""
+        if input_file.endswith('.npz'):
+            return cls.load(input_file)
+        return cls(read_merged_rows(input_file))
+
+    def save(self, output_file: str) -> None:
+        """Save the flattened arrays to an .npz file, which loads without flattening."""
+        np.savez(output_file,
+                 origin_strings=np.array(self.origin_strings, dtype=str),
+                 **{f'v{version}_{name}': getattr(self, name)[version]
+                    for version in (4, 6)
+                    for name in ('starts', 'asns', 'counts')})
+
+    @classmethod
+    def load(cls, input_file: str) -> 'PrefixLookup':
+        lookup = cls.__new__(cls)
+        with np.load(input_file) as data:
+            for name in ('starts', 'asns', 'counts'):
+                setattr(lookup, name, {version: data[f'v{version}_{name}'] for version in (4, 6)})
+            # Missing in files saved before non-numeric origins were kept.
+            lookup.origin_strings = data['origin_strings'].tolist() if 'origin_strings' in data.files else list()
+        return lookup
+
+    def decode_origin(self, code: int) -> str:
+        """Return the origin string of an origin code returned by the lookup methods."""
+        if code >= INTERNED_ORIGIN_BASE:
+            return self.origin_strings[code - INTERNED_ORIGIN_BASE]
+        return str(code)
+
+    def lookup_array(self, version: int, addresses: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Match an array of addresses of the same family.
+
+        Returns two arrays with the origin code (see decode_origin) and the number of
+        collectors that see the matched prefix. Both are 0 for addresses without a match,
+        so use the collector count to tell them apart from matches with origin AS0.
+        """
+        starts = self.starts[version]
+        addresses = np.asarray(addresses, dtype=starts.dtype)
+        idx = np.searchsorted(starts, addresses, side='right') - 1
+        return self.asns[version][idx], self.counts[version][idx]
+
+    def lookup_v4(self, addresses: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Match an array of IPv4 addresses given as uint32 values."""
+        return self.lookup_array(4, addresses)
+
+    def lookup_v6(self, addresses: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Match an array of IPv6 addresses given as 16-byte big-endian values (dtype S16)."""
+        return self.lookup_array(6, addresses)
+
+    def lookup(self, addresses: List[str]) -> List[Tuple[int, int]]:
+        """Match a list of address strings of any family.
+
+        Convenience wrapper that returns a list of (origin, number of collectors) tuples in
+        the order of the input, where the origin is the string of the merged tree, with
+        (None, 0) for addresses without a match.
+        """
+        results = [(None, 0)] * len(addresses)
+        for version, to_array in ((4, ipv4_to_array), (6, ipv6_to_array)):
+            positions = [position for position, address in enumerate(addresses) if (':' in address) == (version == 6)]
+            if not positions:
+                continue
+            asns, counts = self.lookup_array(version, to_array(addresses[position] for position in positions))
+            for position, asn, count in zip(positions, asns.tolist(), counts.tolist()):
+                if count > 0:
+                    results[position] = (self.decode_origin(asn), count)
+        return results
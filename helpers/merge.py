@@ -0,0 +1,386 @@
+import heapq
+import logging
+import os
+import pickle
+import tempfile
+from datetime import datetime, timezone
+from itertools import groupby
+from operator import itemgetter
+from socket import AF_INET
+from typing import Iterator, List, Tuple
+
+import radix
+
+from helpers.columnar import KIND_INTERMEDIATE, KIND_MERGED, ColumnarRTree, encode_origin, write_columnar
+from helpers.compression import DEFAULT_COMPRESSION, get_pickle_suffix, open_compressed, open_decompressed
+from helpers.defines import (COLUMNAR_FILE_FORMATS, COLUMNAR_OUTPUT_FILE_SUFFIX, COLUMNAR_RTREE_OUTPUT_FILE_FORMAT,
+                             EXPECTED_OUTPUT_FILE_SUFFIX, PICKLE_FILE_SUFFIXES, RTREE_FILE_FORMATS,
+                             RTREE_OUTPUT_FILE_FORMAT)
+from helpers.merged_tree import (SEEN_BY_COLLECTORS, SEEN_BY_COLLECTORS_MASK, decode_collector_mask,
+                                 dump_merged_tree)
+from helpers.profiling import checkpoint_allocations
+from helpers.shared_functions import atomic_output_file
+
+# Number of rows per pickled chunk in spill files.
+SPILL_CHUNK_SIZE = 1 << 16
+
+# format: (input file formats, output file format, output file suffix). Pickled files have
+# the suffix of their codec instead (see get_output_file_suffix).
+FILE_FORMATS = {
+    'pickle': (RTREE_FILE_FORMATS, RTREE_OUTPUT_FILE_FORMAT, EXPECTED_OUTPUT_FILE_SUFFIX),
+    'columnar': (COLUMNAR_FILE_FORMATS, COLUMNAR_RTREE_OUTPUT_FILE_FORMAT, COLUMNAR_OUTPUT_FILE_SUFFIX),
+}
+# Suffixes of merged files after .merged, and formats of the leading timestamp of their
+# names: (format, number of dot-separated parts).
+MERGED_FILE_SUFFIXES = list(PICKLE_FILE_SUFFIXES.values()) + [COLUMNAR_OUTPUT_FILE_SUFFIX]
+MERGED_TIMESTAMP_FORMATS = [('%Y%m%d.%H%M', 2), ('%Y%m%d', 1)]
+# Rows of the telemetry of a merge in the stats file: (label, telemetry key).
+MERGE_TELEMETRY_ROWS = [
+    ('wall time (s)', 'duration'),
+    ('cpu time (s)', 'cpu_time'),
+    ('input files', 'files'),
+    ('bytes read', 'bytes_read'),
+    ('bytes written', 'bytes_written'),
+    ('prefixes per second', 'prefixes_per_s'),
+    ('peak memory (bytes)', 'peak_memory'),
+]
+
+# Collector rows are (version, network, prefix length, asn) tuples, where asn is the
+# string stored in the 'as' field of the transformed tree. Rows of a collector are
+# always iterated in canonical order, i.e., sorted by (version, network, prefix length).
+CollectorRow = Tuple[int, int, int, str]
+# Rows of all collectors grouped by prefix: (version, network, prefix length, origins),
+# where origins is a list of (asn, collector bitmask).
+GroupedRow = Tuple[int, int, int, List[Tuple[str, int]]]
+
+
+def load_pickle_rows(input_file: str) -> List[CollectorRow]:
+    """Load a pickled transformed tree of any codec and return its rows in canonical
+    order."""
+    with open_decompressed(input_file) as f:
+        collector_rtree: radix.Radix = pickle.load(f)
+    rows = [(4 if node.family == AF_INET else 6, int.from_bytes(node.packed, 'big'), node.prefixlen, node.data['as'])
+            for node in collector_rtree.nodes()]
+    rows.sort()
+    return rows
+
+
+def spill_rows(rows: List[CollectorRow], output_file: str) -> None:
+    """Write rows to a spill file that can be streamed with read_spilled_rows."""
+    with open(output_file, 'wb') as f:
+        for offset in range(0, len(rows), SPILL_CHUNK_SIZE):
+            pickle.dump(rows[offset:offset + SPILL_CHUNK_SIZE], f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_spilled_rows(input_file: str) -> Iterator[CollectorRow]:
+    with open(input_file, 'rb') as f:
+        while True:
+            try:
+                chunk = pickle.load(f)
+            except EOFError:
+                break
+            yield from chunk
+
+
+def read_columnar_rows(input_file: str) -> Iterator[CollectorRow]:
+    with ColumnarRTree(input_file) as collector_rtree:
+        for version, network, prefix_length, origin in collector_rtree.rows():
+            yield version, network, prefix_length, str(origin)
+
+
+def prepare_collector_file(input_file: str, input_format: str, spill_dir: str) -> str:
+    """Make a transformed file streamable in canonical order.
+
+    Columnar files are already sorted and memory-mapped, so they are used directly.
+    Pickled trees are loaded and spilled to a sorted file in spill_dir. Returns the path
+    of the file to pass to iter_collector_rows.
+    """
+    if input_format == 'columnar':
+        return input_file
+    fd, spill_file = tempfile.mkstemp(suffix='.spill', prefix=f'{os.path.basename(input_file)}.', dir=spill_dir)
+    os.close(fd)
+    rows = load_pickle_rows(input_file)
+    checkpoint_allocations()
+    spill_rows(rows, spill_file)
+    return spill_file
+
+
+def iter_collector_rows(prepared_file: str, input_format: str) -> Iterator[CollectorRow]:
+    if input_format == 'columnar':
+        return read_columnar_rows(prepared_file)
+    return read_spilled_rows(prepared_file)
+
+
+def new_merge_stats() -> dict:
+    return {'total_prefixes': 0,
+            'unique_prefixes': 0,
+            'contested_prefixes': 0,
+            'below_threshold_prefixes': 0,
+            'used_prefixes': 0,
+            'collector_count_agg': 0}
+
+
+def tag_rows(rows: Iterator[CollectorRow], collector_idx: int) -> Iterator[tuple]:
+    for version, network, prefix_length, asn in rows:
+        yield version, network, prefix_length, collector_idx, asn
+
+
+def group_collector_rows(collector_rows: List[Iterator[CollectorRow]]) -> Iterator[GroupedRow]:
+    """Merge the rows of all collectors with a k-way merge.
+
+    collector_rows contains one iterator per collector, each in canonical order. Yields
+    (version, network, prefix length, origins) for each prefix in canonical order, where
+    origins contains (asn, collector bitmask) for each distinct origin of the prefix, and
+    bit i of the bitmask refers to the collector at index i.
+    """
+    merged = heapq.merge(*[tag_rows(rows, collector_idx) for collector_idx, rows in enumerate(collector_rows)])
+    for prefix, entries in groupby(merged, key=itemgetter(0, 1, 2)):
+        origins = dict()
+        for entry in entries:
+            asn = entry[4]
+            origins[asn] = origins.get(asn, 0) | 1 << entry[3]
+        yield prefix + (list(origins.items()),)
+
+
+def select_prefixes(grouped_rows: Iterator[GroupedRow],
+                    min_collector_count: int,
+                    stats: dict) -> Iterator[Tuple[int, int, int, str, int]]:
+    """Select the prefixes of the merged tree from the output of group_collector_rows.
+
+    Yields (version, network, prefix length, asn, collector bitmask) for each prefix that
+    all collectors agree on and that is seen by at least min_collector_count collectors.
+    The threshold is checked with the population count of the bitmask. Counters are
+    updated in stats (see new_merge_stats) while iterating.
+    """
+    for version, network, prefix_length, origins in grouped_rows:
+        stats['total_prefixes'] += 1
+        if len(origins) > 1:
+            # Never include contested prefixes.
+            stats['contested_prefixes'] += 1
+            continue
+        stats['unique_prefixes'] += 1
+        asn, seen = origins[0]
+        collector_count = seen.bit_count()
+        if collector_count < min_collector_count:
+            stats['below_threshold_prefixes'] += 1
+            continue
+        stats['used_prefixes'] += 1
+        stats['collector_count_agg'] += collector_count
+        yield version, network, prefix_length, asn, seen
+
+
+def record_grouped_rows(grouped_rows: Iterator[GroupedRow], recorded_rows: list) -> Iterator[GroupedRow]:
+    """Pass grouped_rows through and append them to recorded_rows, which can be saved
+    with write_intermediate once the iterator is exhausted."""
+    for row in grouped_rows:
+        recorded_rows.append(row)
+        yield row
+
+
+def write_intermediate(output_file: str, grouped_rows: List[GroupedRow], collector_names: List[str]) -> None:
+    """Write the output of group_collector_rows to a columnar file, from which merged
+    trees for other thresholds or collector subsets can be built without reading the
+    collector trees again (see read_intermediate).
+
+    Each origin of a prefix is stored as a separate row with its collector bitmask.
+    """
+    rows = list()
+    for version, network, prefix_length, origins in grouped_rows:
+        for asn, seen in origins:
+            rows.append((version, network, prefix_length, encode_origin(asn), seen))
+    with atomic_output_file(output_file) as tmp_output_file:
+        write_columnar(tmp_output_file, rows, KIND_INTERMEDIATE, collector_names)
+
+
+def read_intermediate(input_file: str, collectors: List[str] = None) -> Tuple[List[str], Iterator[GroupedRow]]:
+    """Read a file created by write_intermediate.
+
+    Returns the collector names and an iterator over the grouped rows, as produced by
+    group_collector_rows. If collectors is given, only the specified collectors are
+    included, as if the other collectors were not merged at all. Collectors keep the
+    order of the file.
+    """
+    intermediate = ColumnarRTree(input_file)
+    if intermediate.kind != KIND_INTERMEDIATE:
+        intermediate.close()
+        raise ValueError(f'Not an intermediate merge file: {input_file}')
+    collector_names = intermediate.collectors
+    if collectors is None:
+        selected_idxs = list(range(len(collector_names)))
+    else:
+        unknown_collectors = set(collectors) - set(collector_names)
+        if unknown_collectors:
+            intermediate.close()
+            raise ValueError(f'Collectors not found in {input_file}: {", ".join(sorted(unknown_collectors))}')
+        selected_idxs = [idx for idx, collector in enumerate(collector_names) if collector in collectors]
+    selected_names = [collector_names[idx] for idx in selected_idxs]
+    return selected_names, iter_intermediate_rows(intermediate, selected_idxs)
+
+
+def iter_intermediate_rows(intermediate: ColumnarRTree, selected_idxs: List[int]) -> Iterator[GroupedRow]:
+    """Group the rows of an intermediate file by prefix and reduce the collector
+    bitmasks to the selected collectors, whose bits are renumbered in order."""
+    renumber = selected_idxs != list(range(len(intermediate.collectors)))
+    selected_mask = 0
+    for idx in selected_idxs:
+        selected_mask |= 1 << idx
+    # Bitmasks repeat a lot, so the renumbered masks are cached.
+    renumbered_masks = dict()
+
+    def get_mask(seen: int) -> int:
+        seen &= selected_mask
+        if not renumber or not seen:
+            return seen
+        try:
+            return renumbered_masks[seen]
+        except KeyError:
+            mask = 0
+            for new_idx, idx in enumerate(selected_idxs):
+                if seen >> idx & 1:
+                    mask |= 1 << new_idx
+            renumbered_masks[seen] = mask
+            return mask
+
+    with intermediate:
+        rows = ((version, network, prefix_length, str(origin), seen)
+                for version, network, prefix_length, origin, seen in intermediate.rows())
+        for prefix, entries in groupby(rows, key=itemgetter(0, 1, 2)):
+            origins = list()
+            for entry in entries:
+                seen = get_mask(entry[4])
+                if seen:
+                    origins.append((entry[3], seen))
+            if origins:
+                yield prefix + (origins,)
+
+
+def get_output_file_suffix(output_format: str, compression: Tuple[str, int] = DEFAULT_COMPRESSION) -> str:
+    if output_format == 'pickle':
+        return get_pickle_suffix(compression)
+    return FILE_FORMATS[output_format][2]
+
+
+def get_merged_output_file_name(timestamp: datetime,
+                                output_format: str,
+                                min_collector_ratio: float = None,
+                                min_collector_count: int = None,
+                                compression: Tuple[str, int] = DEFAULT_COMPRESSION) -> str:
+    output_file = timestamp.strftime(FILE_FORMATS[output_format][1])
+    pickle_suffix = get_pickle_suffix(compression)
+    if min_collector_ratio:
+        return output_file.format(suffix=f'.min_ratio_{min_collector_ratio}', pickle_suffix=pickle_suffix)
+    if min_collector_count:
+        return output_file.format(suffix=f'.min_{min_collector_count}', pickle_suffix=pickle_suffix)
+    return output_file.format(suffix='', pickle_suffix=pickle_suffix)
+
+
+def parse_merged_file_name(file_name: str) -> Tuple[datetime, str]:
+    """Parse the name of a merged file as created by get_merged_output_file_name, or with
+    a timestamp with hours and minutes (e.g., 20240101.1200.min_3.merged.col).
+
+    Returns the timestamp and the threshold variant, e.g., min_3 or min_ratio_0.5, which is
+    an empty string for the tree without threshold. Returns None if file_name is not the
+    name of a merged file.
+    """
+    stem, sep, suffix = file_name.rpartition('.merged')
+    if not sep or suffix not in MERGED_FILE_SUFFIXES:
+        return None
+    parts = stem.split('.')
+    for timestamp_format, part_count in MERGED_TIMESTAMP_FORMATS:
+        try:
+            timestamp = datetime.strptime('.'.join(parts[:part_count]), timestamp_format)
+        except ValueError:
+            continue
+        return timestamp.replace(tzinfo=timezone.utc), '.'.join(parts[part_count:])
+    return None
+
+
+def build_merged_output(merged: Iterator[Tuple[int, int, int, str, int]],
+                        collector_names: List[str],
+                        output_format: str,
+                        collector_encoding: str = 'names'):
+    """Consume the output of select_prefixes.
+
+    Returns a radix tree for the pickle format, or a list of merged rows for the
+    columnar format. The collectors of each node of the tree are encoded according to
+    collector_encoding (see helpers.merged_tree).
+    """
+    if output_format == 'columnar':
+        return [(version, network, prefix_length, encode_origin(asn), seen)
+                for version, network, prefix_length, asn, seen in merged]
+    merged_rtree = radix.Radix()
+    for version, network, prefix_length, asn, seen in merged:
+        node = merged_rtree.add(packed=network.to_bytes(4 if version == 4 else 16, 'big'), masklen=prefix_length)
+        node.data['as'] = asn
+        if collector_encoding == 'bitmask':
+            node.data[SEEN_BY_COLLECTORS_MASK] = seen
+        else:
+            node.data[SEEN_BY_COLLECTORS] = decode_collector_mask(seen, collector_names)
+    return merged_rtree
+
+
+def write_merged_output(output_file: str,
+                        merged_output,
+                        collector_names: List[str],
+                        output_format: str,
+                        collector_encoding: str = 'names',
+                        compression: Tuple[str, int] = DEFAULT_COMPRESSION) -> None:
+    # Publish atomically, since other processes may pick up new files as soon as they appear.
+    with atomic_output_file(output_file) as tmp_output_file:
+        if output_format == 'columnar':
+            write_columnar(tmp_output_file, merged_output, KIND_MERGED, collector_names)
+        else:
+            with open_compressed(tmp_output_file, compression) as f:
+                dump_merged_tree(f, merged_output, collector_names if collector_encoding == 'bitmask' else None)
+
+
+def summarize_merge_stats(stats: dict) -> dict:
+    """Add derived values (averages and percentages) to the counters of a merge."""
+    total_prefixes = stats['total_prefixes']
+    used_prefixes = stats['used_prefixes']
+    below_threshold_prefixes = stats['below_threshold_prefixes']
+    contested_prefixes = stats['contested_prefixes']
+    total_ignored_prefixes = contested_prefixes + below_threshold_prefixes
+    summary = dict(stats)
+    summary['avg_collector_count'] = stats['collector_count_agg'] / used_prefixes
+    summary['total_ignored_prefixes'] = total_ignored_prefixes
+    summary['total_ignored_prefixes_pct'] = total_ignored_prefixes / total_prefixes * 100
+    summary['below_threshold_prefixes_total_pct'] = below_threshold_prefixes / total_prefixes * 100
+    summary['below_threshold_prefixes_pct'] = 0
+    summary['contested_prefixes_total_pct'] = contested_prefixes / total_prefixes * 100
+    summary['contested_prefixes_pct'] = 0
+    if total_ignored_prefixes > 0:
+        summary['below_threshold_prefixes_pct'] = below_threshold_prefixes / total_ignored_prefixes * 100
+        summary['contested_prefixes_pct'] = contested_prefixes / total_ignored_prefixes * 100
+    summary['used_prefixes_pct'] = used_prefixes / total_prefixes * 100
+    return summary
+
+
+def print_merge_stats(s: dict) -> None:
+    # autopep8: off
+    logging.info(f'Used {s["used_prefixes"]} prefixes seen by {s["avg_collector_count"]:.2f} collectors on average')
+    logging.info(f'                     Total: {s["total_prefixes"]:9,d} 100.00%')
+    logging.info(f'                   Ignored: {s["total_ignored_prefixes"]:9,d} {s["total_ignored_prefixes_pct"]:6.2f}% 100.00%')
+    logging.info(f'Announced by multiple ASes: {s["contested_prefixes"]:9,d} {s["contested_prefixes_total_pct"]:6.2f}% {s["contested_prefixes_pct"]:6.2f}%')
+    logging.info(f'           Below threshold: {s["below_threshold_prefixes"]:9,d} {s["below_threshold_prefixes_total_pct"]:6.2f}% {s["below_threshold_prefixes_pct"]:6.2f}%')
+    logging.info(f'                      Used: {s["used_prefixes"]:9,d} {s["used_prefixes_pct"]:6.2f}%')
+    # autopep8: on
+
+
+def write_merge_stats(s: dict, output_file: str, telemetry: dict = None) -> None:
+    """Write the summary of a merge to output_file, followed by the telemetry of the merge
+    (see helpers.telemetry) if given."""
+    with open(output_file, 'w') as f:
+        # autopep8: off
+        f.write(f'average collectors per prefix,{s["avg_collector_count"]},,\n')
+        f.write(f'total prefixes,{s["total_prefixes"]},100%,\n')
+        f.write(f'ignored prefixes,{s["total_ignored_prefixes"]},{s["total_ignored_prefixes_pct"]}%, 100%\n')
+        f.write(f'announced by multiple ases,{s["contested_prefixes"]},{s["contested_prefixes_total_pct"]}%,{s["contested_prefixes_pct"]}%\n')
+        f.write(f'below threshold,{s["below_threshold_prefixes"]},{s["below_threshold_prefixes_total_pct"]}%,{s["below_threshold_prefixes_pct"]}%\n')
+        f.write(f'used prefixes,{s["used_prefixes"]},{s["used_prefixes_pct"]}%,\n')
+        # autopep8: on
+        if telemetry is None:
+            return
+        for label, key in MERGE_TELEMETRY_ROWS:
+            if key in telemetry:
+                f.write(f'{label},{telemetry[key]},,\n')
@@ -0,0 +1,82 @@
+"""Access to merged radix trees with either collector encoding.
+
+By default, each node of a merged tree stores the names of the collectors that see the
+prefix:
+
+    {'as': str(asn), 'seen_by_collectors': tuple(str(collector), ...)}
+
+With the bitmask encoding, each node stores an integer instead, where bit i refers to
+the collector at index i of the collector table:
+
+    {'as': str(asn), 'seen_by_collectors_mask': int}
+
+The table is stored once per file. The pickled object is then a dict with the keys
+'collectors' and 'rtree' instead of the radix tree itself. Use load_merged_tree and the
+accessors below to support both encodings.
+"""
+import pickle
+from typing import Iterable, List, Tuple
+
+import radix
+
+from helpers.compression import open_decompressed
+
+COLLECTOR_ENCODINGS = ('bitmask', 'names')
+SEEN_BY_COLLECTORS = 'seen_by_collectors'
+SEEN_BY_COLLECTORS_MASK = 'seen_by_collectors_mask'
+
+
+def decode_collector_mask(seen: int, collectors: List[str]) -> tuple:
+    """Return the names of the collectors whose bits are set in seen."""
+    names = list()
+    while seen:
+        lowest_bit = seen & -seen
+        names.append(collectors[lowest_bit.bit_length() - 1])
+        seen ^= lowest_bit
+    return tuple(names)
+
+
+def encode_collector_mask(names: Iterable[str], collectors: List[str]) -> int:
+    """Return the bitmask of the collectors in names. Can be used to filter nodes by
+    collector, e.g., node.data['seen_by_collectors_mask'] & mask."""
+    collector_bits = {collector: 1 << bit for bit, collector in enumerate(collectors)}
+    seen = 0
+    for name in names:
+        seen |= collector_bits[name]
+    return seen
+
+
+def get_seen_by_collectors(node, collectors: List[str] = None) -> tuple:
+    """Return the names of the collectors that see the prefix of node. collectors is the
+    collector table of the tree, which is required for the bitmask encoding."""
+    if SEEN_BY_COLLECTORS_MASK in node.data:
+        return decode_collector_mask(node.data[SEEN_BY_COLLECTORS_MASK], collectors)
+    return node.data[SEEN_BY_COLLECTORS]
+
+
+def get_collector_count(node) -> int:
+    """Return the number of collectors that see the prefix of node."""
+    if SEEN_BY_COLLECTORS_MASK in node.data:
+        return node.data[SEEN_BY_COLLECTORS_MASK].bit_count()
+    return len(node.data[SEEN_BY_COLLECTORS])
+
+
+def load_merged_tree(input_file: str) -> Tuple[radix.Radix, List[str]]:
+    """Load a pickled merged tree of any codec (see helpers.compression).
+
+    Returns the tree and its collector table, which is None for the names encoding.
+    """
+    with open_decompressed(input_file) as f:
+        merged = pickle.load(f)
+    if isinstance(merged, dict):
+        return merged['rtree'], merged['collectors']
+    return merged, None
+
+
+def dump_merged_tree(f, rtree: radix.Radix, collectors: List[str] = None) -> None:
+    """Pickle a merged tree to the file object f. If collectors is given, the tree uses
+    the bitmask encoding and the collector table is stored with it."""
+    if collectors is None:
+        pickle.dump(rtree, f)
+    else:
+        pickle.dump({'collectors': collectors, 'rtree': rtree}, f)
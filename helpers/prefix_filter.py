@@ -0,0 +1,130 @@
+import ipaddress
+from typing import Dict, Tuple
+
+# Upper bound for the number of cached verdicts. A full table has roughly 1.2M distinct
+# prefixes, so this keeps the cache effective for a single RIB without growing forever.
+DEFAULT_CACHE_SIZE = 1 << 21
+
+# IPv4 shared address space, which IPv4Network.is_global treats as non-global in
+# addition to the private networks.
+SHARED_ADDRESS_SPACE = ipaddress.IPv4Network('100.64.0.0/10')
+
+ADDRESS_BITS = {4: 32, 6: 128}
+
+
+def build_table(networks: list) -> Dict[int, Dict[int, set]]:
+    """Build a lookup table of the form version -> prefix length -> set of network ints."""
+    table = {4: dict(), 6: dict()}
+    for network in networks:
+        table[network.version].setdefault(network.prefixlen, set()).add(int(network.network_address))
+    return table
+
+
+# These are the registries used by ipaddress itself, so the verdicts below are identical
+# to ip_network(prefix).is_global for the running Python version. Newer versions carve
+# out exceptions from the private ranges, older ones do not have the attribute.
+PRIVATE_TABLE = build_table(ipaddress._IPv4Constants._private_networks
+                            + ipaddress._IPv6Constants._private_networks)
+EXCEPTION_TABLE = build_table(getattr(ipaddress._IPv4Constants, '_private_networks_exceptions', list())
+                              + getattr(ipaddress._IPv6Constants, '_private_networks_exceptions', list()))
+SHARED_TABLE = build_table([SHARED_ADDRESS_SPACE])
+
+
+def parse_ipv4_prefix(prefix: str) -> Tuple[int, int, int]:
+    """Fast path for prefixes of the form a.b.c.d/n.
+
+    Returns None if the prefix is not in this form, in which case the caller should fall
+    back to the ipaddress module, which also produces the appropriate error messages.
+    """
+    address, sep, length = prefix.partition('/')
+    if not sep or not length.isascii() or not length.isdigit():
+        return None
+    octets = address.split('.')
+    if len(octets) != 4:
+        return None
+    network = 0
+    for octet in octets:
+        # Same restrictions as ipaddress: ASCII digits only, at most three characters and
+        # no leading zeros.
+        if not octet.isascii() or not octet.isdigit() or len(octet) > 3 or (len(octet) > 1 and octet[0] == '0'):
+            return None
+        value = int(octet)
+        if value > 255:
+            return None
+        network = (network << 8) | value
+    prefix_length = int(length)
+    if prefix_length > 32:
+        return None
+    if network & ((1 << (32 - prefix_length)) - 1):
+        # Host bits set. Let ipaddress raise the ValueError.
+        return None
+    return 4, network, prefix_length
+
+
+def parse_prefix(prefix: str) -> Tuple[int, int, int]:
+    """Parse a prefix string into (version, network int, prefix length).
+
+    Raises ValueError for invalid prefixes, exactly like ipaddress.ip_network.
+    """
+    parsed = parse_ipv4_prefix(prefix)
+    if parsed is not None:
+        return parsed
+    network = ipaddress.ip_network(prefix)
+    return network.version, int(network.network_address), network.prefixlen
+
+
+def network_in_table(table: Dict[int, set], bits: int, network: int, prefix_length: int) -> bool:
+    """Check if the network is fully covered by one of the networks in the table."""
+    for table_length, table_networks in table.items():
+        if table_length > prefix_length:
+            continue
+        if (network >> (bits - table_length)) << (bits - table_length) in table_networks:
+            return True
+    return False
+
+
+def address_in_table(table: Dict[int, set], bits: int, address: int) -> bool:
+    for table_length, table_networks in table.items():
+        if (address >> (bits - table_length)) << (bits - table_length) in table_networks:
+            return True
+    return False
+
+
+def is_global_network(version: int, network: int, prefix_length: int) -> bool:
+    """Equivalent of ip_network(prefix).is_global for an already parsed prefix."""
+    bits = ADDRESS_BITS[version]
+    if version == 4 and network_in_table(SHARED_TABLE[4], bits, network, prefix_length):
+        return False
+    if not network_in_table(PRIVATE_TABLE[version], bits, network, prefix_length):
+        return True
+    # Private unless the network or broadcast address falls into one of the exceptions.
+    broadcast = network | ((1 << (bits - prefix_length)) - 1)
+    exceptions = EXCEPTION_TABLE[version]
+    return address_in_table(exceptions, bits, network) or address_in_table(exceptions, bits, broadcast)
+
+
+class PrefixClassifier:
+    """Classify prefix strings as globally reachable or not.
+
+    Verdicts are cached per distinct prefix string, since each prefix is usually
+    announced by many peers.
+    """
+
+    def __init__(self, cache_size: int = DEFAULT_CACHE_SIZE) -> None:
+        self.cache_size = cache_size
+        self.cache = dict()
+
+    def is_global(self, prefix: str) -> bool:
+        """Return True if the prefix is globally reachable.
+
+        Raises ValueError for invalid prefixes.
+        """
+        try:
+            return self.cache[prefix]
+        except KeyError:
+            pass
+        verdict = is_global_network(*parse_prefix(prefix))
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[prefix] = verdict
+        return verdict
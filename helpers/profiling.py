@@ -0,0 +1,147 @@
+"""Profiling of the jobs of worker processes.
+
+With --profile, each job (e.g., the transform of one RIB) runs under cProfile and its
+stats are written to <profile dir>/<job name>.prof, which can be inspected with pstats or
+tools like snakeviz. With allocation tracing, tracemalloc runs as well, and the
+allocations that are live at the largest checkpoint of the job (see
+checkpoint_allocations) are written to <job name>.allocations. summarize_profiles merges
+the files of all jobs into a summary of the hottest functions and allocation sites.
+
+Tracing allocations slows jobs down considerably, so durations of such runs are not
+comparable to regular runs.
+"""
+import cProfile
+import io
+import linecache
+import logging
+import os
+import pstats
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from glob import glob
+from typing import Iterator
+
+from helpers.defines import DEFAULT_PROFILE_FOLDER
+
+PROFILE_DIR_FORMAT = '%Y%m%d.%H%M%S.{stage}'
+PROFILE_SUFFIX = '.prof'
+ALLOCATIONS_SUFFIX = '.allocations'
+SUMMARY_FILE = 'summary.txt'
+# Number of functions and allocation sites in the summary.
+SUMMARY_TOP_N = 30
+# Allocations of the profiler itself and of imports are not interesting.
+ALLOCATION_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+# (traced size, snapshot) of the largest checkpoint of the running job.
+largest_snapshot = None
+
+
+class Profiler:
+    """Settings of a profiled run, which are passed to the worker processes."""
+
+    def __init__(self, profile_dir: str, trace_allocations: bool = False) -> None:
+        self.profile_dir = profile_dir
+        self.trace_allocations = trace_allocations
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+def get_profile_dir(stage: str) -> str:
+    """Return a new folder for the profiles of a run of stage in the default folder."""
+    return os.path.join(DEFAULT_PROFILE_FOLDER,
+                        datetime.now(tz=timezone.utc).strftime(PROFILE_DIR_FORMAT).format(stage=stage))
+
+
+def get_job_name(path: str, *suffixes) -> str:
+    """Return the name of the job of an input file. Files of different collectors often
+    have the same name, so the folders are part of the job name."""
+    name = os.path.normpath(path).strip(os.sep).replace(os.sep, '_')
+    return '.'.join((name,) + suffixes)
+
+
+def checkpoint_allocations() -> None:
+    """Keep a snapshot of the live allocations of the running job if allocations are
+    traced and more memory is allocated than at previous checkpoints. Called where a job
+    holds most of its data, e.g., once a RIB is aggregated."""
+    global largest_snapshot
+    if not tracemalloc.is_tracing():
+        return
+    size = tracemalloc.get_traced_memory()[0]
+    if largest_snapshot is None or size > largest_snapshot[0]:
+        largest_snapshot = (size, tracemalloc.take_snapshot())
+
+
+@contextmanager
+def profile_job(profiler: Profiler, name: str) -> Iterator[None]:
+    """Profile the block as job name if profiler is not None.
+
+    Jobs must not run concurrently in the same process, since tracemalloc and, depending
+    on the Python version, cProfile can only be active once per process.
+    """
+    global largest_snapshot
+    if profiler is None:
+        yield
+        return
+    output_file = os.path.join(profiler.profile_dir, name)
+    largest_snapshot = None
+    if profiler.trace_allocations:
+        tracemalloc.start()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        if profiler.trace_allocations:
+            checkpoint_allocations()
+            tracemalloc.stop()
+            largest_snapshot[1].filter_traces(ALLOCATION_FILTERS).dump(output_file + ALLOCATIONS_SUFFIX)
+            largest_snapshot = None
+        profile.dump_stats(output_file + PROFILE_SUFFIX)
+
+
+def summarize_allocations(allocation_files: list, top_n: int) -> str:
+    """Return the top_n allocation sites by size, summed over all jobs."""
+    totals = defaultdict(lambda: [0, 0])
+    for allocation_file in allocation_files:
+        for stat in tracemalloc.Snapshot.load(allocation_file).statistics('lineno'):
+            frame = stat.traceback[0]
+            total = totals[(frame.filename, frame.lineno)]
+            total[0] += stat.size
+            total[1] += stat.count
+    lines = [f'Top {top_n} allocation sites by size at the largest checkpoint of {len(allocation_files)} jobs',
+             f'{"MiB":>10} {"blocks":>10}  site']
+    for (filename, lineno), (size, count) in sorted(totals.items(), key=lambda item: item[1][0], reverse=True)[:top_n]:
+        lines.append(f'{size / 1024**2:10.1f} {count:10d}  {filename}:{lineno}')
+        line = linecache.getline(filename, lineno).strip()
+        if line:
+            lines.append(f'{"":23}{line}')
+    return '\n'.join(lines) + '\n'
+
+
+def summarize_profiles(profile_dir: str, top_n: int = SUMMARY_TOP_N) -> str:
+    """Merge the profiles and allocation snapshots of all jobs in profile_dir and write
+    the top_n functions by own and cumulative time and the top_n allocation sites to
+    the summary file. Returns the path of the summary file."""
+    profile_files = sorted(glob(os.path.join(profile_dir, f'*{PROFILE_SUFFIX}')))
+    allocation_files = sorted(glob(os.path.join(profile_dir, f'*{ALLOCATIONS_SUFFIX}')))
+    summary = io.StringIO()
+    if profile_files:
+        stats = pstats.Stats(*profile_files, stream=summary)
+        summary.write(f'Top {top_n} functions of {len(profile_files)} jobs by own time\n')
+        stats.strip_dirs().sort_stats(pstats.SortKey.TIME).print_stats(top_n)
+        summary.write(f'Top {top_n} functions of {len(profile_files)} jobs by cumulative time\n')
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top_n)
+    if allocation_files:
+        summary.write(summarize_allocations(allocation_files, top_n))
+    summary_file = os.path.join(profile_dir, SUMMARY_FILE)
+    with open(summary_file, 'w') as f:
+        f.write(summary.getvalue())
+    logging.info(f'Wrote summary of {len(profile_files)} profiles to {summary_file}')
+    return summary_file
@@ -1,6 +1,8 @@
 import logging
 import os
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from typing import Iterator, List
 
 from helpers.defines import DEFAULT_INDEX_FOLDER, FOLDER_FORMAT, INDEX_OUTPUT_FILE_FORMAT, STATS_OUTPUT_FILE_FORMAT, TIMESTAMP_FORMAT
 
@@ -13,33 +15,67 @@ def parse_timestamp_argument(arg: str) -> datetime:
     return timestamp
 
 
+def parse_file_timestamp(file_name: str, file_formats: list) -> datetime:
+    """Return the timestamp of the first format in file_formats that matches file_name,
+    or None if no format matches."""
+    for file_format in file_formats:
+        try:
+            return datetime.strptime(file_name, file_format).replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+    return None
+
+
+def parse_timestamp_range(start_arg: str, end_arg: str, step_hours: float) -> List[datetime]:
+    """Return the timestamps from start_arg to end_arg (inclusive) in steps of step_hours,
+    or only the start timestamp if end_arg is None. Returns None if the range is
+    invalid."""
+    start = parse_timestamp_argument(start_arg)
+    if start is None:
+        return None
+    if end_arg is None:
+        return [start]
+    end = parse_timestamp_argument(end_arg)
+    if end is None or end < start or step_hours <= 0:
+        return None
+    step = timedelta(hours=step_hours)
+    timestamps = list()
+    timestamp = start
+    while timestamp <= end:
+        timestamps.append(timestamp)
+        timestamp += step
+    return timestamps
+
+
 def get_candidate_file(
         collector_dir: str,
         timestamp: datetime,
         max_timestamp_difference: timedelta,
-        file_formats: list) -> str:
+        file_formats: list,
+        catalog=None) -> str:
     """Find the file closest to the specified timestamp.
 
     Looks for files according to file_formats in collector_dir that are close to
     timestamp. max_timestamp_difference can be used to limit the acceptable deviation
-    from the specified timestamp. Returns None if no valid file is found.
+    from the specified timestamp. If a FileCatalog is given, the folder is only scanned
+    if it changed since the last lookup. Returns None if no valid file is found.
     """
     month_folder = os.path.join(collector_dir, timestamp.strftime(FOLDER_FORMAT))
     if not os.path.exists(month_folder):
         logging.warning(f'Folder does not exist: {month_folder}')
         return None
+    if catalog is not None and catalog.covers(month_folder, file_formats):
+        best_file = catalog.get_closest_file(month_folder, timestamp, max_timestamp_difference, file_formats)
+        if best_file is None:
+            logging.warning(f'No valid file found in folder: {month_folder}')
+        return best_file
     best_diff = None
     best_file = None
     for entry in os.scandir(month_folder):
         if not entry.is_file():
             continue
-        file_ts = None
         file_path = os.path.join(month_folder, entry.name)
-        for format in file_formats:
-            try:
-                file_ts = datetime.strptime(entry.name, format).replace(tzinfo=timezone.utc)
-            except ValueError:
-                continue
+        file_ts = parse_file_timestamp(entry.name, file_formats)
         if file_ts is None:
             logging.error(f'Failed to get timestamp for file: {file_path}')
             continue
@@ -54,17 +90,23 @@ def get_candidate_file(
     return best_file
 
 
-def get_latest_index_file(timestamp: datetime) -> str:
+def get_latest_index_file(timestamp: datetime, catalog=None) -> str:
+    """Return the path of the newest index file in the index folder. If a FileCatalog of
+    the index folder is given, the folder is only scanned if it changed."""
     latest = None
     file_name = str()
-    for entry in os.scandir(DEFAULT_INDEX_FOLDER):
-        try:
-            entry_dt = datetime.strptime(entry.name, INDEX_OUTPUT_FILE_FORMAT).replace(tzinfo=timezone.utc)
-        except ValueError:
-            continue
-        if not latest or entry_dt > latest:
-            latest = entry_dt
-            file_name = entry.name
+    if catalog is not None and catalog.covers(DEFAULT_INDEX_FOLDER, [INDEX_OUTPUT_FILE_FORMAT]):
+        latest_file = catalog.get_latest_file(DEFAULT_INDEX_FOLDER, [INDEX_OUTPUT_FILE_FORMAT])
+        if latest_file is not None:
+            file_name, latest = latest_file
+    else:
+        for entry in os.scandir(DEFAULT_INDEX_FOLDER):
+            entry_dt = parse_file_timestamp(entry.name, [INDEX_OUTPUT_FILE_FORMAT])
+            if entry_dt is None:
+                continue
+            if not latest or entry_dt > latest:
+                latest = entry_dt
+                file_name = entry.name
     if latest is None:
         logging.error('Failed to find valid index file.')
         return str()
@@ -76,3 +118,22 @@ def get_latest_index_file(timestamp: datetime) -> str:
 def get_stat_file_name(timestamp: datetime, stats_dir: str, stat_type: str) -> str:
     output_file_name = timestamp.strftime(STATS_OUTPUT_FILE_FORMAT).format(type=stat_type)
     return os.path.join(stats_dir, output_file_name)
+
+
+@contextmanager
+def atomic_output_file(output_file: str) -> Iterator[str]:
+    """Yield a temporary path that is renamed to output_file if the block succeeds.
+
+    Readers never see a partially written output_file. The temporary file is removed if
+    the block raises.
+    """
+    output_dir = os.path.dirname(output_file)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    tmp_file = f'{output_file}.{os.getpid()}.tmp'
+    try:
+        yield tmp_file
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
@@ -0,0 +1,214 @@
+"""Performance telemetry of the pipeline stages.
+
+Each stage measures its duration, CPU time and peak memory with StageTelemetry and adds
+its own counters, e.g., the bytes it read and wrote or the number of parsed RIB entries. Stages
+that process files (fetch, transform) record the same metrics for each file. The results
+are written to the stats folder and, optionally, as a textfile for the Prometheus node
+exporter, so that scheduled runs can alert on throughput regressions.
+
+All durations are in seconds, sizes in bytes.
+"""
+import logging
+import os
+import resource
+import time
+
+from helpers.shared_functions import atomic_output_file
+
+PROMETHEUS_PREFIX = 'ribexplorer'
+PROMETHEUS_FILE_FORMAT = PROMETHEUS_PREFIX + '_{stage}.prom'
+# Counters for which a rate per second is added to summaries.
+RATE_COUNTERS = ('entries', 'prefixes', 'bytes_written')
+# Per-file counters that are summed into the totals of a stage.
+FILE_COUNTERS = ('bytes_read', 'bytes_written', 'entries', 'prefixes', 'decompress_time', 'parse_time', 'attempts',
+                 'failures')
+# Telemetry fields in the order of the stats files, with their Prometheus metric name and
+# help text.
+METRICS = {
+    'duration': ('duration_seconds', 'Wall time'),
+    'cpu_time': ('cpu_seconds', 'User and system CPU time, including child processes'),
+    'bytes_read': ('read_bytes', 'Bytes read from input files'),
+    'bytes_written': ('written_bytes', 'Bytes written to output files'),
+    'bytes_written_per_s': ('written_bytes_per_second', 'Bytes written per second of wall time'),
+    'entries': ('entries', 'Parsed RIB entries'),
+    'entries_per_s': ('entries_per_second', 'Parsed RIB entries per second of wall time'),
+    'prefixes': ('prefixes', 'Processed prefixes'),
+    'prefixes_per_s': ('prefixes_per_second', 'Processed prefixes per second of wall time'),
+    'decompress_time': ('decompress_seconds', 'Time spent reading and decompressing input files. Only measured by '
+                                              'the mrt reader, bgpkit-parser decompresses in its own process'),
+    'parse_time': ('parse_seconds', 'Time spent parsing and aggregating entries, excluding decompression'),
+    'files': ('files', 'Processed files'),
+    'attempts': ('download_attempts', 'Download attempts'),
+    'failures': ('failures', 'Files that failed to download'),
+    'peak_memory': ('peak_memory_bytes', 'Peak resident set size of the largest process'),
+}
+
+
+def get_cpu_time() -> float:
+    """Return the CPU time of this process and all child processes that were waited for."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + child_usage.ru_utime + child_usage.ru_stime
+
+
+def get_total_peak_memory() -> int:
+    """Return the peak resident set size of this process or the largest child process
+    that was waited for, in bytes."""
+    # ru_maxrss is in KiB on Linux.
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+def get_file_size(path: str) -> int:
+    """Return the size of path, or 0 if it does not exist."""
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def add_rates(stats: dict, duration: float) -> None:
+    """Add the rate per second of each counter in RATE_COUNTERS that is in stats."""
+    for counter in RATE_COUNTERS:
+        if counter in stats:
+            stats[f'{counter}_per_s'] = stats[counter] / duration if duration > 0 else 0
+
+
+class StageTelemetry:
+    """Measure a stage from its creation until summarize is called.
+
+    CPU time and peak memory include child processes once they were waited for, so
+    summarize should be called after worker pools are closed. Jobs of pools that are
+    still running have to be added with add_worker.
+    """
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+        self.start = time.monotonic()
+        self.start_cpu_time = get_cpu_time()
+        self.worker_cpu_time = 0.0
+        self.worker_peak_memory = 0
+        self.counters = dict()
+
+    def add_worker(self, cpu_time: float, peak_memory: int) -> None:
+        """Add the CPU time and peak memory of a job that ran in a worker process which
+        is not waited for before summarize."""
+        self.worker_cpu_time += cpu_time
+        self.worker_peak_memory = max(self.worker_peak_memory, peak_memory)
+
+    def add(self, counter: str, value: float) -> None:
+        if value is None:
+            return
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def add_files(self, file_stats: list) -> None:
+        """Add the counters of per-file stats to the totals of the stage."""
+        self.add('files', len(file_stats))
+        for counter in FILE_COUNTERS:
+            for stat in file_stats:
+                self.add(counter, stat.get(counter))
+
+    def summarize(self) -> dict:
+        duration = time.monotonic() - self.start
+        summary = {'duration': duration,
+                   'cpu_time': get_cpu_time() - self.start_cpu_time + self.worker_cpu_time,
+                   'peak_memory': max(get_total_peak_memory(), self.worker_peak_memory)}
+        summary.update(self.counters)
+        add_rates(summary, duration)
+        return summary
+
+
+def get_total_row(file_stats: list) -> dict:
+    """Return the totals of per-file stats as a row with file 'total'.
+
+    Durations and CPU times are summed, i.e., they are the processing time of all files,
+    not the wall time of a (parallel) stage. The peak memory is the largest of any file.
+    """
+    total = {'file': 'total', 'files': len(file_stats)}
+    for counter in ('duration', 'cpu_time') + FILE_COUNTERS:
+        values = [stat[counter] for stat in file_stats if stat.get(counter) is not None]
+        if values:
+            total[counter] = sum(values)
+    peak_memories = [stat['peak_memory'] for stat in file_stats if stat.get('peak_memory') is not None]
+    if peak_memories:
+        total['peak_memory'] = max(peak_memories)
+    if 'duration' in total:
+        add_rates(total, total['duration'])
+    return total
+
+
+def format_telemetry(summary: dict) -> str:
+    parts = [f'duration:{summary["duration"]:.1f}s', f'cpu:{summary["cpu_time"]:.1f}s']
+    for counter in ('bytes_read', 'bytes_written'):
+        if counter in summary:
+            parts.append(f'{counter}:{summary[counter] / 1024**2:.1f}MiB')
+    for rate in ('entries_per_s', 'prefixes_per_s'):
+        if rate in summary:
+            parts.append(f'{rate}:{summary[rate]:.0f}')
+    parts.append(f'peak_memory:{summary["peak_memory"] / 1024**2:.0f}MiB')
+    return ' '.join(parts)
+
+
+def write_telemetry_stats(rows: list, output_file: str) -> None:
+    """Write per-file rows and a total row (file 'total') to a stats CSV. Only the
+    telemetry fields that occur in any row are included."""
+    logging.info(f'Writing telemetry stats to {output_file}')
+    delimiter = ','
+    headers = ['file'] + [field for field in METRICS if any(field in row for row in rows)]
+    os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+    with open(output_file, 'w') as f:
+        f.write(delimiter.join(headers) + '\n')
+        for row in rows:
+            line_data = [row.get(h, '') for h in headers]
+            f.write(delimiter.join(map(str, line_data)) + '\n')
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def get_collector_rows(file_stats: list) -> list:
+    """Combine per-file stats into one row per source and collector, like get_total_row.
+
+    Returns (source, collector, row) tuples. Stats without source are grouped under an
+    empty source.
+    """
+    groups = dict()
+    for stat in file_stats:
+        groups.setdefault((stat.get('source') or str(), stat['collector']), list()).append(stat)
+    return [(source, collector, get_total_row(stats)) for (source, collector), stats in sorted(groups.items())]
+
+
+def write_prometheus_textfile(textfile_dir: str, stage: str, summary: dict, file_stats: list = None) -> None:
+    """Write the summary of a stage, and optionally its per-file stats, to the textfile
+    collector folder of the node exporter.
+
+    Metrics are gauges named ribexplorer_stage_<metric>{stage="..."} and
+    ribexplorer_collector_<metric>{stage="...",source="...",collector="..."}. Per-file
+    stats need a collector and are combined per collector (see get_collector_rows), so
+    that the series do not change with the file names of each run. The file is replaced
+    atomically, as required by the node exporter.
+    """
+    lines = list()
+    stage_label = f'stage="{escape_label_value(stage)}"'
+    collector_rows = [(f'{stage_label},source="{escape_label_value(source)}",'
+                       f'collector="{escape_label_value(collector)}"', row)
+                      for source, collector, row in get_collector_rows(file_stats or list())]
+    for scope, rows in (('stage', [(stage_label, summary)]), ('collector', collector_rows)):
+        for field, (name, help_text) in METRICS.items():
+            samples = [(labels, row[field]) for labels, row in rows if row.get(field) is not None]
+            if not samples:
+                continue
+            metric = f'{PROMETHEUS_PREFIX}_{scope}_{name}'
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} gauge')
+            lines += [f'{metric}{{{labels}}} {value}' for labels, value in samples]
+    metric = f'{PROMETHEUS_PREFIX}_stage_last_run_timestamp_seconds'
+    lines.append(f'# HELP {metric} Time when the stage finished')
+    lines.append(f'# TYPE {metric} gauge')
+    lines.append(f'{metric}{{{stage_label}}} {time.time()}')
+    output_file = os.path.join(textfile_dir, PROMETHEUS_FILE_FORMAT.format(stage=stage))
+    logging.info(f'Writing Prometheus metrics to {output_file}')
+    with atomic_output_file(output_file) as tmp_output_file:
+        with open(tmp_output_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
@@ -0,0 +1,610 @@
+import json
+import logging
+import os
+import pickle
+import queue
+import resource
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+from functools import partial
+from itertools import groupby
+from multiprocessing.pool import Pool
+from operator import itemgetter
+from socket import AF_INET
+from statistics import median
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import radix
+
+from helpers.aggregation import CompactAggregate
+from helpers.columnar import KIND_TRANSFORMED, rtree_to_rows, write_columnar
+from helpers.compression import DEFAULT_COMPRESSION, get_pickle_suffix, open_compressed
+from helpers.defines import COLUMNAR_OUTPUT_FILE_SUFFIX, EXPECTED_OUTPUT_FILE_SUFFIX, FOLDER_FORMAT
+from helpers.prefix_filter import PrefixClassifier, is_global_network, parse_prefix
+from helpers.profiling import Profiler, checkpoint_allocations, get_job_name, profile_job
+from helpers.shared_functions import atomic_output_file
+from helpers.telemetry import add_rates, format_telemetry, get_cpu_time, get_file_size, get_total_row
+from readers.BGPKitReader import BGPKitReader
+from readers.MRTReader import MRTReader
+
+# Suffixes with the default compression. Pickled files use the suffix of their codec
+# (see get_transform_output_file).
+OUTPUT_FILE_SUFFIX = EXPECTED_OUTPUT_FILE_SUFFIX
+OUTPUT_FILE_SUFFIXES = {
+    'pickle': OUTPUT_FILE_SUFFIX,
+    'columnar': COLUMNAR_OUTPUT_FILE_SUFFIX,
+}
+RIB_READERS = {
+    'bgpkit': BGPKitReader,
+    'mrt': MRTReader,
+}
+# Durations and peak memory of previous transforms, used to schedule the longest jobs
+# first and to limit the number of workers. Stored in the stats folder.
+DURATIONS_FILE = 'transform-durations.json'
+SCHEDULES = ('history', 'size', 'index')
+# Stats of shards that are summed when they are combined. Times can be None if a reader
+# does not measure them.
+SUMMED_STATS = ('entries', 'origin_sets', 'cpu_time', 'decompress_time', 'parse_time')
+STATS_HEADERS = ['file', 'peers', 'entries', 'origin_sets', 'v4_pfxs', 'ignored_v4_pfxs', 'ignored_v4_pfxs_pct',
+                 'final_v4_pfxs', 'v6_pfxs', 'ignored_v6_pfxs', 'ignored_v6_pfxs_pct', 'final_v6_pfxs']
+# Telemetry of timed transforms (see timed_transform_rib), appended to STATS_HEADERS.
+TELEMETRY_HEADERS = ['duration', 'cpu_time', 'bytes_read', 'bytes_written', 'entries_per_s', 'decompress_time',
+                     'parse_time', 'peak_memory']
+
+
+def get_transform_output_file(input_file_name: str,
+                              output_dir: str,
+                              source: str,
+                              collector: str,
+                              timestamp: datetime,
+                              output_format: str,
+                              compression: Tuple[str, int] = DEFAULT_COMPRESSION) -> str:
+    """Return the path of the transformed file for the RIB file input_file_name."""
+    suffix = get_pickle_suffix(compression) if output_format == 'pickle' else OUTPUT_FILE_SUFFIXES[output_format]
+    output_file_name = f'{os.path.splitext(input_file_name)[0]}{suffix}'
+    return os.path.join(output_dir, source, collector, timestamp.strftime(FOLDER_FORMAT), output_file_name)
+
+
+def transform_rib(fixture: Tuple[str, str, str, str, str, tuple]) -> dict:
+    input_file, output_file, reader_name, output_format, aggregation, compression = fixture
+    logging.info(f'Processing {input_file}')
+    aggregate, stats = aggregate_rib(input_file, reader_name, aggregation=aggregation)
+    return FINALIZERS[aggregation](aggregate, stats, output_file, output_format, compression)
+
+
+def new_transform_stats(input_file: str) -> dict:
+    return {'file': input_file,
+            'peers': set(),
+            'entries': 0,
+            'origin_sets': 0,
+            'v4_pfxs': 0,
+            'v6_pfxs': 0,
+            'ignored_v4_pfxs': 0,
+            'ignored_v6_pfxs': 0}
+
+
+def get_run_origins(run: list, stats: dict) -> List[Tuple[object, str]]:
+    """Return the (peer, origin) pairs of a run of entries for the same prefix that need
+    to be aggregated, and count the ignored origin AS sets."""
+    run_origins = set(map(itemgetter(2), run))
+    if len(run_origins) == 1 and ',' not in run[0][2]:
+        # All peers agree, so subsequent entries would not change the aggregate.
+        # There are sometimes singleton sets of the form {ASXXX},
+        # which we should be able to use, just strip the parenthesis.
+        return [(run[0][0], run[0][2].strip('{}'))]
+    # (peer, origin) of the entries without "Origin AS Sets"
+    origins = list()
+    for peer, _, origin_asn in run:
+        if ',' in origin_asn:
+            stats['origin_sets'] += 1
+            continue
+        origins.append((peer, origin_asn.strip('{}')))
+    return origins
+
+
+def aggregate_entries(entries: Iterable[Tuple[object, str, str]], stats: dict) -> radix.Radix:
+    """Build the tree of origin sets from (peer, prefix, origin) entries.
+
+    RIB dumps list the entries of all peers for a prefix consecutively, so entries are
+    processed in runs of the same prefix. The prefix is classified and inserted once per
+    run, and if all peers agree on the origin, only the first entry of the run needs to be
+    checked against the tree. The result is the same as processing each entry on its own.
+    """
+    rtree = radix.Radix()
+    classifier = PrefixClassifier()
+    peers = stats['peers']
+    get_peer = itemgetter(0)
+    for prefix, run in groupby(entries, key=itemgetter(1)):
+        run = list(run)
+        peers.update(map(get_peer, run))
+
+        try:
+            prefix_is_global = classifier.is_global(prefix)
+        except ValueError as e:
+            logging.error(f'Invalid prefix ({prefix}): {e}')
+            continue
+
+        if not prefix_is_global:
+            logging.debug(f'Ignoring non-global prefix: {prefix}')
+            continue
+
+        stats['entries'] += len(run)
+
+        origins = get_run_origins(run, stats)
+        if not origins:
+            continue
+
+        node = rtree.add(prefix)
+        for peer, origin_asn in origins:
+            if 'as' in node.data:
+                if origin_asn not in node.data['as']:
+                    logging.debug(f'{prefix}: {node.data["as"]} += {origin_asn}')
+                    if peer in node.data['peers']:
+                        logging.error(f'Peer {peer} reported different origins for {prefix}: {node.data["as"]} '
+                                      f'{origin_asn}')
+                    node.data['as'].add(origin_asn)
+                    node.data['peers'].append(peer)
+            else:
+                node.data['as'] = {origin_asn}
+                node.data['peers'] = [peer]
+    return rtree
+
+
+def aggregate_entries_compact(entries: Iterable[Tuple[object, str, str]], stats: dict) -> CompactAggregate:
+    """Same as aggregate_entries, but collect the origins in a CompactAggregate.
+
+    The prefix of each run is parsed to integers once, and no radix tree is built until
+    the result is finalized.
+    """
+    aggregate = CompactAggregate()
+    peers = stats['peers']
+    get_peer = itemgetter(0)
+    for prefix, run in groupby(entries, key=itemgetter(1)):
+        run = list(run)
+        peers.update(map(get_peer, run))
+
+        try:
+            version, network, prefix_length = parse_prefix(prefix)
+        except ValueError as e:
+            logging.error(f'Invalid prefix ({prefix}): {e}')
+            continue
+
+        if not is_global_network(version, network, prefix_length):
+            logging.debug(f'Ignoring non-global prefix: {prefix}')
+            continue
+
+        stats['entries'] += len(run)
+
+        origins = get_run_origins(run, stats)
+        if not origins:
+            continue
+
+        aggregate.add(prefix, version, network, prefix_length, origins)
+    return aggregate
+
+
+AGGREGATORS = {
+    'compact': aggregate_entries_compact,
+    'radix': aggregate_entries,
+}
+
+
+def aggregate_rib(input_file: str,
+                  reader_name: str,
+                  shard: int = 0,
+                  num_shards: int = 1,
+                  aggregation: str = 'radix') -> tuple:
+    """Collect the origins of all global prefixes of a RIB.
+
+    With the radix aggregation, returns a radix tree where each node holds the set of
+    origins ('as') and the peers that contributed them ('peers'). With the compact
+    aggregation, returns a CompactAggregate. The second return value are the stats of the
+    read entries. With num_shards > 1, only the prefixes of the specified shard are read
+    (see BaseRIBReader).
+
+    The stats include the time spent decompressing the file (None if the reader does not
+    measure it) and the remaining time spent parsing and aggregating entries.
+    """
+    stats = new_transform_stats(input_file)
+    reader = RIB_READERS[reader_name](input_file, shard, num_shards)
+    start = time.perf_counter()
+    aggregate = AGGREGATORS[aggregation](reader.read(), stats)
+    checkpoint_allocations()
+    stats['decompress_time'] = reader.decompress_time
+    stats['parse_time'] = time.perf_counter() - start - (reader.decompress_time or 0)
+    return aggregate, stats
+
+
+def add_partial_stats(stats: dict, partial_stats: dict) -> None:
+    stats['peers'] |= partial_stats['peers']
+    for key in SUMMED_STATS:
+        if partial_stats.get(key) is None:
+            continue
+        stats[key] = (stats.get(key) or 0) + partial_stats[key]
+
+
+def combine_ribs(partials: List[Tuple[list, dict]]) -> Tuple[radix.Radix, dict]:
+    """Combine the results of aggregate_rib for multiple shards of the same RIB.
+
+    partials contains one (rows, stats) tuple per shard, where rows holds the (prefix,
+    origins, peers) of the nodes of the shard's tree, since lists are faster to pass
+    between processes than radix trees. The origin sets of prefixes that occur in
+    multiple shards are joined, so the result is the same as aggregating the entire RIB
+    at once.
+    """
+    rtree = radix.Radix()
+    stats = None
+    for rows, partial_stats in partials:
+        if stats is None:
+            stats = partial_stats
+        else:
+            add_partial_stats(stats, partial_stats)
+        for prefix, origins, peers in rows:
+            node = rtree.add(prefix)
+            if 'as' in node.data:
+                node.data['as'] |= origins
+                node.data['peers'] += peers
+            else:
+                node.data['as'] = origins
+                node.data['peers'] = peers
+    return rtree, stats
+
+
+def combine_compact(partials: List[Tuple[CompactAggregate, dict]]) -> Tuple[CompactAggregate, dict]:
+    """Combine the results of aggregate_rib for multiple shards of the same RIB with the
+    compact aggregation."""
+    aggregate = None
+    stats = None
+    for partial, partial_stats in partials:
+        if aggregate is None:
+            aggregate = partial
+            stats = partial_stats
+            continue
+        aggregate.update(partial)
+        add_partial_stats(stats, partial_stats)
+    return aggregate, stats
+
+
+def finalize_rib(rtree: radix.Radix,
+                 stats: dict,
+                 output_file: str,
+                 output_format: str,
+                 compression: Tuple[str, int] = DEFAULT_COMPRESSION) -> dict:
+    """Remove prefixes with multiple origins from an aggregated RIB and write it to
+    output_file."""
+    # Do not create an output file for an empty RIB.
+    if not rtree.nodes():
+        logging.warning(f'Did not create empty file: {output_file}')
+        return stats
+
+    # Remove AS sets caused by differing information from peers.
+    for node in rtree.nodes():
+        is_v4 = node.family == AF_INET
+        if is_v4:
+            stats['v4_pfxs'] += 1
+        else:
+            stats['v6_pfxs'] += 1
+        asn_set = node.data['as']
+        if len(asn_set) == 1:
+            node.data['as'] = asn_set.pop()
+            node.data.pop('peers')
+        else:
+            if is_v4:
+                stats['ignored_v4_pfxs'] += 1
+            else:
+                stats['ignored_v6_pfxs'] += 1
+            rtree.delete(node.prefix)
+
+    stats['peers'] = len(stats['peers'])
+
+    if output_format == 'columnar':
+        write_rows(rtree_to_rows(rtree), output_file)
+        return stats
+
+    write_rtree(rtree, output_file, compression)
+    return stats
+
+
+def finalize_compact(aggregate: CompactAggregate,
+                     stats: dict,
+                     output_file: str,
+                     output_format: str,
+                     compression: Tuple[str, int] = DEFAULT_COMPRESSION) -> dict:
+    """Same as finalize_rib for a CompactAggregate. The radix tree is only built from
+    the prefixes with a single origin."""
+    if not aggregate:
+        logging.warning(f'Did not create empty file: {output_file}')
+        return stats
+
+    aggregate.count_prefixes(stats)
+    stats['peers'] = len(stats['peers'])
+
+    if output_format == 'columnar':
+        write_rows(aggregate.to_rows(), output_file)
+        return stats
+
+    write_rtree(aggregate.to_rtree(), output_file, compression)
+    return stats
+
+
+# Output files are written atomically, so that an interrupted transform does not leave
+# a partial file that looks complete.
+def write_rtree(rtree: radix.Radix, output_file: str, compression: Tuple[str, int] = DEFAULT_COMPRESSION) -> None:
+    with atomic_output_file(output_file) as tmp_output_file:
+        with open_compressed(tmp_output_file, compression) as f:
+            pickle.dump(rtree, f)
+
+
+def write_rows(rows: Iterable[tuple], output_file: str) -> None:
+    with atomic_output_file(output_file) as tmp_output_file:
+        write_columnar(tmp_output_file, rows, KIND_TRANSFORMED)
+
+
+FINALIZERS = {
+    'compact': finalize_compact,
+    'radix': finalize_rib,
+}
+COMBINERS = {
+    'compact': combine_compact,
+    'radix': combine_ribs,
+}
+AGGREGATIONS = tuple(sorted(AGGREGATORS))
+
+
+def get_peak_memory() -> int:
+    """Return the peak resident set size of this process in bytes."""
+    # ru_maxrss is in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def add_file_telemetry(stats: dict, fixture: tuple) -> None:
+    """Add the sizes of the input and output file of fixture and the entries parsed
+    per second to the stats of a finished transform."""
+    input_file, output_file = fixture[:2]
+    stats['bytes_read'] = get_file_size(input_file)
+    stats['bytes_written'] = get_file_size(output_file)
+    stats['prefixes'] = stats['v4_pfxs'] + stats['v6_pfxs']
+    add_rates(stats, stats['duration'])
+
+
+def timed_transform_rib(fixture: Tuple[str, str, str, str, str, tuple], profiler: Profiler = None) -> dict:
+    """Run transform_rib and add its duration and CPU time (in s), the peak memory of the
+    worker (in bytes), and other telemetry (see add_file_telemetry) to the stats. The
+    transform is profiled if profiler is given."""
+    start = time.monotonic()
+    start_cpu_time = get_cpu_time()
+    with profile_job(profiler, get_job_name(fixture[0])):
+        stats = transform_rib(fixture)
+    stats['duration'] = time.monotonic() - start
+    stats['cpu_time'] = get_cpu_time() - start_cpu_time
+    stats['peak_memory'] = get_peak_memory()
+    add_file_telemetry(stats, fixture)
+    return stats
+
+
+def aggregate_rib_shard(job: Tuple[tuple, int, int], profiler: Profiler = None) -> tuple:
+    fixture, shard, num_shards = job
+    input_file, _, reader_name, _, aggregation, _ = fixture
+    logging.info(f'Processing {input_file} (shard {shard + 1}/{num_shards})')
+    start = time.monotonic()
+    start_cpu_time = get_cpu_time()
+    with profile_job(profiler, get_job_name(input_file, f'shard{shard + 1}of{num_shards}')):
+        aggregate, stats = aggregate_rib(input_file, reader_name, shard, num_shards, aggregation)
+        if aggregation == 'radix':
+            aggregate = [(node.prefix, node.data['as'], node.data['peers']) for node in aggregate.nodes()]
+    stats['cpu_time'] = get_cpu_time() - start_cpu_time
+    return fixture, (aggregate, stats), time.monotonic() - start, get_peak_memory()
+
+
+def finalize_rib_shards(fixture: tuple,
+                        partials: list,
+                        duration: float,
+                        peak_memory: int,
+                        profiler: Profiler = None) -> dict:
+    input_file, output_file, _, output_format, aggregation, compression = fixture
+    start = time.monotonic()
+    start_cpu_time = get_cpu_time()
+    with profile_job(profiler, get_job_name(input_file, 'finalize')):
+        aggregate, stats = COMBINERS[aggregation](partials)
+        checkpoint_allocations()
+        stats = FINALIZERS[aggregation](aggregate, stats, output_file, output_format, compression)
+    # Total processing time of all shards, which is what the scheduler needs to estimate.
+    stats['duration'] = duration + time.monotonic() - start
+    stats['cpu_time'] += get_cpu_time() - start_cpu_time
+    # Peak memory of the largest job of this file.
+    stats['peak_memory'] = max(peak_memory, get_peak_memory())
+    add_file_telemetry(stats, fixture)
+    return stats
+
+
+def transform_ribs(pool: Pool,
+                   num_workers: int,
+                   fixtures: list,
+                   num_shards: int = 1,
+                   profiler: Profiler = None) -> Iterator[dict]:
+    """Transform fixtures with pool and yield the stats of each file once it is done.
+
+    Files are processed in the order of fixtures. With num_shards > 1, each file is split
+    into num_shards jobs that aggregate a part of the prefixes (see aggregate_rib), so a
+    single large file can use multiple workers. The partial results are combined and
+    written by an additional job, which is started before any remaining shard jobs. If
+    profiler is given, each job is profiled (see helpers.profiling).
+    """
+    if num_shards <= 1:
+        yield from pool.imap_unordered(partial(timed_transform_rib, profiler=profiler), fixtures)
+        return
+    shard_jobs = deque((fixture, shard, num_shards) for fixture in fixtures for shard in range(num_shards))
+    finalize_jobs = deque()
+    partials = defaultdict(list)
+    durations = defaultdict(float)
+    peak_memories = defaultdict(int)
+    done = queue.Queue()
+    in_flight = 0
+    remaining = len(fixtures)
+    while remaining > 0:
+        # Keep exactly one job per worker in the pool, so that finalize jobs do not have
+        # to wait for all queued shard jobs.
+        while in_flight < num_workers and (finalize_jobs or shard_jobs):
+            if finalize_jobs:
+                pool.apply_async(finalize_rib_shards, finalize_jobs.popleft() + (profiler,), callback=done.put,
+                                 error_callback=done.put)
+            else:
+                pool.apply_async(aggregate_rib_shard, (shard_jobs.popleft(), profiler), callback=done.put,
+                                 error_callback=done.put)
+            in_flight += 1
+        result = done.get()
+        in_flight -= 1
+        if isinstance(result, BaseException):
+            raise result
+        if isinstance(result, dict):
+            # Stats of a finalized file.
+            remaining -= 1
+            yield result
+            continue
+        fixture, shard_result, duration, peak_memory = result
+        partials[fixture].append(shard_result)
+        durations[fixture] += duration
+        peak_memories[fixture] = max(peak_memories[fixture], peak_memory)
+        if len(partials[fixture]) == num_shards:
+            finalize_jobs.append((fixture, partials.pop(fixture), durations.pop(fixture),
+                                  peak_memories.pop(fixture)))
+
+
+def load_durations(input_file: str) -> Dict[str, dict]:
+    """Load the durations of previous transforms.
+
+    The file maps collector keys (source/collector) to the size of the last input file,
+    the time it took to transform it, and the peak memory of the worker. Returns an empty dict if the file does not
+    exist or is invalid.
+    """
+    if not os.path.exists(input_file):
+        return dict()
+    try:
+        with open(input_file, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.warning(f'Ignoring invalid durations file {input_file}: {e}')
+        return dict()
+
+
+def save_durations(output_file: str, durations: Dict[str, dict]) -> None:
+    with atomic_output_file(output_file) as tmp_output_file:
+        with open(tmp_output_file, 'w') as f:
+            json.dump(durations, f, indent=2, sort_keys=True)
+
+
+def schedule_fixtures(fixtures: list, keys: List[str], durations: Dict[str, dict], schedule: str) -> list:
+    """Order fixtures so that the longest jobs are started first.
+
+    keys contains the collector key of each fixture. With the history schedule, the
+    expected duration of a job is its duration from a previous run, scaled by the change
+    of the input file size. Jobs without history are estimated from their size, using
+    the median throughput of the jobs with history. Without any history, or with the
+    size schedule, jobs are ordered by input file size. The index schedule keeps the
+    order.
+    """
+    if schedule == 'index':
+        return list(fixtures)
+    sizes = [os.path.getsize(fixture[0]) for fixture in fixtures]
+    history = [durations.get(key) if schedule == 'history' else None for key in keys]
+    rates = [entry['duration'] / entry['size'] for entry in history if entry and entry['size'] > 0]
+    if not rates:
+        expected = sizes
+    else:
+        median_rate = median(rates)
+        expected = list()
+        for size, entry in zip(sizes, history):
+            if entry and entry['size'] > 0:
+                expected.append(entry['duration'] * size / entry['size'])
+            else:
+                expected.append(size * median_rate)
+    order = sorted(range(len(fixtures)), key=lambda idx: expected[idx], reverse=True)
+    return [fixtures[idx] for idx in order]
+
+
+def get_memory_limited_workers(fixtures: list,
+                               keys: List[str],
+                               durations: Dict[str, dict],
+                               num_workers: int,
+                               memory_budget: int,
+                               num_shards: int = 1) -> int:
+    """Return the number of workers whose jobs fit into memory_budget (in bytes).
+
+    The expected peak memory of a job is its peak memory from a previous run, scaled by
+    the change of the input file size, or estimated from its size using the median
+    memory per input byte of the jobs with history. With num_shards > 1, the peak memory
+    is that of the largest shard job of a file, which is expected for each of its shards.
+    Since the largest jobs can run at the same time, the sum of the largest expected peaks
+    has to fit into the budget. Returns num_workers if there is no history, and at least
+    1.
+    """
+    sizes = [os.path.getsize(fixture[0]) for fixture in fixtures]
+    history = [durations.get(key) for key in keys]
+    history = [entry if entry and entry.get('peak_memory') and entry['size'] > 0 else None for entry in history]
+    ratios = [entry['peak_memory'] / entry['size'] for entry in history if entry]
+    if not ratios:
+        logging.warning('No peak memory history available. Not limiting the number of workers.')
+        return num_workers
+    median_ratio = median(ratios)
+    expected = list()
+    for size, entry in zip(sizes, history):
+        if entry:
+            expected += [entry['peak_memory'] * size / entry['size']] * num_shards
+        else:
+            expected += [size * median_ratio] * num_shards
+    expected.sort(reverse=True)
+    workers = 0
+    total = 0
+    while workers < min(num_workers, len(expected)):
+        total += expected[workers]
+        if total > memory_budget:
+            break
+        workers += 1
+    if workers == 0:
+        logging.warning(f'Largest file is expected to need {expected[0] / 1024**2:.0f} MiB, which exceeds the memory '
+                        f'budget')
+    return max(workers, 1)
+
+
+def print_stats(stats: list) -> None:
+    for stat in sorted(stats, key=lambda d: d['file']):
+        v4_pfxs = stat['v4_pfxs']
+        ignored_v4_pfxs = stat['ignored_v4_pfxs']
+        ignored_v4_pfxs_pct = 0
+        if v4_pfxs > 0:
+            ignored_v4_pfxs_pct = ignored_v4_pfxs / v4_pfxs * 100
+        final_v4_pfxs = v4_pfxs - ignored_v4_pfxs
+        stat['ignored_v4_pfxs_pct'] = ignored_v4_pfxs_pct
+        stat['final_v4_pfxs'] = final_v4_pfxs
+        v6_pfxs = stat['v6_pfxs']
+        ignored_v6_pfxs = stat['ignored_v6_pfxs']
+        ignored_v6_pfxs_pct = 0
+        if v6_pfxs > 0:
+            ignored_v6_pfxs_pct = ignored_v6_pfxs / v6_pfxs * 100
+        final_v6_pfxs = v6_pfxs - ignored_v6_pfxs
+        stat['ignored_v6_pfxs_pct'] = ignored_v6_pfxs_pct
+        stat['final_v6_pfxs'] = final_v6_pfxs
+    # autopep8: off
+        logging.info(f'{stat["file"]} | peers:{stat["peers"]} entries:{stat["entries"]} origin_sets:{stat["origin_sets"]} v4_pfxs:{v4_pfxs} v4_ignored:{ignored_v4_pfxs} ({ignored_v4_pfxs_pct:.2f}%) v4_final:{final_v4_pfxs} v6_pfxs:{v6_pfxs} v6_ignored:{ignored_v6_pfxs} ({ignored_v6_pfxs_pct:.2f}%) v6_final:{final_v6_pfxs}')
+    # autopep8: on
+        if 'cpu_time' in stat:
+            logging.info(f'{stat["file"]} | {format_telemetry(stat)}')
+
+
+def write_stats(stats: list, output_file: str) -> None:
+    """Write the stats of print_stats to a CSV, followed by a row with file 'total'. The
+    telemetry columns are empty for files that were not timed (see get_total_row for the
+    totals)."""
+    logging.info(f'Writing transform stats to {output_file}')
+    delimiter = ','
+    headers = STATS_HEADERS + TELEMETRY_HEADERS
+    total = get_total_row(stats)
+    for h in ('origin_sets', 'v4_pfxs', 'ignored_v4_pfxs', 'final_v4_pfxs', 'v6_pfxs', 'ignored_v6_pfxs',
+              'final_v6_pfxs'):
+        total[h] = sum(stat[h] for stat in stats)
+    with open(output_file, 'w') as f:
+        f.write(delimiter.join(headers) + '\n')
+        for stat in sorted(stats, key=lambda d: d['file']) + [total]:
+            line_data = [stat.get(h) for h in headers]
+            f.write(delimiter.join('' if value is None else str(value) for value in line_data) + '\n')
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+from helpers.compression import DEFAULT_COMPRESSION
+from helpers.prefix_filter import EXCEPTION_TABLE, PRIVATE_TABLE, SHARED_TABLE
+from helpers.shared_functions import atomic_output_file
+
+# Increase if a change to the transformation changes its output, which invalidates all
+# cached files.
+TRANSFORM_VERSION = 1
+MANIFEST_VERSION = 1
+# Stored in the folder of the RIB files, so that outputs in all output folders are known.
+MANIFEST_FILE = 'transform-manifest.json'
+HASH_CHUNK_SIZE = 1 << 20
+
+
+def get_filter_fingerprint() -> str:
+    """Return a hash of the special-purpose address tables used to filter prefixes. These
+    are taken from the ipaddress module, so they can change with the Python version."""
+    tables = list()
+    for table in (PRIVATE_TABLE, EXCEPTION_TABLE, SHARED_TABLE):
+        tables.append({version: {length: sorted(networks) for length, networks in lengths.items()}
+                       for version, lengths in table.items()})
+    return hashlib.sha256(json.dumps(tables, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def hash_file(input_file: str) -> str:
+    digest = hashlib.sha256()
+    with open(input_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TransformCache:
+    """Manifest of the transformed files that are valid for a RIB file.
+
+    Each RIB file is mapped to a cache key and the output files that were created from
+    it. The key covers the RIB (its size and modification time, or its content hash with
+    hash_inputs), the transform version, the prefix filter tables, the RIB reader, and the
+    compression of the output. An output file is only valid if it is listed for a RIB with
+    the current key. If the output was created under a different path, e.g., in another
+    output folder, it is linked or copied instead of transforming the RIB again. With
+    hash_inputs, this also works for copies of the same RIB.
+
+    Outputs are only recorded once they are written completely, so files from an
+    interrupted run are redone. Output files that were modified or removed since they
+    were recorded are invalid as well. The methods are thread-safe.
+
+    An existing output of a RIB without any entry is adopted if it is newer than the RIB,
+    so that outputs created before the manifest existed are not transformed again. Outputs
+    are written atomically, so an existing output is complete.
+    """
+
+    def __init__(self, data_dir: str, hash_inputs: bool = False) -> None:
+        self.manifest_file = os.path.join(data_dir, MANIFEST_FILE)
+        self.hash_inputs = hash_inputs
+        self.filter_fingerprint = get_filter_fingerprint()
+        self.lock = threading.Lock()
+        self.files = self.load()
+
+    def load(self) -> dict:
+        if not os.path.exists(self.manifest_file):
+            return dict()
+        try:
+            with open(self.manifest_file, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f'Ignoring invalid transform manifest {self.manifest_file}: {e}')
+            return dict()
+        if manifest.get('version') != MANIFEST_VERSION:
+            logging.warning(f'Ignoring transform manifest {self.manifest_file} with unsupported version '
+                            f'{manifest.get("version")}')
+            return dict()
+        return manifest['files']
+
+    def save(self) -> None:
+        with self.lock:
+            manifest = {'version': MANIFEST_VERSION, 'files': self.files}
+            with atomic_output_file(self.manifest_file) as tmp_manifest_file:
+                with open(tmp_manifest_file, 'w') as f:
+                    json.dump(manifest, f, indent=2, sort_keys=True)
+
+    def get_key(self, input_file: str, reader_name: str, compression: tuple = DEFAULT_COMPRESSION) -> str:
+        if self.hash_inputs:
+            input_id = {'sha256': hash_file(input_file)}
+        else:
+            input_id = get_file_stamp(input_file)
+        key = {'input': input_id,
+               'transform_version': TRANSFORM_VERSION,
+               'filter': self.filter_fingerprint,
+               'reader': reader_name}
+        # Only added for other codecs, so that the keys of existing bz2 outputs stay valid.
+        if compression != DEFAULT_COMPRESSION:
+            key['compression'] = list(compression)
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def lookup(self, input_file: str, output_file: str, key: str) -> bool:
+        """Return True if output_file is a valid transform of input_file.
+
+        If not, but a valid output in the same format exists elsewhere, output_file is
+        created from it and True is returned as well. If input_file has no entry, an
+        existing output_file that is newer than input_file is adopted.
+        """
+        input_file = os.path.normpath(input_file)
+        output_file = os.path.normpath(output_file)
+        with self.lock:
+            entry = self.files.get(input_file)
+            if entry is not None and entry['key'] == key and is_unchanged(output_file, entry['outputs']):
+                return True
+            adopt = entry is None and is_newer(output_file, input_file)
+        if adopt:
+            logging.info(f'Adopting existing {output_file} into the transform manifest')
+            self.record(input_file, output_file, key)
+            return True
+        with self.lock:
+            # Outputs of the same input, or of any input with the same content if the key
+            # is a content hash.
+            candidates = list()
+            for other_input_file, other_entry in self.files.items():
+                if other_entry['key'] != key:
+                    continue
+                if other_input_file != input_file and not self.hash_inputs:
+                    continue
+                candidates += [candidate for candidate in other_entry['outputs']
+                               if is_unchanged(candidate, other_entry['outputs'])]
+        for candidate in candidates:
+            if candidate == output_file:
+                continue
+            if os.path.splitext(candidate)[1] != os.path.splitext(output_file)[1]:
+                continue
+            logging.info(f'Reusing {candidate} for {output_file}')
+            link_or_copy(candidate, output_file)
+            self.record(input_file, output_file, key)
+            return True
+        return False
+
+    def record(self, input_file: str, output_file: str, key: str) -> None:
+        """Record output_file as a valid transform of input_file."""
+        input_file = os.path.normpath(input_file)
+        output_file = os.path.normpath(output_file)
+        with self.lock:
+            entry = self.files.get(input_file)
+            if entry is None or entry['key'] != key:
+                # Outputs of a previous version of the input are no longer valid.
+                entry = {'key': key, 'outputs': dict()}
+                self.files[input_file] = entry
+            entry['outputs'][output_file] = get_file_stamp(output_file)
+
+
+def get_file_stamp(path: str) -> dict:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_unchanged(path: str, stamps: dict) -> bool:
+    """Check if the file at path exists and matches its recorded size and modification
+    time. Modified files are not reused."""
+    if path not in stamps:
+        return False
+    try:
+        return get_file_stamp(path) == stamps[path]
+    except FileNotFoundError:
+        return False
+
+
+def is_newer(path: str, other_path: str) -> bool:
+    """Check if the file at path exists and was modified after the file at other_path."""
+    try:
+        return os.stat(path).st_mtime_ns > os.stat(other_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def link_or_copy(input_file: str, output_file: str) -> None:
+    with atomic_output_file(output_file) as tmp_output_file:
+        try:
+            os.link(input_file, tmp_output_file)
+        except OSError:
+            shutil.copyfile(input_file, tmp_output_file)
@@ -0,0 +1,119 @@
+import argparse
+import json
+import logging
+import sys
+import time
+
+from helpers.defines import DEFAULT_HISTORY_FILE, TIMESTAMP_FORMAT, TIMESTAMP_FORMAT_ESCAPED
+from helpers.diff import iter_merged_rows
+from helpers.history import HistoryStore, get_snapshot_timestamp
+from helpers.shared_functions import parse_timestamp_argument
+
+
+def append_snapshots(store: HistoryStore, input_files: list, timestamp_arg: str) -> None:
+    if timestamp_arg is not None:
+        if len(input_files) != 1:
+            logging.error('--timestamp requires a single input file')
+            return
+        timestamp = parse_timestamp_argument(timestamp_arg)
+        if timestamp is None:
+            logging.error(f'Invalid timestamp specified: {timestamp_arg}')
+            return
+        snapshots = [(timestamp, input_files[0])]
+    else:
+        snapshots = list()
+        for input_file in input_files:
+            timestamp = get_snapshot_timestamp(input_file)
+            if timestamp is None:
+                logging.error(f'Failed to get timestamp from file name, use --timestamp: {input_file}')
+                continue
+            snapshots.append((timestamp, input_file))
+    snapshots.sort()
+    for timestamp, input_file in snapshots:
+        if store.contains(timestamp):
+            logging.info(f'Skipping {input_file}, snapshot {timestamp.strftime(TIMESTAMP_FORMAT)} is already stored')
+            continue
+        start = time.perf_counter()
+        try:
+            counts = store.append(timestamp, input_file, iter_merged_rows(input_file))
+        except ValueError as e:
+            logging.error(f'Failed to append {input_file}: {e}')
+            continue
+        # autopep8: off
+        logging.info(f'Appended {input_file} in {time.perf_counter() - start:.2f}s: {counts["continued"]} continued, {counts["ended"]} ended, {counts["started"]} started intervals')
+        # autopep8: on
+    logging.info(f'History contains {store.get_snapshot_count()} snapshots')
+
+
+def lookup_addresses(store: HistoryStore, addresses: list, timestamp_arg: str) -> None:
+    timestamp = None
+    if timestamp_arg is not None:
+        timestamp = parse_timestamp_argument(timestamp_arg)
+        if timestamp is None:
+            logging.error(f'Invalid timestamp specified: {timestamp_arg}')
+            return
+    for address in addresses:
+        try:
+            match = store.lookup(address, timestamp)
+        except ValueError as e:
+            logging.error(f'Invalid address {address}: {e}')
+            continue
+        prefix, asn = match if match is not None else (None, None)
+        print(json.dumps({'address': address, 'prefix': prefix, 'as': asn}))
+
+
+def print_histories(store: HistoryStore, prefixes: list) -> None:
+    for prefix in prefixes:
+        try:
+            history = store.get_history(prefix)
+        except ValueError as e:
+            logging.error(f'Invalid prefix {prefix}: {e}')
+            continue
+        for interval in history:
+            interval['first_seen'] = interval['first_seen'].strftime(TIMESTAMP_FORMAT)
+            interval['last_seen'] = interval['last_seen'].strftime(TIMESTAMP_FORMAT)
+        print(json.dumps({'prefix': prefix, 'history': history}))
+
+
+def main() -> None:
+    desc = """Keep the prefix-to-origin history of a series of merged trees in an indexed store,
+    and query it without loading the snapshots. Snapshots are appended incrementally and
+    have to be newer than the latest stored snapshot."""
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('-s', '--store', default=DEFAULT_HISTORY_FILE,
+                        help=f'history store file (default: {DEFAULT_HISTORY_FILE})')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    append_parser = subparsers.add_parser('append', help='append merged trees in chronological order')
+    append_parser.add_argument('input_files', nargs='+', help='pickled or columnar merged trees')
+    append_parser.add_argument('-t', '--timestamp',
+                               help=f'timestamp ({TIMESTAMP_FORMAT_ESCAPED}) of the snapshot if it can not be '
+                               'parsed from the file name')
+    lookup_parser = subparsers.add_parser('lookup', help='longest-prefix match of addresses at a point in time')
+    lookup_parser.add_argument('addresses', nargs='+', help='IPv4 or IPv6 addresses')
+    lookup_parser.add_argument('-t', '--timestamp',
+                               help=f'use the latest snapshot at or before this timestamp '
+                               f'({TIMESTAMP_FORMAT_ESCAPED}, default: latest snapshot)')
+    prefix_parser = subparsers.add_parser('prefix', help='origin history of prefixes')
+    prefix_parser.add_argument('prefixes', nargs='+', help='IPv4 or IPv6 prefixes')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[logging.StreamHandler(sys.stderr)],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    with HistoryStore(args.store) as store:
+        if args.command == 'append':
+            append_snapshots(store, args.input_files, args.timestamp)
+        elif args.command == 'lookup':
+            lookup_addresses(store, args.addresses, args.timestamp)
+        else:
+            print_histories(store, args.prefixes)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -0,0 +1,352 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import List
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from helpers.columnar import ColumnarRTree, columnar_to_rtree, is_columnar_file
+from helpers.defines import COLUMNAR_OUTPUT_FILE_SUFFIX, DEFAULT_MERGED_FOLDER, PICKLE_FILE_SUFFIXES
+from helpers.lookup import PrefixLookup, merged_rtree_rows
+from helpers.merge import parse_merged_file_name
+from helpers.merged_tree import get_seen_by_collectors, load_merged_tree
+
+MERGED_FILE_PATTERNS = (['*.merged' + suffix for suffix in PICKLE_FILE_SUFFIXES.values()]
+                        + ['*.merged' + COLUMNAR_OUTPUT_FILE_SUFFIX])
+# Number of recent requests used for latency percentiles.
+LATENCY_WINDOW = 10000
+# Time window (in s) for the current QPS.
+QPS_WINDOW = 60
+
+
+class Snapshot:
+    """A loaded merged tree. Instances are never modified after creation."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.collectors = None
+        if is_columnar_file(path):
+            with ColumnarRTree(path) as merged:
+                self.rtree = columnar_to_rtree(merged)
+        else:
+            self.rtree, self.collectors = load_merged_tree(path)
+        self.lookup = PrefixLookup(merged_rtree_rows(self.rtree))
+        self.loaded_at = time.time()
+
+    def lookup_addresses(self, addresses: List[str]) -> list:
+        results = [None] * len(addresses)
+        families = {4: ([], []), 6: ([], [])}
+        for position, address in enumerate(addresses):
+            version = 6 if isinstance(address, str) and ':' in address else 4
+            try:
+                if version == 4:
+                    value = int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big')
+                else:
+                    value = socket.inet_pton(socket.AF_INET6, address)
+            except (OSError, TypeError):
+                results[position] = {'address': address, 'error': 'invalid address'}
+                continue
+            families[version][0].append(position)
+            families[version][1].append(value)
+        for version, (positions, values) in families.items():
+            if not positions:
+                continue
+            dtype = np.uint32 if version == 4 else 'S16'
+            asns, counts = self.lookup.lookup_array(version, np.array(values, dtype=dtype))
+            for position, asn, count in zip(positions, asns.tolist(), counts.tolist()):
+                results[position] = {'address': addresses[position],
+                                     'asn': self.lookup.decode_origin(asn) if count > 0 else None,
+                                     'seen_by_collectors': count}
+        return results
+
+    def lookup_prefixes(self, prefixes: List[str]) -> list:
+        results = list()
+        for prefix in prefixes:
+            try:
+                node = self.rtree.search_exact(prefix)
+            except (ValueError, TypeError):
+                results.append({'prefix': prefix, 'error': 'invalid prefix'})
+                continue
+            if node is None:
+                results.append({'prefix': prefix, 'asn': None, 'seen_by_collectors': list()})
+                continue
+            results.append({'prefix': node.prefix,
+                            'asn': node.data['as'],
+                            'seen_by_collectors': list(get_seen_by_collectors(node, self.collectors))})
+        return results
+
+
+class QueryStats:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = 0
+        self.queries = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        # (timestamp, number of queries) of recent requests.
+        self.recent = deque()
+
+    def record(self, queries: int, latency: float, error: bool = False) -> None:
+        now = time.time()
+        with self.lock:
+            self.requests += 1
+            self.queries += queries
+            if error:
+                self.errors += 1
+            self.latencies.append(latency)
+            self.recent.append((now, queries))
+            while self.recent and self.recent[0][0] < now - QPS_WINDOW:
+                self.recent.popleft()
+
+    def to_dict(self) -> dict:
+        now = time.time()
+        with self.lock:
+            latencies = sorted(self.latencies)
+            recent_queries = sum(queries for ts, queries in self.recent if ts >= now - QPS_WINDOW)
+            recent_requests = sum(1 for ts, _ in self.recent if ts >= now - QPS_WINDOW)
+            ret = {'uptime': now - self.started_at,
+                   'requests': self.requests,
+                   'queries': self.queries,
+                   'errors': self.errors,
+                   f'requests_per_second_{QPS_WINDOW}s': recent_requests / QPS_WINDOW,
+                   f'queries_per_second_{QPS_WINDOW}s': recent_queries / QPS_WINDOW}
+        if latencies:
+            ret['latency_ms'] = {'mean': sum(latencies) / len(latencies) * 1000,
+                                 'p50': latencies[len(latencies) // 2] * 1000,
+                                 'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+                                 'max': latencies[-1] * 1000}
+        return ret
+
+
+class QueryService:
+    def __init__(self, merged_dir: str, merged_file: str, poll_interval: float, variant: str = '') -> None:
+        self.merged_dir = merged_dir
+        self.merged_file = merged_file
+        self.variant = variant
+        self.poll_interval = poll_interval
+        self.snapshot = None
+        self.stats = QueryStats()
+        self.stopped = threading.Event()
+
+    def find_latest_file(self) -> str:
+        """Return the merged file of self.variant with the newest timestamp in its name.
+
+        The modification time only breaks ties, e.g., between formats, so that a backfill
+        of older timestamps does not replace the served tree.
+        """
+        if self.merged_file:
+            return self.merged_file if os.path.exists(self.merged_file) else None
+        candidates = list()
+        for pattern in MERGED_FILE_PATTERNS:
+            for candidate in glob.glob(os.path.join(self.merged_dir, pattern)):
+                parsed = parse_merged_file_name(os.path.basename(candidate))
+                if parsed is None or parsed[1] != self.variant:
+                    continue
+                try:
+                    mtime = os.path.getmtime(candidate)
+                except OSError:
+                    # Removed since the glob, e.g., by a cleanup of old files.
+                    continue
+                candidates.append((parsed[0], mtime, candidate))
+        if not candidates:
+            return None
+        return max(candidates)[2]
+
+    def refresh(self) -> None:
+        """Load the latest merged file if it differs from the current snapshot.
+
+        The new snapshot is built completely before it replaces the reference to the old
+        one, so in-flight queries finish on the snapshot they started with.
+        """
+        latest = self.find_latest_file()
+        if latest is None:
+            if self.snapshot is None:
+                logging.warning(f'No merged file found in {self.merged_dir}')
+            return
+        try:
+            mtime = os.stat(latest).st_mtime
+        except OSError as e:
+            logging.warning(f'Failed to stat {latest}: {e}')
+            return
+        current = self.snapshot
+        if current is not None and current.path == latest and current.mtime == mtime:
+            return
+        logging.info(f'Loading {latest}')
+        try:
+            snapshot = Snapshot(latest)
+        except Exception as e:
+            logging.error(f'Failed to load {latest}: {e}')
+            return
+        self.snapshot = snapshot
+        logging.info(f'Serving {latest} ({len(snapshot.rtree.nodes())} prefixes)')
+
+    def watch(self) -> None:
+        while not self.stopped.wait(self.poll_interval):
+            # A failed poll must not stop the watcher thread, the next one may succeed.
+            try:
+                self.refresh()
+            except OSError as e:
+                logging.error(f'Failed to refresh merged file: {e}')
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    server_version = 'rib-explorer'
+
+    def address_string(self) -> str:
+        # Unix sockets do not have a client address.
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return 'unix'
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug(f'{self.address_string()} {format % args}')
+
+    def send_json(self, status: int, data: dict) -> None:
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def get_query_values(self, parameter: str, body_key: str) -> list:
+        """Read query values from the URL parameter (GET) or the JSON body (POST)."""
+        if self.command == 'POST':
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except json.JSONDecodeError as e:
+                raise ValueError(f'Invalid JSON body: {e}')
+            values = body.get(body_key, list()) if isinstance(body, dict) else None
+            if not isinstance(values, list):
+                raise ValueError(f'{body_key} must be a list')
+            return values
+        return parse_qs(urlparse(self.path).query).get(parameter, list())
+
+    def handle_query(self) -> None:
+        service: QueryService = self.server.service
+        start = time.perf_counter()
+        path = urlparse(self.path).path
+        if path == '/stats':
+            snapshot = service.snapshot
+            data = service.stats.to_dict()
+            if snapshot is not None:
+                data['snapshot'] = {'path': snapshot.path, 'loaded_at': snapshot.loaded_at}
+            self.send_json(200, data)
+            return
+        if path not in ('/lookup', '/prefix'):
+            self.send_json(404, {'error': 'unknown endpoint'})
+            return
+        # Keep a reference for the entire request, a swap does not affect it.
+        snapshot = service.snapshot
+        if snapshot is None:
+            self.send_json(503, {'error': 'no snapshot loaded'})
+            return
+        try:
+            if path == '/lookup':
+                values = self.get_query_values('address', 'addresses')
+                results = snapshot.lookup_addresses(values)
+            else:
+                values = self.get_query_values('prefix', 'prefixes')
+                results = snapshot.lookup_prefixes(values)
+        except ValueError as e:
+            service.stats.record(0, time.perf_counter() - start, error=True)
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(200, {'snapshot': snapshot.path, 'results': results})
+        service.stats.record(len(values), time.perf_counter() - start)
+
+    def do_GET(self) -> None:
+        self.handle_query()
+
+    def do_POST(self) -> None:
+        self.handle_query()
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def main() -> None:
+    desc = """Serve prefix-to-AS queries from the latest merged tree over localhost HTTP or
+    a Unix socket.
+
+    The merged file with the newest timestamp in its name in the merged folder (or the
+    file specified with --merged-file) is loaded once and replaced atomically as soon as a
+    newer file appears or the file is rewritten. Only trees of the threshold variant
+    selected with --variant are considered.
+
+    Endpoints:
+      GET  /lookup?address=X&address=Y    POST /lookup {"addresses": [...]}
+      GET  /prefix?prefix=X               POST /prefix {"prefixes": [...]}
+      GET  /stats
+    """
+    parser = argparse.ArgumentParser(description=desc, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--merged-dir',
+                        default=DEFAULT_MERGED_FOLDER,
+                        help=f'directory containing merged trees (default: {DEFAULT_MERGED_FOLDER})')
+    parser.add_argument('-f', '--merged-file', help='serve this file instead of the newest file in --merged-dir')
+    parser.add_argument('--variant',
+                        default='',
+                        help='threshold variant to serve, e.g., min_3 or min_ratio_0.5 for trees created with '
+                             '--min-collector-count 3 or --min-collector-ratio 0.5 (default: trees without threshold)')
+    parser.add_argument('--host', default='127.0.0.1', help='listen address (default: 127.0.0.1)')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='listen port (default: 8080)')
+    parser.add_argument('-u', '--unix-socket', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--poll-interval',
+                        type=float,
+                        default=30,
+                        help='interval (in s) to check for new merged files (default: 30)')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[
+            logging.FileHandler('query-service.log'),
+            logging.StreamHandler(sys.stdout)
+        ],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    logging.info(f'Started {sys.argv}')
+
+    service = QueryService(args.merged_dir, args.merged_file, args.poll_interval, args.variant)
+    service.refresh()
+    watcher = threading.Thread(target=service.watch, daemon=True)
+    watcher.start()
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, QueryHandler)
+        logging.info(f'Listening on {args.unix_socket}')
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), QueryHandler)
+        logging.info(f'Listening on {args.host}:{args.port}')
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stopped.set()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
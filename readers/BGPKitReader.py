@@ -0,0 +1,41 @@
+import subprocess as sp
+from typing import Iterable, Iterator, Tuple
+
+from readers import BaseRIBReader
+
+
+class BGPKitReader(BaseRIBReader):
+    """Read RIB entries from the text output of a bgpkit-parser subprocess.
+
+    If the file is sharded, even shards read IPv4 and odd shards IPv6 prefixes, which is
+    filtered by bgpkit-parser itself. Shards of the same address family are split further
+    by prefix.
+    """
+
+    def read(self) -> Iterator[Tuple[str, str, str]]:
+        command = ['bgpkit-parser']
+        family_shard = 0
+        family_num_shards = 1
+        if self.num_shards > 1:
+            is_ipv6 = self.shard % 2 == 1
+            command.append('--ipv6-only' if is_ipv6 else '--ipv4-only')
+            family_shard = self.shard // 2
+            family_num_shards = (self.num_shards + 1 - is_ipv6) // 2
+        command.append(self.input_file)
+        # Output format:
+        #   type|timestamp|peer_ip|peer_asn|prefix|as_path|origin_asns|origin|
+        #   next_hop|local_pref|med|communities|atomic|aggr_asn|aggr_ip|only_to_customer
+        with sp.Popen(command, stdout=sp.PIPE, text=True, bufsize=1) as p:
+            yield from self.parse_lines(p.stdout, family_shard, family_num_shards)
+
+    def parse_lines(self,
+                    lines: Iterable[str],
+                    family_shard: int = 0,
+                    family_num_shards: int = 1) -> Iterator[Tuple[str, str, str]]:
+        """Parse the text output of bgpkit-parser. Also used by the benchmarks to read
+        generated output without the subprocess."""
+        for line in lines:
+            res = line.split('|')
+            if family_num_shards > 1 and self.get_shard(res[4].encode(), family_num_shards) != family_shard:
+                continue
+            yield res[2], res[4], res[5].split(' ')[-1]
@@ -0,0 +1,207 @@
+import bz2
+import gzip
+import io
+import logging
+import socket
+import struct
+import time
+from typing import BinaryIO, Iterator, Tuple
+
+from readers import BaseRIBReader
+
+# RFC 6396 and RFC 8050
+MRT_HEADER = struct.Struct('!IHHI')
+TABLE_DUMP_V2 = 13
+PEER_INDEX_TABLE = 1
+PEER_TYPE_IPV6 = 0x01
+PEER_TYPE_AS4 = 0x02
+RIB_IPV4_UNICAST = 2
+RIB_IPV6_UNICAST = 4
+RIB_IPV4_UNICAST_ADDPATH = 8
+RIB_IPV6_UNICAST_ADDPATH = 10
+RIB_SUBTYPES = {
+    # subtype: (is_ipv6, has_path_id)
+    RIB_IPV4_UNICAST: (False, False),
+    RIB_IPV6_UNICAST: (True, False),
+    RIB_IPV4_UNICAST_ADDPATH: (False, True),
+    RIB_IPV6_UNICAST_ADDPATH: (True, True),
+}
+
+# BGP path attributes (RFC 4271)
+ATTR_FLAG_EXTENDED_LENGTH = 0x10
+ATTR_TYPE_AS_PATH = 2
+AS_SET = 1
+AS_SEQUENCE = 2
+
+COMPRESSED_OPENERS = {
+    '.bz2': bz2.open,
+    '.gz': gzip.open,
+}
+# Records are read with many small reads, which are served from a buffer of this size.
+READ_BUFFER_SIZE = 1024 * 1024
+
+
+def open_rib_file(input_file: str) -> BinaryIO:
+    for suffix, opener in COMPRESSED_OPENERS.items():
+        if input_file.endswith(suffix):
+            return opener(input_file, 'rb')
+    return open(input_file, 'rb')
+
+
+class TimedReader(io.RawIOBase):
+    """Raw stream that measures the time spent in the reads of an underlying (usually
+    decompressing) file."""
+
+    def __init__(self, f: BinaryIO) -> None:
+        self.f = f
+        self.read_time = 0.0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        start = time.perf_counter()
+        size = self.f.readinto(buffer)
+        self.read_time += time.perf_counter() - start
+        return size
+
+    def close(self) -> None:
+        self.f.close()
+        super().close()
+
+
+def format_prefix(is_ipv6: bool, prefix_bytes: bytes, prefix_length: int) -> str:
+    if is_ipv6:
+        address = socket.inet_ntop(socket.AF_INET6, prefix_bytes.ljust(16, b'\x00'))
+    else:
+        address = socket.inet_ntop(socket.AF_INET, prefix_bytes.ljust(4, b'\x00'))
+    return f'{address}/{prefix_length}'
+
+
+def get_origin(attributes: bytes) -> str:
+    """Extract the origin from the AS_PATH attribute in the format used by bgpkit-parser.
+
+    AS numbers are always encoded with four bytes in TABLE_DUMP_V2. Confederation
+    segments are ignored.
+    """
+    offset = 0
+    end = len(attributes)
+    while offset < end:
+        flags = attributes[offset]
+        attr_type = attributes[offset + 1]
+        if flags & ATTR_FLAG_EXTENDED_LENGTH:
+            attr_length = int.from_bytes(attributes[offset + 2:offset + 4], 'big')
+            offset += 4
+        else:
+            attr_length = attributes[offset + 2]
+            offset += 3
+        if attr_type != ATTR_TYPE_AS_PATH:
+            offset += attr_length
+            continue
+        origin = str()
+        segment_offset = offset
+        segment_end = offset + attr_length
+        while segment_offset < segment_end:
+            segment_type = attributes[segment_offset]
+            segment_count = attributes[segment_offset + 1]
+            segment_offset += 2
+            if segment_count > 0 and segment_type in (AS_SET, AS_SEQUENCE):
+                asns = struct.unpack_from(f'!{segment_count}I', attributes, segment_offset)
+                if segment_type == AS_SEQUENCE:
+                    origin = str(asns[-1])
+                else:
+                    origin = '{' + ','.join(map(str, asns)) + '}'
+            segment_offset += segment_count * 4
+        return origin
+    return str()
+
+
+class MRTReader(BaseRIBReader):
+    """Decode MRT TABLE_DUMP_V2 RIB files in-process.
+
+    Only the IPv4/IPv6 unicast RIB subtypes (with and without ADD-PATH) are decoded.
+    Other record types are skipped. The peer is identified by its index in the
+    PEER_INDEX_TABLE, which is available as a list of (peer_ip, peer_asn) tuples in
+    self.peers after reading. If the file is sharded, records of other shards are skipped
+    without decoding, but the file is still decompressed completely.
+    """
+
+    def __init__(self, input_file: str, shard: int = 0, num_shards: int = 1) -> None:
+        super().__init__(input_file, shard, num_shards)
+        self.peers = list()
+
+    def read(self) -> Iterator[Tuple[int, str, str]]:
+        skipped_types = set()
+        timed_reader = TimedReader(open_rib_file(self.input_file))
+        with io.BufferedReader(timed_reader, READ_BUFFER_SIZE) as f:
+            while True:
+                header = f.read(MRT_HEADER.size)
+                if not header:
+                    break
+                if len(header) < MRT_HEADER.size:
+                    logging.error(f'{self.input_file}: Truncated MRT header')
+                    break
+                _, record_type, subtype, length = MRT_HEADER.unpack(header)
+                body = f.read(length)
+                if len(body) < length:
+                    logging.error(f'{self.input_file}: Truncated MRT record')
+                    break
+                if record_type == TABLE_DUMP_V2 and subtype == PEER_INDEX_TABLE:
+                    self.peers = self.read_peer_index_table(body)
+                    continue
+                if record_type != TABLE_DUMP_V2 or subtype not in RIB_SUBTYPES:
+                    if (record_type, subtype) not in skipped_types:
+                        logging.warning(f'{self.input_file}: Skipping unsupported MRT records of type {record_type} '
+                                        f'subtype {subtype}')
+                        skipped_types.add((record_type, subtype))
+                    continue
+                if self.num_shards > 1:
+                    # Prefix length and prefix, skipping the sequence number.
+                    prefix_key = body[4:5 + (body[4] + 7) // 8]
+                    if self.get_shard(prefix_key, self.num_shards) != self.shard:
+                        continue
+                yield from self.read_rib_record(body, *RIB_SUBTYPES[subtype])
+        self.decompress_time = timed_reader.read_time
+
+    @staticmethod
+    def read_peer_index_table(body: bytes) -> list:
+        # Skip collector BGP ID.
+        view_name_length = int.from_bytes(body[4:6], 'big')
+        offset = 6 + view_name_length
+        peer_count = int.from_bytes(body[offset:offset + 2], 'big')
+        offset += 2
+        peers = list()
+        for _ in range(peer_count):
+            peer_type = body[offset]
+            # Skip peer BGP ID.
+            offset += 5
+            if peer_type & PEER_TYPE_IPV6:
+                peer_ip = socket.inet_ntop(socket.AF_INET6, body[offset:offset + 16])
+                offset += 16
+            else:
+                peer_ip = socket.inet_ntop(socket.AF_INET, body[offset:offset + 4])
+                offset += 4
+            asn_length = 4 if peer_type & PEER_TYPE_AS4 else 2
+            peer_asn = int.from_bytes(body[offset:offset + asn_length], 'big')
+            offset += asn_length
+            peers.append((peer_ip, peer_asn))
+        return peers
+
+    @staticmethod
+    def read_rib_record(body: bytes, is_ipv6: bool, has_path_id: bool) -> Iterator[Tuple[int, str, str]]:
+        # Skip sequence number.
+        prefix_length = body[4]
+        prefix_bytes_length = (prefix_length + 7) // 8
+        offset = 5 + prefix_bytes_length
+        prefix = format_prefix(is_ipv6, body[5:offset], prefix_length)
+        entry_count = int.from_bytes(body[offset:offset + 2], 'big')
+        offset += 2
+        # Peer index, originated time, optional path identifier.
+        entry_header_length = 10 if has_path_id else 6
+        for _ in range(entry_count):
+            peer_index = int.from_bytes(body[offset:offset + 2], 'big')
+            offset += entry_header_length
+            attributes_length = int.from_bytes(body[offset:offset + 2], 'big')
+            offset += 2
+            yield peer_index, prefix, get_origin(body[offset:offset + attributes_length])
+            offset += attributes_length
@@ -0,0 +1,40 @@
+import logging
+import zlib
+from abc import ABC, abstractmethod
+from typing import Iterator, Tuple
+
+
+class BaseRIBReader(ABC):
+    """Base class of RIB readers.
+
+    A reader can be restricted to one of num_shards disjoint shards of the prefixes, so
+    that multiple workers can process a single file. All entries of a prefix belong to
+    the same shard.
+
+    Readers that decompress the input file in-process set decompress_time to the time
+    (in s) spent reading and decompressing it after read is exhausted. It is None if the
+    time is not known.
+    """
+
+    def __init__(self, input_file: str, shard: int = 0, num_shards: int = 1) -> None:
+        self.input_file = input_file
+        self.shard = shard
+        self.num_shards = num_shards
+        self.decompress_time = None
+        logging.debug(f'{self.__class__.__name__} {input_file} shard {shard + 1}/{num_shards}')
+
+    @staticmethod
+    def get_shard(key: bytes, num_shards: int) -> int:
+        """Map a prefix key to a shard. The key must be the same for all entries of a
+        prefix."""
+        return zlib.crc32(key) % num_shards
+
+    @abstractmethod
+    def read(self) -> Iterator[Tuple[object, str, str]]:
+        """Yield (peer, prefix, origin) tuples for all RIB entries of the input file.
+
+        peer is an opaque identifier that is unique per peer within one file. origin is
+        the last element of the AS path, i.e., either an ASN or an origin AS set of the
+        form {X,Y}. It is an empty string if the AS path is empty.
+        """
+        pass
@@ -0,0 +1,416 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import multiprocessing
+from shutil import which
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from fetchers.RISFetcher import RISFetcher
+from fetchers.RouteViewsFetcher import RouteViewsFetcher
+from helpers.compression import CODECS, get_compression
+from helpers.defines import (DEFAULT_DATA_FOLDER, DEFAULT_INDEX_FOLDER, DEFAULT_MERGED_FOLDER, DEFAULT_STATS_FOLDER,
+                             DEFAULT_TRANSFORMED_FOLDER, INTERMEDIATE_OUTPUT_FILE_FORMAT, TIMESTAMP_FORMAT_ESCAPED)
+from helpers.file_catalog import FileCatalog
+from helpers.merge import (FILE_FORMATS, build_merged_output, get_merged_output_file_name, group_collector_rows,
+                           iter_collector_rows, new_merge_stats, prepare_collector_file, print_merge_stats,
+                           record_grouped_rows, select_prefixes, summarize_merge_stats, write_intermediate,
+                           write_merge_stats, write_merged_output)
+from helpers.merged_tree import COLLECTOR_ENCODINGS
+from helpers.shared_functions import get_latest_index_file, get_stat_file_name, parse_timestamp_argument
+from helpers.transform import (AGGREGATIONS, DURATIONS_FILE, RIB_READERS, get_transform_output_file, load_durations,
+                               print_stats, save_durations, timed_transform_rib, write_stats)
+from helpers.transform_cache import TransformCache
+
+# Signals the workers of a stage that there is no more input.
+STOP = None
+
+
+class Stage:
+    """A pipeline stage with a fixed number of worker threads.
+
+    Workers take items from input_queue, process them with func, and pass non-None
+    results on to the input queue of the downstream stage. Queues are bounded, so a stage
+    that is faster than its successor blocks instead of piling up work.
+    """
+
+    def __init__(self, name: str, func, num_workers: int, input_queue: queue.Queue) -> None:
+        self.name = name
+        self.func = func
+        self.num_workers = num_workers
+        self.input_queue = input_queue
+        self.downstream = None
+        self.threads = list()
+        self.lock = threading.Lock()
+        self.items = 0
+        self.failures = 0
+        # Accumulated time (in s) of all workers spent processing, waiting for input, and
+        # waiting for space in the downstream queue.
+        self.busy = 0
+        self.idle = 0
+        self.blocked = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self) -> None:
+        self.started_at = time.monotonic()
+        for worker_idx in range(self.num_workers):
+            thread = threading.Thread(target=self.work, name=f'{self.name}-{worker_idx}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self) -> None:
+        while True:
+            wait_start = time.monotonic()
+            item = self.input_queue.get()
+            work_start = time.monotonic()
+            if item is STOP:
+                with self.lock:
+                    self.idle += work_start - wait_start
+                return
+            failed = False
+            try:
+                result = self.func(item)
+            except Exception as e:
+                logging.error(f'{self.name} failed for {item}: {e}')
+                failed = True
+                result = None
+            work_end = time.monotonic()
+            if result is not None and self.downstream is not None:
+                self.downstream.input_queue.put(result)
+            with self.lock:
+                self.items += 1
+                if failed:
+                    self.failures += 1
+                self.idle += work_start - wait_start
+                self.busy += work_end - work_start
+                self.blocked += time.monotonic() - work_end
+
+    def join(self) -> None:
+        for thread in self.threads:
+            thread.join()
+        self.finished_at = time.monotonic()
+        if self.downstream is not None:
+            for _ in range(self.downstream.num_workers):
+                self.downstream.input_queue.put(STOP)
+
+    def to_dict(self, pipeline_start: float) -> dict:
+        # Utilization is relative to the time from the pipeline start until the stage
+        # finished, i.e., waiting for the first input counts as idle time.
+        wall_time = self.finished_at - pipeline_start
+        capacity = wall_time * self.num_workers
+        return {'stage': self.name,
+                'workers': self.num_workers,
+                'items': self.items,
+                'failures': self.failures,
+                'wall_time': wall_time,
+                'busy': self.busy,
+                'idle': self.idle,
+                'blocked': self.blocked,
+                'utilization_pct': self.busy / capacity * 100 if capacity > 0 else 0}
+
+
+def print_stage_stats(stage_stats: list) -> None:
+    for s in stage_stats:
+        # autopep8: off
+        logging.info(f'{s["stage"]:>9}: workers:{s["workers"]} items:{s["items"]} failures:{s["failures"]} wall:{s["wall_time"]:.1f}s busy:{s["busy"]:.1f}s idle:{s["idle"]:.1f}s blocked:{s["blocked"]:.1f}s utilization:{s["utilization_pct"]:.1f}%')
+        # autopep8: on
+
+
+def write_stage_stats(stage_stats: list, output_file: str) -> None:
+    logging.info(f'Writing pipeline stats to {output_file}')
+    delimiter = ','
+    headers = ['stage', 'workers', 'items', 'failures', 'wall_time', 'busy', 'idle', 'blocked', 'utilization_pct']
+    with open(output_file, 'w') as f:
+        f.write(delimiter.join(headers) + '\n')
+        for stat in stage_stats:
+            f.write(delimiter.join(map(str, [stat[h] for h in headers])) + '\n')
+
+
+def main() -> None:
+    desc = """Fetch, transform, and merge RIBs for the specified timestamp in a single pipeline.
+
+    Instead of running each step to completion, a RIB is transformed as soon as its download
+    finishes, and a transformed tree is prepared for the merge (decompressed and flattened)
+    as soon as it is written. The final k-way merge starts once all collectors are
+    prepared. Stages are connected with bounded queues, and the utilization of each stage
+    is reported at the end.
+    """
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument('timestamp', help=f'UTC timestamp in {TIMESTAMP_FORMAT_ESCAPED} format')
+    parser.add_argument('-i', '--index', help='index file')
+    parser.add_argument('--data-dir',
+                        default=DEFAULT_DATA_FOLDER,
+                        help=f'RIB directory (default: {DEFAULT_DATA_FOLDER})')
+    parser.add_argument('--transformed-dir',
+                        default=DEFAULT_TRANSFORMED_FOLDER,
+                        help=f'transformed tree directory (default: {DEFAULT_TRANSFORMED_FOLDER})')
+    parser.add_argument('-o', '--output-dir',
+                        default=DEFAULT_MERGED_FOLDER,
+                        help=f'output directory (default: {DEFAULT_MERGED_FOLDER})')
+    parser.add_argument('--output-file',
+                        help='output file name. output file is created in the output directory')
+    parser.add_argument('--temp-dir',
+                        help='directory for temporary files of the merge (default: system temp directory)')
+    parser.add_argument('--num-fetchers',
+                        type=int,
+                        default=4,
+                        help='number of parallel downloads (default: 4)')
+    parser.add_argument('--num-transformers',
+                        type=int,
+                        default=4,
+                        help='number of processes that transform RIBs and prepare trees for the merge (default: 4)')
+    parser.add_argument('--queue-size',
+                        type=int,
+                        default=4,
+                        help='max. number of finished items waiting for the next stage (default: 4)')
+    parser.add_argument('-r', '--reader',
+                        choices=sorted(RIB_READERS),
+                        default='bgpkit',
+                        help='RIB reader backend (default: bgpkit)')
+    parser.add_argument('--aggregation',
+                        choices=AGGREGATIONS,
+                        default='compact',
+                        help='data structure used to aggregate the origins of a RIB (default: compact)')
+    parser.add_argument('--transform-format',
+                        choices=sorted(FILE_FORMATS),
+                        default='pickle',
+                        help='format of the transformed files (default: pickle)')
+    parser.add_argument('--output-format',
+                        choices=sorted(FILE_FORMATS),
+                        default='pickle',
+                        help='format of the output file (default: pickle)')
+    parser.add_argument('--compression',
+                        choices=sorted(CODECS),
+                        default='bz2',
+                        help='compression codec of pickled transformed and output files, which determines their '
+                             'suffix (.pickle.bz2, .pickle.gz, .pickle.xz or .pickle). Readers detect the codec by its '
+                             'magic bytes (default: bz2)')
+    parser.add_argument('--compression-level',
+                        type=int,
+                        help='compression level of --compression (default: 9 for bz2, 6 for gzip and lzma)')
+    parser.add_argument('--collector-encoding',
+                        choices=COLLECTOR_ENCODINGS,
+                        default='names',
+                        help='store the collectors of each prefix of a pickled tree as names or as a bitmask into a '
+                             'collector table (default: names)')
+    parser.add_argument('--hash-inputs',
+                        action='store_true',
+                        help='identify RIB files by their content hash instead of their size and modification time '
+                             'when checking if transformed files are up to date')
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='overwrite existing transformed files')
+    parser.add_argument('-w', '--write-stats', action='store_true', help='write stats to file')
+    parser.add_argument('-s', '--stats-dir',
+                        default=DEFAULT_STATS_FOLDER,
+                        help=f'stats output directory (default: {DEFAULT_STATS_FOLDER})')
+    parser.add_argument('--save-intermediate',
+                        action='store_true',
+                        help='also save the intermediate file of the merge, from which create-merged-rtree.py '
+                             'can build trees for other thresholds or collectors (see --from-intermediate)')
+    min_group = parser.add_mutually_exclusive_group()
+    min_group.add_argument('--min-collector-ratio',
+                           type=float,
+                           help='ratio (0-1) of collectors required to include prefix')
+    min_group.add_argument('--min-collector-count',
+                           type=int,
+                           help='number of collectors required to include prefix')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(
+        format=FORMAT,
+        handlers=[
+            logging.FileHandler('run-pipeline.log'),
+            logging.StreamHandler(sys.stdout)
+        ],
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+
+    logging.info(f'Started {sys.argv}')
+
+    try:
+        compression = get_compression(args.compression, args.compression_level)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+
+    if args.reader == 'bgpkit' and not which('bgpkit-parser'):
+        logging.error('Failed to find bgpkit-parser executable. Is it installed?')
+        sys.exit(1)
+
+    timestamp = parse_timestamp_argument(args.timestamp)
+    if timestamp is None:
+        logging.error('Invalid timestamp specified')
+        sys.exit(1)
+
+    index_file = args.index
+    if index_file is None:
+        index_file = get_latest_index_file(timestamp, FileCatalog(DEFAULT_INDEX_FOLDER))
+        if not index_file:
+            sys.exit(1)
+    with open(index_file, 'r') as f:
+        index = json.load(f)
+
+    output_file = args.output_file
+    if output_file is None:
+        output_file = get_merged_output_file_name(timestamp, args.output_format, args.min_collector_ratio,
+                                                  args.min_collector_count, compression)
+    output_file = os.path.join(args.output_dir, output_file)
+
+    # Connections are reused by all fetch threads.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=args.num_fetchers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # Items are (position in index, source, collector, file).
+    fetch_queue = queue.Queue()
+    fetcher_classes = {'routeviews': RouteViewsFetcher, 'ris': RISFetcher}
+    fetchers = dict()
+    for source, fetcher_class in fetcher_classes.items():
+        for collector, url in index['sources'][source].items():
+            fetcher = fetcher_class(collector, url, timestamp, args.data_dir)
+            fetcher.session = session
+            fetchers[collector] = fetcher
+            fetch_queue.put((len(fetchers) - 1, source, collector, None))
+
+    transform_stats = list()
+    # Durations and peak memory are recorded for the schedule and memory budget of
+    # transform-snapshots.py.
+    durations_file = os.path.join(args.stats_dir, DURATIONS_FILE)
+    durations = load_durations(durations_file)
+    cache = TransformCache(args.data_dir, args.hash_inputs)
+    data_catalog = FileCatalog(args.data_dir)
+    transformed_catalog = FileCatalog(args.transformed_dir)
+
+    def fetch(item: tuple) -> tuple:
+        position, source, collector, _ = item
+        rib_file = fetchers[collector].fetch()
+        if rib_file is None:
+            return None
+        data_catalog.update(os.path.dirname(rib_file))
+        return position, source, collector, rib_file
+
+    # Use a new process for each job, so that the peak memory is measured per job and
+    # memory is returned to the system between files. Workers are then started while the
+    # fetch threads are running, which is unsafe with fork, so they are forked from a
+    # server process instead.
+    context = multiprocessing.get_context('forkserver')
+    with context.Pool(args.num_transformers, maxtasksperchild=1) as p, \
+            tempfile.TemporaryDirectory(dir=args.temp_dir) as spill_dir:
+
+        def transform(item: tuple) -> tuple:
+            position, source, collector, rib_file = item
+            transformed_file = get_transform_output_file(os.path.basename(rib_file), args.transformed_dir, source,
+                                                         collector, timestamp, args.transform_format, compression)
+            cache_key = cache.get_key(rib_file, args.reader, compression)
+            if args.force or not cache.lookup(rib_file, transformed_file, cache_key):
+                fixture = (rib_file, transformed_file, args.reader, args.transform_format, args.aggregation,
+                           compression)
+                stat = p.apply(timed_transform_rib, (fixture,))
+                transform_stats.append(stat)
+                durations[f'{source}/{collector}'] = {'size': os.path.getsize(rib_file),
+                                                      'duration': stat['duration'],
+                                                      'peak_memory': stat['peak_memory']}
+                if not os.path.exists(transformed_file):
+                    # Empty RIB.
+                    return None
+                cache.record(rib_file, transformed_file, cache_key)
+                cache.save()
+                transformed_catalog.record(transformed_file)
+            return position, source, collector, transformed_file
+
+        def prepare(item: tuple) -> tuple:
+            position, source, collector, transformed_file = item
+            prepared_file = p.apply(prepare_collector_file, (transformed_file, args.transform_format, spill_dir))
+            prepared_files.append((position, collector, prepared_file))
+
+        prepared_files = list()
+        stages = [Stage('fetch', fetch, args.num_fetchers, fetch_queue),
+                  Stage('transform', transform, args.num_transformers, queue.Queue(args.queue_size)),
+                  Stage('prepare', prepare, args.num_transformers, queue.Queue(args.queue_size))]
+        for stage, downstream in zip(stages, stages[1:]):
+            stage.downstream = downstream
+        for _ in range(args.num_fetchers):
+            fetch_queue.put(STOP)
+
+        logging.info(f'Processing {len(fetchers)} collectors')
+        pipeline_start = time.monotonic()
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+            logging.info(f'Stage {stage.name} finished after {stage.finished_at - pipeline_start:.1f}s')
+        session.close()
+        if transform_stats:
+            save_durations(durations_file, durations)
+
+        # Merge in index order, so that the output does not depend on the completion order.
+        prepared_files.sort()
+        collector_names = [collector for _, collector, _ in prepared_files]
+        total_collector_count = len(collector_names)
+        logging.info(f'Merging files from {total_collector_count} collectors')
+        min_collector_count = 0
+        if args.min_collector_ratio:
+            min_collector_count = int(total_collector_count * args.min_collector_ratio)
+        elif args.min_collector_count:
+            min_collector_count = args.min_collector_count
+        logging.info(f'Min. collector count: {min_collector_count}')
+
+        merge_start = time.monotonic()
+        merge_stats = new_merge_stats()
+        collector_rows = [iter_collector_rows(prepared_file, args.transform_format)
+                          for _, _, prepared_file in prepared_files]
+        grouped_rows = group_collector_rows(collector_rows)
+        if args.save_intermediate:
+            intermediate_rows = list()
+            grouped_rows = record_grouped_rows(grouped_rows, intermediate_rows)
+        merged_output = build_merged_output(select_prefixes(grouped_rows, min_collector_count, merge_stats),
+                                            collector_names,
+                                            args.output_format,
+                                            args.collector_encoding)
+        write_merged_output(output_file, merged_output, collector_names, args.output_format, args.collector_encoding,
+                            compression)
+        if args.save_intermediate:
+            intermediate_file = os.path.join(args.output_dir, timestamp.strftime(INTERMEDIATE_OUTPUT_FILE_FORMAT))
+            logging.info(f'Writing intermediate file {intermediate_file}')
+            write_intermediate(intermediate_file, intermediate_rows, collector_names)
+        merge_end = time.monotonic()
+
+    logging.info(f'Wrote {output_file}')
+    print_stats(transform_stats)
+    merge_summary = summarize_merge_stats(merge_stats)
+    print_merge_stats(merge_summary)
+
+    stage_stats = [stage.to_dict(pipeline_start) for stage in stages]
+    merge_time = merge_end - merge_start
+    stage_stats.append({'stage': 'merge',
+                        'workers': 1,
+                        'items': total_collector_count,
+                        'failures': 0,
+                        'wall_time': merge_end - pipeline_start,
+                        'busy': merge_time,
+                        'idle': merge_start - pipeline_start,
+                        'blocked': 0,
+                        'utilization_pct': merge_time / (merge_end - pipeline_start) * 100})
+    logging.info(f'Total time: {merge_end - pipeline_start:.1f}s')
+    print_stage_stats(stage_stats)
+
+    if args.write_stats:
+        write_stats(transform_stats, get_stat_file_name(timestamp, args.stats_dir, 'transformed'))
+        write_merge_stats(merge_summary, get_stat_file_name(timestamp, args.stats_dir, 'merged'))
+        write_stage_stats(stage_stats, get_stat_file_name(timestamp, args.stats_dir, 'pipeline'))
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
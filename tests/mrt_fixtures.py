@@ -0,0 +1,112 @@
+"""Generator of synthetic MRT TABLE_DUMP_V2 files (RFC 6396, RFC 8050) for tests.
+
+Records are built from plain Python values, e.g.:
+
+    write_mrt_file(path, [
+        peer_index_table([('192.0.2.1', 64496), ('2001:db8::1', 4200000000)]),
+        rib_record(0, '203.0.113.0/24', [(0, as_path((AS_SEQUENCE, [64496, 64497])))]),
+    ])
+
+Only the fields read by readers.MRTReader are meaningful, all other fields (BGP IDs,
+timestamps, other attributes) are filled with fixed values.
+"""
+import bz2
+import gzip
+import ipaddress
+import socket
+import struct
+from typing import Iterable, List, Tuple
+
+from readers.MRTReader import (ATTR_FLAG_EXTENDED_LENGTH, ATTR_TYPE_AS_PATH, MRT_HEADER, PEER_INDEX_TABLE,
+                               PEER_TYPE_AS4, PEER_TYPE_IPV6, RIB_IPV4_UNICAST, RIB_IPV4_UNICAST_ADDPATH,
+                               RIB_IPV6_UNICAST, RIB_IPV6_UNICAST_ADDPATH, TABLE_DUMP_V2)
+
+RIB_IPV4_MULTICAST = 3
+RIB_IPV6_MULTICAST = 5
+RIB_GENERIC = 6
+BGP4MP = 16
+ATTR_FLAG_TRANSITIVE = 0x40
+ATTR_TYPE_ORIGIN = 1
+TIMESTAMP = 1704067200
+
+# (segment type, ASNs)
+Segment = Tuple[int, List[int]]
+
+
+def mrt_record(record_type: int, subtype: int, body: bytes) -> bytes:
+    return MRT_HEADER.pack(TIMESTAMP, record_type, subtype, len(body)) + body
+
+
+def peer_index_table(peers: Iterable[tuple], view_name: str = 'test') -> bytes:
+    """Encode a PEER_INDEX_TABLE record. peers are (peer_ip, peer_asn) or (peer_ip,
+    peer_asn, as4) tuples. ASNs are encoded with four bytes if as4 is True or the ASN does
+    not fit into two bytes."""
+    view_name = view_name.encode('utf-8')
+    body = struct.pack('!4sH', socket.inet_aton('192.0.2.255'), len(view_name)) + view_name
+    body += struct.pack('!H', len(peers))
+    for peer in peers:
+        peer_ip, peer_asn = peer[:2]
+        as4 = peer[2] if len(peer) > 2 else peer_asn > 0xffff
+        address = ipaddress.ip_address(peer_ip)
+        peer_type = (PEER_TYPE_IPV6 if address.version == 6 else 0) | (PEER_TYPE_AS4 if as4 else 0)
+        body += struct.pack('!B4s', peer_type, socket.inet_aton('192.0.2.254')) + address.packed
+        body += peer_asn.to_bytes(4 if as4 else 2, 'big')
+    return mrt_record(TABLE_DUMP_V2, PEER_INDEX_TABLE, body)
+
+
+def as_path(*segments: Segment) -> List[Segment]:
+    """Return an AS path of (segment type, ASNs) segments. An AS path without segments is
+    empty."""
+    return list(segments)
+
+
+def attributes(segments: List[Segment] = None, extended_length: bool = False) -> bytes:
+    """Encode the path attributes of a RIB entry: ORIGIN and, unless segments is None,
+    AS_PATH with four-byte ASNs."""
+    encoded = struct.pack('!BBBB', ATTR_FLAG_TRANSITIVE, ATTR_TYPE_ORIGIN, 1, 0)
+    if segments is None:
+        return encoded
+    value = b''.join(struct.pack(f'!BB{len(asns)}I', segment_type, len(asns), *asns)
+                     for segment_type, asns in segments)
+    if extended_length:
+        encoded += struct.pack('!BBH', ATTR_FLAG_TRANSITIVE | ATTR_FLAG_EXTENDED_LENGTH, ATTR_TYPE_AS_PATH,
+                               len(value))
+    else:
+        encoded += struct.pack('!BBB', ATTR_FLAG_TRANSITIVE, ATTR_TYPE_AS_PATH, len(value))
+    return encoded + value
+
+
+def rib_record(sequence: int, prefix: str, entries: Iterable[tuple], add_path: bool = False) -> bytes:
+    """Encode a RIB_IPV4_UNICAST or RIB_IPV6_UNICAST record (or their ADD-PATH variants)
+    for prefix. entries are (peer index, AS path) or (peer index, AS path, path
+    identifier) tuples, where the AS path is a list of segments (see as_path), None for
+    an entry without AS_PATH attribute, or the already encoded attributes."""
+    network = ipaddress.ip_network(prefix)
+    if network.version == 4:
+        subtype = RIB_IPV4_UNICAST_ADDPATH if add_path else RIB_IPV4_UNICAST
+    else:
+        subtype = RIB_IPV6_UNICAST_ADDPATH if add_path else RIB_IPV6_UNICAST
+    prefix_bytes = network.network_address.packed[:(network.prefixlen + 7) // 8]
+    entries = list(entries)
+    body = struct.pack('!IB', sequence, network.prefixlen) + prefix_bytes + struct.pack('!H', len(entries))
+    for entry in entries:
+        peer_index, segments = entry[:2]
+        encoded = segments if isinstance(segments, bytes) else attributes(segments)
+        body += struct.pack('!HI', peer_index, TIMESTAMP)
+        if add_path:
+            body += struct.pack('!I', entry[2] if len(entry) > 2 else 1)
+        body += struct.pack('!H', len(encoded)) + encoded
+    return mrt_record(TABLE_DUMP_V2, subtype, body)
+
+
+def write_mrt_file(output_file: str, records: Iterable[bytes]) -> None:
+    """Write records to output_file, compressed if it ends with .bz2 or .gz."""
+    if output_file.endswith('.bz2'):
+        opener = bz2.open
+    elif output_file.endswith('.gz'):
+        opener = gzip.open
+    else:
+        opener = open
+    with opener(output_file, 'wb') as f:
+        for record in records:
+            f.write(record)
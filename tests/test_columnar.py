@@ -0,0 +1,104 @@
+import pickle
+import socket
+
+import pytest
+import radix
+
+from helpers.aggregation import CompactAggregate
+from helpers.columnar import ColumnarRTree, columnar_to_rtree, rtree_to_rows, write_columnar
+from helpers.merge import (build_merged_output, group_collector_rows, iter_collector_rows, new_merge_stats,
+                           prepare_collector_file, read_intermediate, select_prefixes, write_intermediate,
+                           write_merged_output)
+
+COLLECTORS = ['rrc00', 'route-views2']
+# Origins of the transformed tree of each collector. Empty origins come from RIB entries
+# without AS path, '0123' is numeric but does not survive a round trip through int.
+COLLECTOR_ORIGINS = [
+    {'8.8.8.0/24': '15169', '10.0.0.0/8': '', '192.0.2.0/24': '0123', '2001:db8::/32': '', '2a00::/12': '64496'},
+    {'8.8.8.0/24': '15169', '10.0.0.0/8': '', '192.0.2.0/24': '123', '2001:db8::/32': '64497', '2a00::/12': '64496'},
+]
+
+
+def make_rtree(origins: dict) -> radix.Radix:
+    rtree = radix.Radix()
+    for prefix, origin in origins.items():
+        rtree.add(prefix).data['as'] = origin
+    return rtree
+
+
+def get_origins(rtree: radix.Radix) -> dict:
+    return {node.prefix: node.data['as'] for node in rtree.nodes()}
+
+
+def write_collector_file(output_dir, idx: int, input_format: str) -> str:
+    rtree = make_rtree(COLLECTOR_ORIGINS[idx])
+    if input_format == 'columnar':
+        output_file = str(output_dir / f'{COLLECTORS[idx]}.col')
+        write_columnar(output_file, rtree_to_rows(rtree))
+    else:
+        output_file = str(output_dir / f'{COLLECTORS[idx]}.pickle')
+        with open(output_file, 'wb') as f:
+            pickle.dump(rtree, f)
+    return output_file
+
+
+def group(output_dir, input_format: str) -> list:
+    output_dir.mkdir()
+    prepared_files = [prepare_collector_file(write_collector_file(output_dir, idx, input_format), input_format,
+                                             str(output_dir))
+                      for idx in range(len(COLLECTORS))]
+    return list(group_collector_rows([iter_collector_rows(prepared_file, input_format)
+                                      for prepared_file in prepared_files]))
+
+
+def test_string_origins_are_kept(tmp_path):
+    output_file = str(tmp_path / 'collector.col')
+    write_columnar(output_file, rtree_to_rows(make_rtree(COLLECTOR_ORIGINS[0])))
+    with ColumnarRTree(output_file) as columnar:
+        assert len(columnar) == len(COLLECTOR_ORIGINS[0])
+        assert columnar.counts == {4: 1, 6: 1}
+        rows = list(columnar.rows())
+        assert rows == sorted(rows, key=lambda row: row[:3])
+        assert [row[3] for row in rows] == [15169, '', '0123', '', 64496]
+        rtree = columnar_to_rtree(columnar)
+    assert get_origins(rtree) == COLLECTOR_ORIGINS[0]
+
+
+def test_compact_aggregate_rows():
+    aggregate = CompactAggregate()
+    for prefix, origin in COLLECTOR_ORIGINS[0].items():
+        node = radix.Radix().add(prefix)
+        aggregate.add(prefix, 4 if node.family == socket.AF_INET else 6, int.from_bytes(node.packed, 'big'),
+                      node.prefixlen, [('192.0.2.1', origin)])
+    assert sorted(aggregate.to_rows(), key=str) == sorted(rtree_to_rows(make_rtree(COLLECTOR_ORIGINS[0])), key=str)
+
+
+@pytest.mark.parametrize('min_collector_count', [1, 2])
+def test_pickle_and_columnar_merge_identically(tmp_path, min_collector_count):
+    pickle_grouped = group(tmp_path / 'pickle', 'pickle')
+    columnar_grouped = group(tmp_path / 'columnar', 'columnar')
+    assert columnar_grouped == pickle_grouped
+    merged = dict()
+    for output_format in ('pickle', 'columnar'):
+        stats = new_merge_stats()
+        merged_output = build_merged_output(select_prefixes(iter(pickle_grouped), min_collector_count, stats),
+                                            COLLECTORS, output_format)
+        output_file = str(tmp_path / f'merged.{output_format}')
+        write_merged_output(output_file, merged_output, COLLECTORS, output_format)
+        if output_format == 'columnar':
+            with ColumnarRTree(output_file) as columnar:
+                merged[output_format] = get_origins(columnar_to_rtree(columnar))
+        else:
+            merged[output_format] = get_origins(merged_output)
+    assert merged['columnar'] == merged['pickle']
+    assert merged['pickle']['10.0.0.0/8'] == ''
+
+
+def test_intermediate(tmp_path):
+    grouped = group(tmp_path / 'pickle', 'pickle')
+    output_file = str(tmp_path / 'intermediate.col')
+    write_intermediate(output_file, grouped, COLLECTORS)
+    collector_names, rows = read_intermediate(output_file)
+    assert collector_names == COLLECTORS
+    # The order of the origins of a prefix is not preserved.
+    assert [row[:3] + (sorted(row[3]),) for row in rows] == [row[:3] + (sorted(row[3]),) for row in grouped]
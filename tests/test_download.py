@@ -0,0 +1,183 @@
+"""Tests of BaseFetcher.download against a local HTTP server."""
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fetchers import PARTIAL_FILE_SUFFIX, BaseFetcher
+from fetchers.AsyncFetchEngine import ThreadSessions
+
+CONTENT = bytes(range(256)) * 4096
+PARTIAL_SIZE = 100_000
+
+
+class DummyFetcher(BaseFetcher):
+    def get_file_list(self) -> None:
+        pass
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve CONTENT, with the behavior selected by the mode attribute of the server:
+
+    range: honor Range requests with 206
+    ignore: ignore Range requests and return the whole file with 200
+    truncate: announce the whole file, but close the connection after half of it
+    wrong-start: return a 206 that starts at the beginning of the file
+    unsatisfiable: return 416 with the size of the file in Content-Range
+    """
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        mode = self.server.mode
+        self.server.ranges.append(self.headers.get('Range'))
+        start = 0
+        range_header = self.headers.get('Range')
+        if range_header is not None:
+            start = int(range_header.removeprefix('bytes=').partition('-')[0])
+        if mode == 'unsatisfiable' or (range_header is not None and start >= len(CONTENT)):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(CONTENT)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if mode == 'wrong-start':
+            start = 0
+        if range_header is not None and mode in ('range', 'wrong-start'):
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}')
+        else:
+            start = 0
+            self.send_response(200)
+        body = CONTENT[start:]
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if mode == 'truncate':
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    httpd.mode = 'range'
+    httpd.ranges = list()
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+    thread.join()
+
+
+def download(server, tmp_path, partial: bytes = None) -> tuple:
+    output_file = tmp_path / 'bview.20240101.0000.gz'
+    if partial is not None:
+        (tmp_path / (output_file.name + PARTIAL_FILE_SUFFIX)).write_bytes(partial)
+    fetcher = DummyFetcher('rrc00', 'http://127.0.0.1/', datetime(2024, 1, 1), str(tmp_path))
+    url = f'http://127.0.0.1:{server.server_address[1]}/bview.20240101.0000.gz'
+    stats = {'bytes_written': 0}
+    return fetcher.download(url, str(output_file), stats), output_file, stats
+
+
+def get_partial_file(output_file):
+    return output_file.with_name(output_file.name + PARTIAL_FILE_SUFFIX)
+
+
+def test_fresh_download(server, tmp_path):
+    success, output_file, stats = download(server, tmp_path)
+    assert success
+    assert output_file.read_bytes() == CONTENT
+    assert not get_partial_file(output_file).exists()
+    assert server.ranges == [None]
+    assert stats['bytes_written'] == len(CONTENT)
+
+
+def test_resume(server, tmp_path):
+    success, output_file, stats = download(server, tmp_path, CONTENT[:PARTIAL_SIZE])
+    assert success
+    assert output_file.read_bytes() == CONTENT
+    assert server.ranges == [f'bytes={PARTIAL_SIZE}-']
+    assert stats['bytes_written'] == len(CONTENT) - PARTIAL_SIZE
+
+
+def test_range_ignored(server, tmp_path):
+    server.mode = 'ignore'
+    # The partial file is overwritten, so its content does not matter.
+    success, output_file, stats = download(server, tmp_path, b'\xff' * PARTIAL_SIZE)
+    assert success
+    assert output_file.read_bytes() == CONTENT
+    assert stats['bytes_written'] == len(CONTENT)
+
+
+def test_length_mismatch(server, tmp_path):
+    server.mode = 'truncate'
+    success, output_file, _ = download(server, tmp_path)
+    assert not success
+    assert not output_file.exists()
+    # The partial file is kept to resume the next attempt.
+    assert get_partial_file(output_file).stat().st_size < len(CONTENT)
+
+
+def test_wrong_range_start(server, tmp_path):
+    server.mode = 'wrong-start'
+    success, output_file, _ = download(server, tmp_path, CONTENT[:PARTIAL_SIZE])
+    assert not success
+    assert not output_file.exists()
+    assert not get_partial_file(output_file).exists()
+
+
+def test_unsatisfiable_complete_partial_file(server, tmp_path):
+    success, output_file, stats = download(server, tmp_path, CONTENT)
+    assert success
+    assert output_file.read_bytes() == CONTENT
+    assert not get_partial_file(output_file).exists()
+    assert stats['bytes_written'] == 0
+
+
+def test_unsatisfiable_range(server, tmp_path):
+    server.mode = 'unsatisfiable'
+    success, output_file, _ = download(server, tmp_path, CONTENT[:PARTIAL_SIZE])
+    assert not success
+    assert not output_file.exists()
+    assert not get_partial_file(output_file).exists()
+    # The next attempt starts over.
+    server.mode = 'range'
+    success, output_file, _ = download(server, tmp_path)
+    assert success
+    assert output_file.read_bytes() == CONTENT
+    assert server.ranges == [f'bytes={PARTIAL_SIZE}-', None]
+
+
+@pytest.mark.parametrize('content_range, expected', [
+    ('bytes 100-199/1000', (100, 1000)),
+    ('bytes 100-199/*', (100, None)),
+    ('bytes */1000', (None, 1000)),
+    ('', (None, None)),
+    ('items 0-1/2', (None, None)),
+])
+def test_parse_content_range(content_range, expected):
+    assert BaseFetcher.parse_content_range(content_range) == expected
+
+
+def test_thread_sessions(server):
+    sessions = ThreadSessions(1)
+    url = f'http://127.0.0.1:{server.server_address[1]}/bview.20240101.0000.gz'
+    thread_sessions = list()
+
+    def get() -> None:
+        assert sessions.get(url).content == CONTENT
+        thread_sessions.append(sessions.get_session())
+
+    threads = [threading.Thread(target=get) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(map(id, thread_sessions))) == 4
+    assert sessions.get_session() is sessions.get_session()
+    assert len(sessions.sessions) == 5
+    sessions.close()
+    assert sessions.sessions == []
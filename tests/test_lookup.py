@@ -0,0 +1,79 @@
+import random
+import socket
+
+import pytest
+import radix
+
+from helpers.columnar import KIND_MERGED, rtree_to_rows, write_columnar
+from helpers.lookup import PrefixLookup, merged_rtree_rows, read_merged_rows
+from helpers.merged_tree import SEEN_BY_COLLECTORS
+
+COLLECTORS = ['rrc00', 'route-views2']
+# Nested prefixes whose more-specifics have origins that are not plain ASNs, and AS0.
+ORIGINS = {
+    '10.0.0.0/8': '64496',
+    '10.1.0.0/16': '',
+    '10.1.2.0/24': '64497',
+    '10.2.0.0/16': '{64500,64501}',
+    '10.3.0.0/16': '0',
+    '192.0.2.0/24': '0123',
+    '2001:db8::/32': '64498',
+    '2001:db8:1::/48': '',
+}
+
+
+def make_merged_rtree() -> radix.Radix:
+    rtree = radix.Radix()
+    for prefix, origin in ORIGINS.items():
+        node = rtree.add(prefix)
+        node.data['as'] = origin
+        node.data[SEEN_BY_COLLECTORS] = tuple(COLLECTORS)
+    return rtree
+
+
+def get_addresses(rtree: radix.Radix, count: int = 2000) -> list:
+    rnd = random.Random(0)
+    addresses = list()
+    for _ in range(count):
+        node = rnd.choice(rtree.nodes())
+        family, bits = (socket.AF_INET, 32) if node.family == socket.AF_INET else (socket.AF_INET6, 128)
+        address = int.from_bytes(node.packed, 'big') | rnd.getrandbits(bits - node.prefixlen)
+        addresses.append(socket.inet_ntop(family, address.to_bytes(bits // 8, 'big')))
+    return addresses + ['11.0.0.0', '2001:db9::1']
+
+
+def search_best(rtree: radix.Radix, address: str) -> tuple:
+    node = rtree.search_best(address)
+    if node is None:
+        return None, 0
+    return node.data['as'], len(node.data[SEEN_BY_COLLECTORS])
+
+
+def test_matches_search_best():
+    rtree = make_merged_rtree()
+    lookup = PrefixLookup(merged_rtree_rows(rtree))
+    addresses = get_addresses(rtree)
+    assert lookup.lookup(addresses) == [search_best(rtree, address) for address in addresses]
+    assert lookup.lookup(['10.1.0.1', '10.3.0.1', '11.0.0.0']) == [('', 2), ('0', 2), (None, 0)]
+
+
+def test_no_match_and_as0():
+    lookup = PrefixLookup(merged_rtree_rows(make_merged_rtree()))
+    asns, counts = lookup.lookup_array(4, [int.from_bytes(socket.inet_aton(address), 'big')
+                                           for address in ('10.3.0.1', '11.0.0.0')])
+    assert asns.tolist() == [0, 0]
+    assert counts.tolist() == [2, 0]
+
+
+@pytest.mark.parametrize('saved', [False, True])
+def test_columnar_file(tmp_path, saved):
+    rtree = make_merged_rtree()
+    merged_file = str(tmp_path / '20240101.merged.col')
+    write_columnar(merged_file, rtree_to_rows(rtree, COLLECTORS), KIND_MERGED, COLLECTORS)
+    assert sorted(read_merged_rows(merged_file), key=str) == sorted(merged_rtree_rows(rtree), key=str)
+    lookup = PrefixLookup.from_file(merged_file)
+    if saved:
+        lookup.save(str(tmp_path / 'lookup.npz'))
+        lookup = PrefixLookup.from_file(str(tmp_path / 'lookup.npz'))
+    addresses = get_addresses(rtree)
+    assert lookup.lookup(addresses) == [search_best(rtree, address) for address in addresses]
@@ -0,0 +1,173 @@
+import logging
+
+import pytest
+
+from helpers.transform import aggregate_entries, aggregate_entries_compact, aggregate_rib, new_transform_stats
+from readers.MRTReader import AS_SEQUENCE, AS_SET, TABLE_DUMP_V2, MRTReader
+from tests.mrt_fixtures import (BGP4MP, RIB_GENERIC, RIB_IPV4_MULTICAST, RIB_IPV6_MULTICAST, as_path, attributes,
+                                mrt_record, peer_index_table, rib_record, write_mrt_file)
+
+PEERS = [
+    ('192.0.2.1', 64496, False),
+    ('2001:db8::1', 64497, False),
+    ('198.51.100.7', 64498, True),
+    ('2001:db8:ffff::2', 4200000000, True),
+]
+
+
+def read_file(path, records: list, **kwargs) -> tuple:
+    write_mrt_file(str(path), records)
+    reader = MRTReader(str(path), **kwargs)
+    return list(reader.read()), reader
+
+
+def test_peer_index_table(tmp_path):
+    entries, reader = read_file(tmp_path / 'rib', [peer_index_table(PEERS)])
+    assert entries == []
+    assert reader.peers == [(peer_ip, peer_asn) for peer_ip, peer_asn, _ in PEERS]
+
+
+def test_two_byte_asn_peer_next_to_four_byte_peer(tmp_path):
+    # The entry sizes differ, so a wrong ASN length shifts all following peers.
+    peers = [('192.0.2.1', 65535, False), ('192.0.2.2', 65536, True), ('192.0.2.3', 1, False)]
+    _, reader = read_file(tmp_path / 'rib', [peer_index_table(peers)])
+    assert reader.peers == [('192.0.2.1', 65535), ('192.0.2.2', 65536), ('192.0.2.3', 1)]
+
+
+def test_origins(tmp_path):
+    records = [
+        peer_index_table(PEERS),
+        rib_record(0, '203.0.113.0/24', [
+            (0, as_path((AS_SEQUENCE, [64496, 64511, 15169]))),
+            (1, as_path((AS_SEQUENCE, [64497]), (AS_SET, [64500, 64501]))),
+            (2, as_path()),
+            (3, None),
+            (0, as_path((AS_SEQUENCE, [64496, 4200000000]))),
+            (1, as_path((AS_SET, [64500]), (AS_SEQUENCE, [64502]))),
+        ]),
+    ]
+    entries, _ = read_file(tmp_path / 'rib', records)
+    assert entries == [
+        (0, '203.0.113.0/24', '15169'),
+        (1, '203.0.113.0/24', '{64500,64501}'),
+        (2, '203.0.113.0/24', ''),
+        (3, '203.0.113.0/24', ''),
+        (0, '203.0.113.0/24', '4200000000'),
+        (1, '203.0.113.0/24', '64502'),
+    ]
+
+
+def test_extended_length_attribute(tmp_path):
+    path = as_path((AS_SEQUENCE, list(range(64496, 64496 + 100))))
+    records = [peer_index_table(PEERS), rib_record(0, '203.0.113.0/24', [(0, attributes(path, extended_length=True))])]
+    entries, _ = read_file(tmp_path / 'rib', records)
+    assert entries == [(0, '203.0.113.0/24', '64595')]
+
+
+@pytest.mark.parametrize('prefix', ['0.0.0.0/0', '10.0.0.0/7', '192.0.2.0/23', '203.0.113.128/25', '198.51.100.1/32',
+                                    '::/0', '2001:db8::/32', '2001:db8:8000::/33', '2001:db8::1/128'])
+def test_prefixes(tmp_path, prefix):
+    entries, _ = read_file(tmp_path / 'rib', [rib_record(0, prefix, [(0, as_path((AS_SEQUENCE, [64496])))])])
+    assert entries == [(0, prefix, '64496')]
+
+
+def test_add_path(tmp_path):
+    records = [
+        peer_index_table(PEERS),
+        rib_record(0, '203.0.113.0/24', [(0, as_path((AS_SEQUENCE, [64496])), 1),
+                                         (0, as_path((AS_SEQUENCE, [64511])), 2)], add_path=True),
+        rib_record(1, '2001:db8::/32', [(1, as_path((AS_SEQUENCE, [64497])), 7),
+                                        (3, as_path((AS_SET, [64500, 64501])), 8)], add_path=True),
+        rib_record(2, '198.51.100.0/24', [(2, as_path((AS_SEQUENCE, [64498])))]),
+    ]
+    entries, _ = read_file(tmp_path / 'rib', records)
+    assert entries == [
+        (0, '203.0.113.0/24', '64496'),
+        (0, '203.0.113.0/24', '64511'),
+        (1, '2001:db8::/32', '64497'),
+        (3, '2001:db8::/32', '{64500,64501}'),
+        (2, '198.51.100.0/24', '64498'),
+    ]
+
+
+def test_skipped_records(tmp_path, caplog):
+    records = [
+        peer_index_table(PEERS),
+        rib_record(0, '203.0.113.0/24', [(0, as_path((AS_SEQUENCE, [64496])))]),
+        # RIB_GENERIC: sequence number, AFI, SAFI, NLRI and entries, never decoded.
+        mrt_record(TABLE_DUMP_V2, RIB_GENERIC, b'\x00\x00\x00\x01\x00\x01\x02\x18\xcb\x00\x71\x00\x00'),
+        mrt_record(TABLE_DUMP_V2, RIB_GENERIC, b'\x00\x00\x00\x02\x00\x02\x80\x00\x00\x00'),
+        mrt_record(TABLE_DUMP_V2, RIB_IPV4_MULTICAST, rib_record(3, '224.0.0.0/4', [])[12:]),
+        mrt_record(TABLE_DUMP_V2, RIB_IPV6_MULTICAST, rib_record(4, 'ff00::/8', [])[12:]),
+        mrt_record(BGP4MP, 4, b'\x00' * 20),
+        rib_record(5, '2001:db8::/32', [(1, as_path((AS_SEQUENCE, [64497])))]),
+    ]
+    with caplog.at_level(logging.WARNING):
+        entries, _ = read_file(tmp_path / 'rib', records)
+    assert entries == [(0, '203.0.113.0/24', '64496'), (1, '2001:db8::/32', '64497')]
+    # One warning per skipped record type.
+    assert len(caplog.records) == 4
+    for subtype in (RIB_GENERIC, RIB_IPV4_MULTICAST, RIB_IPV6_MULTICAST):
+        assert any(f'type {TABLE_DUMP_V2} subtype {subtype}' in record.message for record in caplog.records)
+
+
+def test_truncated_record(tmp_path, caplog):
+    record = rib_record(0, '203.0.113.0/24', [(0, as_path((AS_SEQUENCE, [64496])))])
+    with caplog.at_level(logging.ERROR):
+        entries, _ = read_file(tmp_path / 'rib', [record, record[:-3]])
+    assert entries == [(0, '203.0.113.0/24', '64496')]
+    assert 'Truncated MRT record' in caplog.text
+
+
+@pytest.mark.parametrize('file_name', ['rib.20240101.0000.bz2', 'bview.20240101.0000.gz'])
+def test_compressed_files(tmp_path, file_name):
+    records = [peer_index_table(PEERS), rib_record(0, '203.0.113.0/24', [(0, as_path((AS_SEQUENCE, [64496])))])]
+    entries, reader = read_file(tmp_path / file_name, records)
+    assert entries == [(0, '203.0.113.0/24', '64496')]
+    assert reader.decompress_time is not None
+
+
+def test_shards(tmp_path):
+    prefixes = [f'10.{idx}.0.0/16' for idx in range(64)] + [f'2001:db8:{idx:x}::/48' for idx in range(64)]
+    records = [peer_index_table(PEERS)]
+    records += [rib_record(idx, prefix, [(0, as_path((AS_SEQUENCE, [64496]))), (1, as_path((AS_SEQUENCE, [64497])))])
+                for idx, prefix in enumerate(prefixes)]
+    entries, _ = read_file(tmp_path / 'rib', records)
+    shard_entries = [read_file(tmp_path / 'rib', records, shard=shard, num_shards=3)[0] for shard in range(3)]
+    assert all(shard_entries)
+    assert sorted(entry for entries_of_shard in shard_entries for entry in entries_of_shard) == sorted(entries)
+
+
+def test_aggregate_rib(tmp_path):
+    records = [
+        peer_index_table(PEERS),
+        rib_record(0, '8.8.8.0/24', [(0, as_path((AS_SEQUENCE, [64496, 15169]))),
+                                     (2, as_path((AS_SEQUENCE, [64498, 15169])))]),
+        rib_record(1, '10.0.0.0/8', [(0, as_path((AS_SEQUENCE, [64496])))]),
+        rib_record(2, '1.1.1.0/24', [(0, as_path((AS_SEQUENCE, [13335]))), (2, as_path((AS_SEQUENCE, [64511])))]),
+        rib_record(3, '2001:db8:1::/48', [(1, as_path((AS_SEQUENCE, [64497])))]),
+        rib_record(4, '2a00::/12', [(1, as_path((AS_SET, [64500, 64501])))]),
+    ]
+    write_mrt_file(str(tmp_path / 'rib'), records)
+    rtree, stats = aggregate_rib(str(tmp_path / 'rib'), 'mrt', aggregation='radix')
+    assert {node.prefix: node.data['as'] for node in rtree.nodes()} == {'8.8.8.0/24': {'15169'},
+                                                                        '1.1.1.0/24': {'13335', '64511'}}
+    assert stats['peers'] == {0, 1, 2}
+    assert stats['origin_sets'] == 1
+
+
+@pytest.mark.parametrize('aggregate', [aggregate_entries, aggregate_entries_compact])
+def test_peer_ips_are_not_split(aggregate, caplog):
+    """Regression test: peers were stored as list(peer_ip), i.e., split into characters,
+    so a peer that reported two origins for a prefix was never recognized."""
+    entries = [('192.0.2.1', '8.8.8.0/24', '15169'),
+               ('198.51.100.7', '8.8.8.0/24', '15169'),
+               ('192.0.2.1', '8.8.8.0/24', '64511')]
+    stats = new_transform_stats('rib')
+    with caplog.at_level(logging.ERROR):
+        result = aggregate(entries, stats)
+    assert stats['peers'] == {'192.0.2.1', '198.51.100.7'}
+    assert 'Peer 192.0.2.1 reported different origins for 8.8.8.0/24' in caplog.text
+    if aggregate is aggregate_entries:
+        # Peers are only added with a new origin.
+        assert result.search_exact('8.8.8.0/24').data['peers'] == ['192.0.2.1', '192.0.2.1']
@@ -0,0 +1,150 @@
+"""Differential tests of PrefixClassifier against ipaddress.ip_network(prefix).is_global."""
+import ipaddress
+import random
+
+import pytest
+
+from helpers import prefix_filter
+from helpers.prefix_filter import DEFAULT_CACHE_SIZE, SHARED_ADDRESS_SPACE, PrefixClassifier, build_table
+
+PRIVATE_NETWORKS = ipaddress._IPv4Constants._private_networks + ipaddress._IPv6Constants._private_networks
+INTERPRETER_EXCEPTIONS = (getattr(ipaddress._IPv4Constants, '_private_networks_exceptions', list())
+                          + getattr(ipaddress._IPv6Constants, '_private_networks_exceptions', list()))
+# Exceptions from the private ranges of newer Python versions (3.12.4+), which carve
+# globally reachable networks out of 192.0.0.0/24 and 2001::/23.
+NEWER_EXCEPTIONS = [ipaddress.ip_network(network) for network in (
+    '192.0.0.9/32', '192.0.0.10/32', '2001:1::1/128', '2001:1::2/128', '2001:3::/32', '2001:4:112::/48',
+    '2001:20::/28', '2001:30::/28')]
+RANDOM_PREFIXES = 100_000
+
+
+def reference_is_global(prefix: str, exceptions: list) -> bool:
+    """is_global as implemented by ipaddress, with the given private network exceptions."""
+    network = ipaddress.ip_network(prefix)
+    first, last = network.network_address, network.broadcast_address
+    if network.version == 4 and first in SHARED_ADDRESS_SPACE and last in SHARED_ADDRESS_SPACE:
+        return False
+    is_private = any(first in private and last in private
+                     for private in PRIVATE_NETWORKS if private.version == network.version)
+    if is_private:
+        is_private = all(first not in exception and last not in exception
+                         for exception in exceptions if exception.version == network.version)
+    return not is_private
+
+
+def make_prefix(version: int, address: int, length: int) -> str:
+    network_class = ipaddress.IPv4Network if version == 4 else ipaddress.IPv6Network
+    return str(network_class((address, length), strict=False))
+
+
+def get_boundary_prefixes(special: ipaddress._BaseNetwork, lengths: range) -> set:
+    """Return the prefixes of each length that contain the first or last address of the
+    special network or the addresses right outside of it."""
+    max_address = (1 << special.max_prefixlen) - 1
+    addresses = [int(special.network_address), int(special.broadcast_address)]
+    addresses += [address for address in (addresses[0] - 1, addresses[1] + 1) if 0 <= address <= max_address]
+    prefixes = set()
+    for address in addresses:
+        for length in lengths:
+            prefixes.add(make_prefix(special.version, address, length))
+    return prefixes
+
+
+def get_random_prefix(rnd: random.Random, network: ipaddress._BaseNetwork) -> str:
+    """Return a random subnet or supernet of network."""
+    length = rnd.randint(0, network.max_prefixlen)
+    address = int(network.network_address) | rnd.getrandbits(network.max_prefixlen - network.prefixlen)
+    return make_prefix(network.version, address, length)
+
+
+def get_corpus(seed: int = 0) -> list:
+    special_networks = PRIVATE_NETWORKS + INTERPRETER_EXCEPTIONS + NEWER_EXCEPTIONS + [SHARED_ADDRESS_SPACE]
+    prefixes = set()
+    for special in special_networks:
+        if special.version == 4:
+            prefixes |= get_boundary_prefixes(special, range(8, 33))
+        else:
+            prefixes |= get_boundary_prefixes(special, range(16, 129))
+    rnd = random.Random(seed)
+    for special in special_networks:
+        prefixes.update(get_random_prefix(rnd, special) for _ in range(100))
+    ipv4_all = ipaddress.ip_network('0.0.0.0/0')
+    ipv6_all = ipaddress.ip_network('::/0')
+    prefixes.update(get_random_prefix(rnd, ipv4_all) for _ in range(RANDOM_PREFIXES // 10))
+    prefixes.update(get_random_prefix(rnd, ipv6_all) for _ in range(RANDOM_PREFIXES))
+    return sorted(prefixes)
+
+
+@pytest.fixture(scope='module')
+def corpus() -> list:
+    return get_corpus()
+
+
+def test_special_blocks_cover_all_lengths(corpus):
+    prefixes = set(corpus)
+    for special in ipaddress._IPv4Constants._private_networks + [SHARED_ADDRESS_SPACE]:
+        for length in range(8, 33):
+            assert make_prefix(4, int(special.network_address), length) in prefixes
+
+
+def test_matches_ipaddress(corpus):
+    classifier = PrefixClassifier()
+    mismatches = [prefix for prefix in corpus
+                  if classifier.is_global(prefix) != ipaddress.ip_network(prefix).is_global]
+    assert mismatches == []
+
+
+def test_matches_reference(corpus):
+    # The reference is only a valid stand-in for the newer exceptions below if it agrees
+    # with ipaddress for the exceptions of the running interpreter.
+    mismatches = [prefix for prefix in corpus
+                  if reference_is_global(prefix, INTERPRETER_EXCEPTIONS) != ipaddress.ip_network(prefix).is_global]
+    assert mismatches == []
+
+
+def test_exception_networks(corpus, monkeypatch):
+    monkeypatch.setattr(prefix_filter, 'EXCEPTION_TABLE', build_table(NEWER_EXCEPTIONS))
+    classifier = PrefixClassifier()
+    mismatches = [prefix for prefix in corpus
+                  if classifier.is_global(prefix) != reference_is_global(prefix, NEWER_EXCEPTIONS)]
+    assert mismatches == []
+    assert classifier.is_global('192.0.0.9/32')
+    assert classifier.is_global('2001:4:112::/48')
+    assert not classifier.is_global('192.0.0.0/29')
+
+
+def test_shared_address_space():
+    classifier = PrefixClassifier()
+    for length in range(10, 33):
+        assert not classifier.is_global(str(ipaddress.ip_network(('100.64.0.0', length), strict=False)))
+        assert not classifier.is_global(str(ipaddress.ip_network(('100.127.255.255', length), strict=False)))
+    for length in range(8, 10):
+        assert classifier.is_global(str(ipaddress.ip_network(('100.64.0.0', length), strict=False)))
+    assert classifier.is_global('100.63.255.0/24')
+    assert classifier.is_global('100.128.0.0/24')
+
+
+def test_invalid_prefixes():
+    classifier = PrefixClassifier()
+    for prefix in ('1.2.3.4/24', '256.0.0.0/8', '01.0.0.0/8', '1.0.0.0/33', '::1/129', 'foo'):
+        with pytest.raises(ValueError):
+            classifier.is_global(prefix)
+
+
+def test_cache_clear(corpus):
+    classifier = PrefixClassifier(cache_size=64)
+    for prefix in corpus[:1000]:
+        assert classifier.is_global(prefix) == ipaddress.ip_network(prefix).is_global
+        assert len(classifier.cache) <= 64
+
+
+def test_default_cache_clear():
+    assert DEFAULT_CACHE_SIZE == 1 << 21
+    classifier = PrefixClassifier()
+    # Fill the cache with stale verdicts instead of classifying 2^21 prefixes.
+    classifier.cache = dict.fromkeys((f'{idx}.0.0.0/32' for idx in range(DEFAULT_CACHE_SIZE)), True)
+    assert not classifier.is_global('10.0.0.0/8')
+    assert classifier.cache == {'10.0.0.0/8': False}
+    assert classifier.is_global('8.8.8.0/24')
+    assert not classifier.is_global('10.0.0.0/8')
+    assert not classifier.is_global('0.0.0.0/32')
@@ -0,0 +1,65 @@
+import importlib.util
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+from helpers.merge import get_merged_output_file_name, parse_merged_file_name
+
+spec = importlib.util.spec_from_file_location('query_service', os.path.join(os.path.dirname(__file__), '..',
+                                                                            'query-service.py'))
+query_service = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(query_service)
+
+
+@pytest.mark.parametrize('file_name, expected', [
+    ('20240101.merged.pickle.bz2', (datetime(2024, 1, 1, tzinfo=timezone.utc), '')),
+    ('20240101.min_3.merged.col', (datetime(2024, 1, 1, tzinfo=timezone.utc), 'min_3')),
+    ('20240101.min_ratio_0.5.merged.pickle.xz', (datetime(2024, 1, 1, tzinfo=timezone.utc), 'min_ratio_0.5')),
+    ('20240101.1200.merged.pickle', (datetime(2024, 1, 1, 12, tzinfo=timezone.utc), '')),
+    ('20240101.1200.min_2.merged.col', (datetime(2024, 1, 1, 12, tzinfo=timezone.utc), 'min_2')),
+    ('20240101.merged.txt', None),
+    ('latest.merged.col', None),
+])
+def test_parse_merged_file_name(file_name, expected):
+    assert parse_merged_file_name(file_name) == expected
+
+
+def test_parse_output_file_names():
+    timestamp = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for output_format in ('pickle', 'columnar'):
+        assert parse_merged_file_name(get_merged_output_file_name(timestamp, output_format)) == (timestamp, '')
+        assert parse_merged_file_name(get_merged_output_file_name(timestamp, output_format, min_collector_ratio=0.5)) \
+            == (timestamp, 'min_ratio_0.5')
+        assert parse_merged_file_name(get_merged_output_file_name(timestamp, output_format, min_collector_count=2)) \
+            == (timestamp, 'min_2')
+
+
+@pytest.mark.parametrize('variant, expected', [
+    ('', '20240102.merged.pickle.bz2'),
+    ('min_2', '20240102.min_2.merged.col'),
+    ('min_ratio_0.5', '20240101.min_ratio_0.5.merged.col'),
+    ('min_3', None),
+])
+def test_find_latest_file(tmp_path, variant, expected):
+    # Written in this order, so that the backfilled and threshold trees are the most recently
+    # modified files.
+    for mtime, file_name in enumerate(['20240102.merged.pickle.bz2', '20240102.min_2.merged.col',
+                                       '20231231.merged.pickle.bz2', '20240101.merged.col',
+                                       '20240101.min_ratio_0.5.merged.col', '20240101.min_2.merged.col']):
+        path = tmp_path / file_name
+        path.touch()
+        os.utime(path, (mtime, mtime))
+    service = query_service.QueryService(str(tmp_path), None, 30, variant)
+    latest = service.find_latest_file()
+    assert (os.path.basename(latest) if latest else None) == expected
+
+
+def test_find_latest_file_tie(tmp_path):
+    # The same timestamp in two formats: the more recently written file wins.
+    for mtime, file_name in enumerate(['20240101.merged.col', '20240101.merged.pickle.bz2']):
+        path = tmp_path / file_name
+        path.touch()
+        os.utime(path, (mtime, mtime))
+    service = query_service.QueryService(str(tmp_path), None, 30)
+    assert os.path.basename(service.find_latest_file()) == '20240101.merged.pickle.bz2'
@@ -0,0 +1,22 @@
+from helpers.telemetry import write_prometheus_textfile
+
+
+def test_prometheus_collector_labels(tmp_path):
+    file_stats = [
+        {'file': '/data/ris/rrc00/2024.01/bview.20240101.0000.gz', 'source': 'ris', 'collector': 'rrc00',
+         'duration': 2.0, 'bytes_written': 100, 'peak_memory': 10},
+        {'file': '/data/ris/rrc00/2024.01/bview.20240102.0000.gz', 'source': 'ris', 'collector': 'rrc00',
+         'duration': 3.0, 'bytes_written': 200, 'peak_memory': 30},
+        {'file': '/data/routeviews/rv1/2024.01/rib.20240101.0000.bz2', 'source': 'routeviews', 'collector': 'rv1',
+         'duration': 1.0, 'bytes_written': 50, 'peak_memory': 20},
+    ]
+    write_prometheus_textfile(str(tmp_path), 'transform', {'duration': 5.0}, file_stats)
+    lines = (tmp_path / 'ribexplorer_transform.prom').read_text().splitlines()
+    assert not any('/data/' in line for line in lines)
+    samples = dict(line.rsplit(' ', 1) for line in lines if line.startswith('ribexplorer_collector_'))
+    labels = 'stage="transform",source="ris",collector="rrc00"'
+    assert samples[f'ribexplorer_collector_duration_seconds{{{labels}}}'] == '5.0'
+    assert samples[f'ribexplorer_collector_written_bytes{{{labels}}}'] == '300'
+    assert samples[f'ribexplorer_collector_peak_memory_bytes{{{labels}}}'] == '30'
+    assert samples[f'ribexplorer_collector_files{{{labels}}}'] == '2'
+    assert samples['ribexplorer_collector_files{stage="transform",source="routeviews",collector="rv1"}'] == '1'
@@ -0,0 +1,41 @@
+import os
+
+from helpers.transform_cache import TransformCache
+
+
+def write_file(path, content: bytes, mtime: int) -> str:
+    path.write_bytes(content)
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def test_adopt_existing_output(tmp_path):
+    rib_file = write_file(tmp_path / 'rib.bz2', b'rib', 1000)
+    output_file = write_file(tmp_path / 'rib.pickle.bz2', b'tree', 2000)
+    cache = TransformCache(str(tmp_path))
+    key = cache.get_key(rib_file, 'bgpkit')
+    assert cache.lookup(rib_file, output_file, key)
+    cache.save()
+    # Recorded, so the next run finds it in the manifest.
+    cache = TransformCache(str(tmp_path))
+    assert cache.files[os.path.normpath(rib_file)]['outputs'] == {
+        os.path.normpath(output_file): {'size': 4, 'mtime_ns': 2000 * 10**9}}
+    assert cache.lookup(rib_file, output_file, key)
+
+
+def test_do_not_adopt_older_output(tmp_path):
+    rib_file = write_file(tmp_path / 'rib.bz2', b'rib', 2000)
+    output_file = write_file(tmp_path / 'rib.pickle.bz2', b'tree', 1000)
+    cache = TransformCache(str(tmp_path))
+    assert not cache.lookup(rib_file, output_file, cache.get_key(rib_file, 'bgpkit'))
+    assert not cache.files
+
+
+def test_do_not_adopt_for_known_input(tmp_path):
+    rib_file = write_file(tmp_path / 'rib.bz2', b'rib', 1000)
+    output_file = write_file(tmp_path / 'rib.pickle.bz2', b'tree', 2000)
+    cache = TransformCache(str(tmp_path))
+    cache.record(rib_file, output_file, cache.get_key(rib_file, 'bgpkit'))
+    # The RIB changed since its output was recorded.
+    write_file(tmp_path / 'rib.bz2', b'new rib', 1500)
+    assert not cache.lookup(rib_file, output_file, cache.get_key(rib_file, 'bgpkit'))
@@ -1,155 +1,24 @@
 import argparse
-import bz2
-import ipaddress
 import json
 import logging
 import os
-import pickle
-import subprocess as sp
 import sys
 from datetime import timedelta
 from multiprocessing import Pool
 from shutil import which
-from socket import AF_INET
-from typing import Tuple
 
-import radix
-
-from helpers.defines import (DEFAULT_DATA_FOLDER, DEFAULT_STATS_FOLDER, DEFAULT_TRANSFORMED_FOLDER, FOLDER_FORMAT,
-                             RIB_FILE_FORMATS, TIMESTAMP_FORMAT_ESCAPED)
+from helpers.compression import CODECS, get_compression
+from helpers.defines import (DEFAULT_DATA_FOLDER, DEFAULT_INDEX_FOLDER, DEFAULT_PROFILE_FOLDER, DEFAULT_STATS_FOLDER,
+                             DEFAULT_TRANSFORMED_FOLDER, RIB_FILE_FORMATS, TIMESTAMP_FORMAT_ESCAPED)
+from helpers.file_catalog import FileCatalog
+from helpers.profiling import Profiler, get_profile_dir, summarize_profiles
 from helpers.shared_functions import (get_candidate_file, get_latest_index_file, get_stat_file_name,
-                                      parse_timestamp_argument)
-
-OUTPUT_FILE_SUFFIX = '.pickle.bz2'
-
-
-def transform_rib(fixture: Tuple[str, str]) -> dict:
-    input_file, output_file = fixture
-    logging.info(f'Processing {input_file}')
-    rtree = radix.Radix()
-
-    stats = {'file': input_file,
-             'peers': set(),
-             'entries': 0,
-             'origin_sets': 0,
-             'v4_pfxs': 0,
-             'v6_pfxs': 0,
-             'ignored_v4_pfxs': 0,
-             'ignored_v6_pfxs': 0}
-
-    # Output format:
-    #   type|timestamp|peer_ip|peer_asn|prefix|as_path|origin_asns|origin|
-    #   next_hop|local_pref|med|communities|atomic|aggr_asn|aggr_ip|only_to_customer
-    p = sp.Popen(['bgpkit-parser', input_file], stdout=sp.PIPE, text=True, bufsize=1)
-
-    for line in p.stdout:
-        res = line.split('|')
-        peer_ip = res[2]
-        prefix = res[4]
-
-        if peer_ip not in stats['peers']:
-            stats['peers'].add(peer_ip)
-
-        try:
-            prefix_parsed = ipaddress.ip_network(prefix)
-        except ValueError as e:
-            logging.error(f'Invalid prefix ({prefix}): {e}')
-            continue
-
-        if not prefix_parsed.is_global:
-            logging.debug(f'Ignoring non-global prefix: {prefix}')
-            continue
-
-        stats['entries'] += 1
-
-        as_path = res[5]
-        origin_asn = as_path.split(' ')[-1]
-        if ',' in origin_asn:
-            # Do not include "Origin AS Sets"
-            stats['origin_sets'] += 1
-            continue
-        # There are sometimes singleton sets of the form {ASXXX},
-        # which we should be able to use, just strip the parenthesis.
-        origin_asn = origin_asn.strip('{}')
-
-        node = rtree.add(prefix)
-        if 'as' in node.data:
-            if origin_asn not in node.data['as']:
-                logging.debug(f'{prefix}: {node.data["as"]} += {origin_asn}')
-                if peer_ip in node.data['peers']:
-                    logging.error(f'Peer {peer_ip} reported different origins for {prefix}: {node.data["as"]} '
-                                  f'{origin_asn}')
-                node.data['as'].add(origin_asn)
-                node.data['peers'].append(peer_ip)
-        else:
-            node.data['as'] = {origin_asn}
-            node.data['peers'] = list(peer_ip)
-
-    # Do not create an output file for an empty RIB.
-    if not rtree.nodes():
-        logging.warning(f'Did not create empty file: {output_file}')
-        return stats
-
-    # Remove AS sets caused by differing information from peers.
-    for node in rtree.nodes():
-        is_v4 = node.family == AF_INET
-        if is_v4:
-            stats['v4_pfxs'] += 1
-        else:
-            stats['v6_pfxs'] += 1
-        asn_set = node.data['as']
-        if len(asn_set) == 1:
-            node.data['as'] = asn_set.pop()
-            node.data.pop('peers')
-        else:
-            if is_v4:
-                stats['ignored_v4_pfxs'] += 1
-            else:
-                stats['ignored_v6_pfxs'] += 1
-            rtree.delete(node.prefix)
-
-    stats['peers'] = len(stats['peers'])
-
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    with bz2.open(output_file, 'wb') as f:
-        pickle.dump(rtree, f)
-
-    return stats
-
-
-def print_stats(stats: list) -> None:
-    for stat in sorted(stats, key=lambda d: d['file']):
-        v4_pfxs = stat['v4_pfxs']
-        ignored_v4_pfxs = stat['ignored_v4_pfxs']
-        ignored_v4_pfxs_pct = 0
-        if v4_pfxs > 0:
-            ignored_v4_pfxs_pct = ignored_v4_pfxs / v4_pfxs * 100
-        final_v4_pfxs = v4_pfxs - ignored_v4_pfxs
-        stat['ignored_v4_pfxs_pct'] = ignored_v4_pfxs_pct
-        stat['final_v4_pfxs'] = final_v4_pfxs
-        v6_pfxs = stat['v6_pfxs']
-        ignored_v6_pfxs = stat['ignored_v6_pfxs']
-        ignored_v6_pfxs_pct = 0
-        if v6_pfxs > 0:
-            ignored_v6_pfxs_pct = ignored_v6_pfxs / v6_pfxs * 100
-        final_v6_pfxs = v6_pfxs - ignored_v6_pfxs
-        stat['ignored_v6_pfxs_pct'] = ignored_v6_pfxs_pct
-        stat['final_v6_pfxs'] = final_v6_pfxs
-    # autopep8: off
-        logging.info(f'{stat["file"]} | peers:{stat["peers"]} entries:{stat["entries"]} origin_sets:{stat["origin_sets"]} v4_pfxs:{v4_pfxs} v4_ignored:{ignored_v4_pfxs} ({ignored_v4_pfxs_pct:.2f}%) v4_final:{final_v4_pfxs} v6_pfxs:{v6_pfxs} v6_ignored:{ignored_v6_pfxs} ({ignored_v6_pfxs_pct:.2f}%) v6_final:{final_v6_pfxs}')
-    # autopep8: on
-
-
-def write_stats(stats: list, output_file: str) -> None:
-    logging.info(f'Writing transform stats to {output_file}')
-    delimiter = ','
-    headers = ['file', 'peers', 'entries', 'origin_sets', 'v4_pfxs', 'ignored_v4_pfxs', 'ignored_v4_pfxs_pct',
-               'final_v4_pfxs', 'v6_pfxs', 'ignored_v6_pfxs', 'ignored_v6_pfxs_pct', 'final_v6_pfxs']
-    with open(output_file, 'w') as f:
-        f.write(delimiter.join(headers) + '\n')
-        for stat in sorted(stats, key=lambda d: d['file']):
-            line_data = [stat[h] for h in headers]
-            f.write(delimiter.join(map(str, line_data)) + '\n')
+                                      parse_timestamp_range)
+from helpers.telemetry import StageTelemetry, format_telemetry, write_prometheus_textfile
+from helpers.transform import (AGGREGATIONS, DURATIONS_FILE, OUTPUT_FILE_SUFFIXES, RIB_READERS, SCHEDULES,
+                               get_memory_limited_workers, get_transform_output_file, load_durations, print_stats,
+                               save_durations, schedule_fixtures, transform_ribs, write_stats)
+from helpers.transform_cache import TransformCache
 
 
 def main() -> None:
@@ -157,13 +26,22 @@ def main() -> None:
 
     Transform the files closest to the specified timestamp. If no file matching the
     exact timestamp is found, transform the next-closest file up to a difference of 24
-    hours, which can be adjusted with the --max-timestamp-difference parameter.
+    hours, which can be adjusted with the --max-timestamp-difference parameter. With
+    --end, the files of all timestamps of the range are transformed, and files that are
+    closest to several timestamps only once.
 
     Ignore prefixes with origin AS sets from the RIB, but also origin AS sets that would be created
     due to peers disagreeing on the origin AS for a prefix.
     """
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument('timestamp', help=f'UTC timestamp in {TIMESTAMP_FORMAT_ESCAPED} format')
+    parser.add_argument('--end',
+                        help=f'UTC timestamp in {TIMESTAMP_FORMAT_ESCAPED} format. Process all timestamps from '
+                             'timestamp to end (inclusive), see --step')
+    parser.add_argument('--step',
+                        type=float,
+                        default=24,
+                        help='hours between the timestamps of a range (default: 24)')
     parser.add_argument('--max-timestamp-difference',
                         type=int,
                         default=24,
@@ -179,6 +57,50 @@ def main() -> None:
                         type=int,
                         default=4,
                         help='number of parallel workers')
+    parser.add_argument('-r', '--reader',
+                        choices=sorted(RIB_READERS),
+                        default='bgpkit',
+                        help='RIB reader backend. mrt decodes TABLE_DUMP_V2 files in-process and also measures the '
+                             'decompression time (default: bgpkit)')
+    parser.add_argument('--output-format',
+                        choices=sorted(OUTPUT_FILE_SUFFIXES),
+                        default='pickle',
+                        help='format of the output files. columnar files are uncompressed and can be memory-mapped '
+                             '(default: pickle)')
+    parser.add_argument('--compression',
+                        choices=sorted(CODECS),
+                        default='bz2',
+                        help='compression codec of pickled output files, which determines their suffix (.pickle.bz2, '
+                             '.pickle.gz, .pickle.xz or .pickle). Readers detect the codec by its magic bytes '
+                             '(default: bz2)')
+    parser.add_argument('--compression-level',
+                        type=int,
+                        help='compression level of --compression (default: 9 for bz2, 6 for gzip and lzma)')
+    parser.add_argument('--aggregation',
+                        choices=AGGREGATIONS,
+                        default='compact',
+                        help='data structure used to aggregate the origins of a file. compact stores integers in '
+                             'dicts and builds the radix tree at the end, radix uses a radix tree with sets of origins '
+                             'throughout. Both produce the same output (default: compact)')
+    parser.add_argument('--memory-budget',
+                        type=int,
+                        help='total memory (in MiB) available to the workers. Reduces the number of workers based on '
+                             'the peak memory of previous runs')
+    parser.add_argument('--shards',
+                        type=int,
+                        default=1,
+                        help='split each file into this many shards that are processed by separate workers. Useful '
+                             'if there are fewer files than workers (default: 1)')
+    parser.add_argument('--schedule',
+                        choices=SCHEDULES,
+                        default='history',
+                        help='order in which files are processed. history starts the files that took longest in '
+                             'previous runs first and falls back to size, which starts the largest files first '
+                             '(default: history)')
+    parser.add_argument('--hash-inputs',
+                        action='store_true',
+                        help='identify RIB files by their content hash instead of their size and modification time '
+                             'when checking if transformed files are up to date')
     parser.add_argument('-f', '--force',
                         action='store_true',
                         help='overwrite existing files')
@@ -186,6 +108,18 @@ def main() -> None:
     parser.add_argument('-s', '--stats-dir',
                         default=DEFAULT_STATS_FOLDER,
                         help=f'stats output directory (default: {DEFAULT_STATS_FOLDER})')
+    parser.add_argument('--textfile-dir',
+                        help='also write telemetry as Prometheus metrics to this node exporter textfile collector '
+                        'directory')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='run each job under cProfile, write one profile per input file and a summary of the '
+                        'hottest functions to --profile-dir')
+    parser.add_argument('--profile-allocations',
+                        action='store_true',
+                        help='with --profile, also trace memory allocations with tracemalloc (slow)')
+    parser.add_argument('--profile-dir',
+                        help=f'profile output directory (default: new directory in {DEFAULT_PROFILE_FOLDER})')
     args = parser.parse_args()
 
     FORMAT = '%(asctime)s %(levelname)s %(message)s'
@@ -200,19 +134,28 @@ def main() -> None:
     )
 
     logging.info(f'Started {sys.argv}')
+    telemetry = StageTelemetry('transform')
+
+    try:
+        compression = get_compression(args.compression, args.compression_level)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
 
-    if not which('bgpkit-parser'):
+    if args.reader == 'bgpkit' and not which('bgpkit-parser'):
         logging.error('Failed to find bgpkit-parser executable. Is it installed?')
         sys.exit(1)
 
-    timestamp = parse_timestamp_argument(args.timestamp)
-    if timestamp is None:
+    timestamps = parse_timestamp_range(args.timestamp, args.end, args.step)
+    if timestamps is None:
         logging.error('Invalid timestamp specified')
         sys.exit(1)
+    if args.end:
+        logging.info(f'Processing {len(timestamps)} timestamps from {timestamps[0]} to {timestamps[-1]}')
 
     index_file = args.index
     if index_file is None:
-        index_file = get_latest_index_file(timestamp)
+        index_file = get_latest_index_file(timestamps[-1], FileCatalog(DEFAULT_INDEX_FOLDER))
         if not index_file:
             sys.exit(1)
     with open(index_file, 'r') as f:
@@ -223,36 +166,109 @@ def main() -> None:
     max_timestamp_difference = timedelta(hours=args.max_timestamp_difference)
 
     fixtures = list()
+    # Collector key (source/collector) of each input file.
+    fixture_keys = dict()
+    # Output file and cache key of each input file.
+    output_files = dict()
+    cache_keys = dict()
+    # Input files of each timestamp, used for the stats files. Neighboring timestamps may
+    # share files, which are only transformed once.
+    timestamp_files = {timestamp: list() for timestamp in timestamps}
+    planned_files = set()
+    cache = TransformCache(input_dir, args.hash_inputs)
+    input_catalog = FileCatalog(input_dir)
+    output_catalog = FileCatalog(output_dir)
     skipped_files = 0
-    for source, collectors in index['sources'].items():
-        for collector in collectors:
-            collector_dir = os.path.join(input_dir, source, collector)
-            candidate_file = get_candidate_file(collector_dir,
-                                                timestamp,
-                                                max_timestamp_difference,
-                                                RIB_FILE_FORMATS)
-            if candidate_file is None:
-                continue
-            output_file_name = f'{os.path.splitext(candidate_file[0])[0]}{OUTPUT_FILE_SUFFIX}'
-            output_file = os.path.join(output_dir, source, collector,
-                                       timestamp.strftime(FOLDER_FORMAT), output_file_name)
-            if not args.force and os.path.exists(output_file):
-                skipped_files += 1
-                continue
-            fixtures.append((candidate_file[1], output_file))
+    for timestamp in timestamps:
+        for source, collectors in index['sources'].items():
+            for collector in collectors:
+                collector_dir = os.path.join(input_dir, source, collector)
+                candidate_file = get_candidate_file(collector_dir,
+                                                    timestamp,
+                                                    max_timestamp_difference,
+                                                    RIB_FILE_FORMATS,
+                                                    input_catalog)
+                if candidate_file is None:
+                    continue
+                timestamp_files[timestamp].append(candidate_file[1])
+                if candidate_file[1] in planned_files:
+                    continue
+                planned_files.add(candidate_file[1])
+                output_file = get_transform_output_file(candidate_file[0], output_dir, source, collector, timestamp,
+                                                        args.output_format, compression)
+                cache_key = cache.get_key(candidate_file[1], args.reader, compression)
+                if not args.force and cache.lookup(candidate_file[1], output_file, cache_key):
+                    skipped_files += 1
+                    continue
+                fixtures.append((candidate_file[1], output_file, args.reader, args.output_format, args.aggregation,
+                                 compression))
+                fixture_keys[candidate_file[1]] = f'{source}/{collector}'
+                output_files[candidate_file[1]] = output_file
+                cache_keys[candidate_file[1]] = cache_key
+    if args.end:
+        logging.info(f'Found {len(planned_files)} distinct files for {len(timestamps)} timestamps')
 
     if skipped_files > 0:
-        logging.info(f'Skipped {skipped_files} existing files. Use --force to overwrite.')
+        logging.info(f'Skipped {skipped_files} up-to-date files. Use --force to overwrite.')
+
+    durations_file = os.path.join(args.stats_dir, DURATIONS_FILE)
+    durations = load_durations(durations_file)
+    fixtures = schedule_fixtures(fixtures, [fixture_keys[fixture[0]] for fixture in fixtures], durations, args.schedule)
 
     num_workers = args.num_workers
+    if args.memory_budget is not None:
+        keys = [fixture_keys[fixture[0]] for fixture in fixtures]
+        num_workers = get_memory_limited_workers(fixtures, keys, durations, num_workers, args.memory_budget * 1024**2,
+                                                 args.shards)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile_dir or get_profile_dir('transform'), args.profile_allocations)
+        logging.info(f'Writing profiles to {profiler.profile_dir}')
     logging.info(f'Processing {len(fixtures)} files with {num_workers} parallel workers')
-    with Pool(num_workers) as p:
-        stats = p.map(transform_rib, fixtures)
-    print_stats(stats)
+    stats = list()
+    # Use a new process for each job, so that the peak memory is measured per job and
+    # memory is returned to the system between files.
+    with Pool(num_workers, maxtasksperchild=1) as p:
+        # Report each file as soon as it is done, instead of waiting for the entire map.
+        for stat in transform_ribs(p, num_workers, fixtures, args.shards, profiler):
+            stat['source'], stat['collector'] = fixture_keys[stat['file']].split('/')
+            stats.append(stat)
+            logging.info(f'[{len(stats)}/{len(fixtures)}] Finished {stat["file"]} in {stat["duration"]:.1f}s')
+            output_file = output_files[stat['file']]
+            # No file is created for empty RIBs.
+            if os.path.exists(output_file):
+                # Save after each file, so that an interrupted run can continue from here.
+                cache.record(stat['file'], output_file, cache_keys[stat['file']])
+                cache.save()
+                output_catalog.record(output_file)
+            print_stats([stat])
+            durations[fixture_keys[stat['file']]] = {'size': os.path.getsize(stat['file']),
+                                                     'duration': stat['duration'],
+                                                     'peak_memory': stat['peak_memory']}
+
+    if stats:
+        save_durations(durations_file, durations)
+
+    if profiler is not None:
+        summarize_profiles(profiler.profile_dir)
+
+    telemetry.add_files(stats)
+    summary = telemetry.summarize()
+    logging.info(f'Transformed {len(stats)} files | {format_telemetry(summary)}')
+    if args.textfile_dir:
+        write_prometheus_textfile(args.textfile_dir, 'transform', summary, stats)
 
     if args.write_stats:
-        stats_output_file = get_stat_file_name(timestamp, args.stats_dir, 'transformed')
-        write_stats(stats, stats_output_file)
+        # Stats files are per day, so timestamps of the same day share a file.
+        stats_files = dict()
+        for timestamp, input_files in timestamp_files.items():
+            stats_output_file = get_stat_file_name(timestamp, args.stats_dir, 'transformed')
+            stats_files.setdefault(stats_output_file, set()).update(input_files)
+        for stats_output_file, input_files in stats_files.items():
+            file_stats = [stat for stat in stats if stat['file'] in input_files]
+            if args.end and not file_stats:
+                continue
+            write_stats(file_stats, stats_output_file)
 
 
 if __name__ == '__main__':